@@ -0,0 +1,192 @@
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import metrics
+
+
+# Admission control for renders in this process: at most BUDGET renders run at once, up to
+# QUEUE_SIZE more wait (first come, first served) for at most WAIT_TIMEOUT seconds, and the
+# rest is rejected right away with an estimate of when a slot frees up. A render that is
+# admitted gets its share of the machine instead of every render slowing down together.
+# Background jobs wait without a limit in a separate line that only moves when no request
+# is waiting, so queued jobs never make requests fail.
+
+# renders running at the same time: a number, or "auto" to derive it from cores and memory
+RENDER_CONCURRENCY = os.environ.get("RENDER_CONCURRENCY", "auto")
+# cores one render (x264 + filters) is given in "auto" mode
+RENDER_CORES_PER_JOB = float(os.environ.get("RENDER_CORES_PER_JOB", "2"))
+# memory (MB) one render may use (decoded frames, x264 lookahead, overlays) in "auto" mode
+RENDER_MEMORY_MB = int(os.environ.get("RENDER_MEMORY_MB", "512"))
+# renders allowed to wait for a slot: a number, or "auto" for as many as the budget
+ADMISSION_QUEUE_SIZE = os.environ.get("ADMISSION_QUEUE_SIZE", "auto")
+# seconds a render waits for a slot before it is rejected
+ADMISSION_WAIT_TIMEOUT = float(os.environ.get("ADMISSION_WAIT_TIMEOUT", "10"))
+
+# Retry-After bounds (seconds) and the guess used before any render has finished
+RETRY_AFTER_MIN = 1
+RETRY_AFTER_MAX = 600
+RETRY_AFTER_DEFAULT = 30
+# weight of the latest render in the moving average of the time a slot is held
+HOLD_TIME_WEIGHT = 0.2
+
+
+class Overloaded(Exception):
+    """No slot is free and the wait queue is full (or the wait timed out)."""
+
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        super().__init__(f"Server sedang penuh, coba lagi dalam {retry_after} detik")
+
+
+def _cgroup_read(path):
+    try:
+        with open(path) as fh:
+            return fh.read().split()
+    except OSError:
+        return None
+
+
+def available_cores():
+    """Cores this process may use: CPU affinity, limited by a cgroup (container) CPU quota."""
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    quota = _cgroup_read("/sys/fs/cgroup/cpu.max")
+    if quota and quota[0] != "max":
+        cores = min(cores, max(1, math.ceil(int(quota[0]) / int(quota[1]))))
+    return cores
+
+
+def available_memory():
+    """Bytes of memory for this process: physical memory, limited by a cgroup limit (None if unknown)."""
+    try:
+        total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        total = None
+    limit = _cgroup_read("/sys/fs/cgroup/memory.max")
+    if limit and limit[0] != "max":
+        total = min(total or int(limit[0]), int(limit[0]))
+    return total
+
+
+def render_budget():
+    """Renders that may run at once: RENDER_CONCURRENCY, or in "auto" mode what the cores and memory allow."""
+    if RENDER_CONCURRENCY != "auto":
+        return max(1, int(RENDER_CONCURRENCY))
+    budget = max(1, int(available_cores() // RENDER_CORES_PER_JOB))
+    memory = available_memory()
+    if memory:
+        budget = min(budget, max(1, memory // (RENDER_MEMORY_MB * 1024 * 1024)))
+    return budget
+
+
+class Admission:
+    """Concurrency budget with a bounded first-come-first-served wait queue for requests
+    and an unbounded, lower-priority one for background jobs."""
+
+    def __init__(self, budget, queue_size, wait_timeout):
+        self.budget = budget
+        self.queue_size = queue_size
+        self.wait_timeout = wait_timeout
+        self.running = 0
+        self._waiters = deque()
+        self._background = deque()
+        self._cond = threading.Condition()
+        # moving average of the seconds a slot is held (None until a render finished)
+        self._hold_time = None
+
+    @property
+    def waiting(self):
+        return len(self._waiters) + len(self._background)
+
+    def retry_after(self):
+        """Seconds until a slot is likely free for a new request, at the current throughput."""
+        with self._cond:
+            return self._retry_after_locked(len(self._waiters) + 1)
+
+    def _retry_after_locked(self, ahead):
+        # throughput is the budget divided by the average time a render holds its slot;
+        # the renders ahead (waiting requests plus the new one) drain at that rate
+        if self._hold_time is None:
+            return RETRY_AFTER_DEFAULT
+        return max(RETRY_AFTER_MIN, min(RETRY_AFTER_MAX, math.ceil(ahead * self._hold_time / self.budget)))
+
+    def acquire(self, timeout=-1):
+        """Take a slot, waiting in line up to timeout seconds (default wait_timeout, None: no limit).
+
+        A timed wait (a request) is refused (Overloaded) when queue_size requests already
+        wait. An untimed one (a background job) always lines up, behind every request.
+        """
+        timeout = self.wait_timeout if timeout == -1 else timeout
+        line = self._background if timeout is None else self._waiters
+        with self._cond:
+            if self.running < self.budget and not self._waiters and not line:
+                self.running += 1
+                metrics.admissions.inc(result="admitted")
+                return
+            if timeout is not None and (len(self._waiters) >= self.queue_size or timeout <= 0):
+                metrics.admissions.inc(result="rejected")
+                raise Overloaded(self._retry_after_locked(len(self._waiters) + 1))
+            ticket = object()
+            line.append(ticket)
+            t0 = time.monotonic()
+            admitted = self._cond.wait_for(
+                lambda: line[0] is ticket and self.running < self.budget and (line is self._waiters or not self._waiters),
+                timeout=timeout,
+            )
+            if not admitted:
+                line.remove(ticket)
+                # the next one in line may be able to go now
+                self._cond.notify_all()
+                metrics.admissions.inc(result="timeout")
+                raise Overloaded(self._retry_after_locked(len(self._waiters) + 1))
+            line.popleft()
+            self.running += 1
+            self._cond.notify_all()
+        metrics.admissions.inc(result="waited")
+        metrics.observe_stage("admission_wait", time.monotonic() - t0)
+
+    def release(self, held=None):
+        """Give the slot back; held: seconds it was held, for the throughput estimate."""
+        with self._cond:
+            self.running -= 1
+            if held is not None:
+                if self._hold_time is None:
+                    self._hold_time = held
+                else:
+                    self._hold_time += HOLD_TIME_WEIGHT * (held - self._hold_time)
+            self._cond.notify_all()
+
+    def slot(self, timeout=-1):
+        """acquire() and return a function that releases the slot (once)."""
+        self.acquire(timeout)
+        t0 = time.monotonic()
+        released = threading.Event()
+
+        def release():
+            if not released.is_set():
+                released.set()
+                self.release(time.monotonic() - t0)
+
+        return release
+
+    @contextmanager
+    def admitted(self, timeout=-1):
+        release = self.slot(timeout)
+        try:
+            yield
+        finally:
+            release()
+
+
+def _queue_size(budget):
+    return budget if ADMISSION_QUEUE_SIZE == "auto" else max(0, int(ADMISSION_QUEUE_SIZE))
+
+
+_budget = render_budget()
+renders = Admission(_budget, _queue_size(_budget), ADMISSION_WAIT_TIMEOUT)
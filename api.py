@@ -1,25 +1,53 @@
+import asyncio
+import json
 import os
+import re
 import shutil
 import tempfile
+import threading
+import time
+import uuid
+import weakref
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Optional
 
+import anyio
 import httpx
-import subprocess
 import traceback
 from fastapi import FastAPI, HTTPException, BackgroundTasks, Request
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
 
 from video_utils import (
     make_header_image,
     make_comments_image,
     make_comments_image_html,
+    close_html_renderer,
     compose_video_ffmpeg,
+    compose_video_stream,
+    compose_video_variants,
+    choose_encode_profile,
+    ENCODE_PROFILE,
+    ENCODE_PROFILES,
+    font_versions,
     ensure_ffmpeg_exists,
+    probe_media,
+    probe_media_bytes,
+    resolve_fonts,
 )
 
 from PIL import Image
 
+import admission
+import cancellation
+import jobs
+import metrics
+import progress
+import render_queue
+import results
+from cache_utils import DiskLRUCache, file_digest, file_fingerprint, make_key
+
 
 APP_DIR = os.path.dirname(__file__)
 BACKGROUND_DIR = os.path.join(APP_DIR, "backgrounds")
@@ -47,11 +75,67 @@ class RenderRequest(BaseModel):
     use_html_renderer: Optional[bool] = False
     scale: Optional[float] = 1.0
     max_duration: Optional[float] = None
+    # pipe the content into ffmpeg while it is still downloading (MP4 with moov first, WebM/MKV)
+    stream_ingest: Optional[bool] = False
+    # /render only: send fragmented MP4 while ffmpeg is still encoding (no Content-Length)
+    stream_output: Optional[bool] = False
+    # draft | standard | quality | auto (default: ENCODE_PROFILE)
+    encode_profile: Optional[str] = None
+    # client-chosen id to follow the render live on GET /progress/{progress_id}
+    progress_id: Optional[str] = None
+    # seconds the caller is willing to wait; the render is stopped after this (max RENDER_DEADLINE)
+    timeout: Optional[float] = None
+
+
+class RenderJobRequest(RenderRequest):
+    # optional URL that receives a POST with the job status once the render finishes
+    callback_url: Optional[str] = None
+
+
+class RenderVariant(BaseModel):
+    header_text: Optional[str] = ""
+    comments: Optional[List[Comment]] = []
+
+
+class BatchRenderRequest(BaseModel):
+    content_url: str
+    background_option: Optional[int] = 1
+    use_html_renderer: Optional[bool] = False
+    scale: Optional[float] = 1.0
+    max_duration: Optional[float] = None
+    encode_profile: Optional[str] = None
+    progress_id: Optional[str] = None
+    timeout: Optional[float] = None
+    variants: List[RenderVariant]
+
+
+# "local": /jobs run on this process' render pool (jobs.py); "queue": /jobs are stored in the
+# durable render queue (render_queue.py) and run by separate worker.py processes
+JOB_BACKEND = os.environ.get("JOB_BACKEND", "local")
+
+# variants per /render/batch request (all of them are encoded by one ffmpeg process)
+MAX_BATCH_VARIANTS = int(os.environ.get("MAX_BATCH_VARIANTS", "20"))
+
+PROGRESS_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+# an SSE progress stream for an id that no render has used yet ends after this many seconds
+PROGRESS_WAIT_START = 60
+# comment line sent on an idle SSE stream so proxies keep it open
+PROGRESS_KEEPALIVE = 15
+
+# every render is stopped after this many seconds (0: no limit); requests may ask for less
+RENDER_DEADLINE = float(os.environ.get("RENDER_DEADLINE", "1800"))
+# how often a running /render checks whether its client is still connected, in seconds
+DISCONNECT_POLL_INTERVAL = 1.0
 
 
 app = FastAPI(title="Shorts Composer API")
 
 
+@app.exception_handler(cancellation.Cancelled)
+def render_cancelled(request: Request, exc: cancellation.Cancelled):
+    return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail})
+
+
 def ensure_background_templates():
     """Create 3 simple background image templates if not present."""
     os.makedirs(BACKGROUND_DIR, exist_ok=True)
@@ -62,78 +146,459 @@ def ensure_background_templates():
             img.save(p)
 
 
-def download_file(url: str, dst_path: str, max_bytes: int = 150 * 1024 * 1024, timeout: int = 60):
-    """Download from URL into dst_path with simple size limit and timeout."""
+# All downloads share one long-lived connection pool so keep-alive connections to the
+# same CDN hosts are reused across requests; downloads of one request run in parallel.
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", "8"))
+_http_client = None
+_http_client_lock = threading.Lock()
+_download_pool = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix="download")
+
+
+def get_http_client():
+    global _http_client
+    with _http_client_lock:
+        if _http_client is None:
+            _http_client = httpx.Client(
+                follow_redirects=True,
+                limits=httpx.Limits(max_connections=64, max_keepalive_connections=16, keepalive_expiry=60),
+            )
+        return _http_client
+
+
+def close_http_client():
+    global _http_client
+    with _http_client_lock:
+        if _http_client is not None:
+            _http_client.close()
+            _http_client = None
+
+
+MAX_CONTENT_BYTES = 150 * 1024 * 1024
+
+
+def download_file(url: str, dst_path: str, max_bytes: int = MAX_CONTENT_BYTES, timeout: int = 60, on_chunk=None, cancel=None):
+    """Download from URL into dst_path with simple size limit and timeout.
+
+    on_chunk(n): optional callback after each chunk is written and flushed to disk.
+    cancel: optional CancelToken; cancelling it closes the connection and raises Cancelled.
+    """
+    unregister = lambda: None
     try:
-        with httpx.Client(timeout=timeout, follow_redirects=True) as client:
-            with client.stream("GET", url) as r:
-                r.raise_for_status()
-                total = 0
-                with open(dst_path, "wb") as fh:
-                    for chunk in r.iter_bytes(chunk_size=8192):
-                        if not chunk:
-                            continue
-                        fh.write(chunk)
-                        total += len(chunk)
-                        if total > max_bytes:
-                            raise HTTPException(status_code=413, detail="File terlalu besar")
+        client = get_http_client()
+        with client.stream("GET", url, timeout=timeout) as r:
+            if cancel is not None:
+                unregister = cancel.on_cancel(r.close)
+            r.raise_for_status()
+            total = 0
+            with open(dst_path, "wb") as fh:
+                for chunk in r.iter_bytes(chunk_size=64 * 1024):
+                    if not chunk:
+                        continue
+                    fh.write(chunk)
+                    total += len(chunk)
+                    metrics.bytes_in.inc(len(chunk), source="content")
+                    if total > max_bytes:
+                        raise HTTPException(status_code=413, detail="File terlalu besar")
+                    if on_chunk is not None:
+                        fh.flush()
+                        on_chunk(len(chunk))
     except httpx.HTTPStatusError as e:
         raise HTTPException(status_code=502, detail=f"Gagal mendownload file: {e}")
     except httpx.RequestError as e:
+        if cancel is not None:
+            cancel.check()
         raise HTTPException(status_code=502, detail=f"Gagal menghubungi URL: {e}")
+    except Exception:
+        # reading from a response closed by the cancel callback fails in various ways
+        if cancel is not None:
+            cancel.check()
+        raise
+    finally:
+        unregister()
+    if cancel is not None:
+        cancel.check()
+
+
+# Preflight: before the full download, content_url is checked with a HEAD request and a
+# range request for its first PREFLIGHT_BYTES, which are probed with ffprobe.
+CONTENT_PREFLIGHT = os.environ.get("CONTENT_PREFLIGHT", "1") != "0"
+PREFLIGHT_BYTES = 512 * 1024
+# limits checked on the probe, and again after the full download when the head could not be
+# probed (duration only when the request sets no max_duration; 0 = no duration limit)
+MAX_CONTENT_DURATION = float(os.environ.get("MAX_CONTENT_DURATION", "0"))
+MAX_CONTENT_SIDE = int(os.environ.get("MAX_CONTENT_SIDE", "4096"))
+NO_VIDEO_DETAIL = "content_url tidak berisi stream video yang valid (tidak ada video stream). Periksa URL atau upload file secara langsung."
+
+
+def _check_content_headers(headers):
+    """Reject by response headers; returns the total size if the headers tell it."""
+    content_type = headers.get("content-type", "").lower()
+    if content_type.startswith("text/html"):
+        raise HTTPException(status_code=400, detail="content_url mengarah ke halaman HTML, bukan file video")
+    if content_type.startswith("audio/"):
+        raise HTTPException(status_code=400, detail=NO_VIDEO_DETAIL)
+    # "bytes 0-524287/18858904" on a 206, otherwise Content-Length
+    content_range = headers.get("content-range", "")
+    total = content_range.rsplit("/", 1)[-1] if "/" in content_range else headers.get("content-length")
+    try:
+        total = int(total)
+    except (TypeError, ValueError):
+        return None
+    if total > MAX_CONTENT_BYTES:
+        raise HTTPException(status_code=413, detail="File terlalu besar")
+    return total
+
+
+def preflight_content(url: str, max_duration: Optional[float] = None, timeout: int = 15):
+    """Check content_url before downloading it completely.
+
+    Raises HTTPException for HTML pages, audio-only files, files over MAX_CONTENT_BYTES and
+    videos over the resolution/duration limits. Returns the probe of the first bytes, or None
+    when they cannot be probed on their own (e.g. an MP4 with its moov atom at the end); the
+    full file is checked after the download in that case.
+    """
+    client = get_http_client()
+    try:
+        r = client.head(url, timeout=timeout)
+        # HEAD is not allowed everywhere; the range request below decides then
+        if r.status_code < 400:
+            _check_content_headers(r.headers)
+    except httpx.RequestError:
+        pass
+
+    head = b""
+    try:
+        with client.stream("GET", url, headers={"Range": f"bytes=0-{PREFLIGHT_BYTES - 1}"}, timeout=timeout) as r:
+            r.raise_for_status()
+            _check_content_headers(r.headers)
+            # servers ignoring Range answer 200 with the whole file: stop after the head
+            for chunk in r.iter_bytes(chunk_size=64 * 1024):
+                head += chunk
+                if len(head) >= PREFLIGHT_BYTES:
+                    break
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(status_code=502, detail=f"Gagal mendownload file: {e}")
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=502, detail=f"Gagal menghubungi URL: {e}")
+
+    if head.lstrip()[:1] == b"<":
+        raise HTTPException(status_code=400, detail="content_url mengarah ke halaman HTML, bukan file video")
+    info = probe_media_bytes(head[:PREFLIGHT_BYTES])
+    if info is None:
+        return None
+    if not info["has_video"]:
+        raise HTTPException(status_code=400, detail=NO_VIDEO_DETAIL)
+    check_content_limits(info, max_duration)
+    return info
+
+
+def check_content_limits(info: dict, max_duration: Optional[float] = None):
+    """Reject (HTTP 400) content over MAX_CONTENT_SIDE or, without max_duration, MAX_CONTENT_DURATION."""
+    video = info["video"]
+    if max(video["width"] or 0, video["height"] or 0) > MAX_CONTENT_SIDE:
+        raise HTTPException(status_code=400, detail=f"Resolusi video terlalu besar (maksimal {MAX_CONTENT_SIDE} px per sisi)")
+    if MAX_CONTENT_DURATION and not max_duration and info["duration"] and info["duration"] > MAX_CONTENT_DURATION:
+        raise HTTPException(status_code=400, detail=f"Durasi video terlalu panjang (maksimal {MAX_CONTENT_DURATION:g} detik, atau isi max_duration)")
+
+
+def check_downloaded_content(path: str, max_duration: Optional[float] = None):
+    """Validate a fully downloaded content file: a video stream and the preflight limits.
+
+    The preflight cannot probe every file from its head (e.g. MP4 with the moov atom at
+    the end), so the limits are applied here as well.
+    """
+    # avoid ffmpeg running on audio-only or HTML
+    if not has_video_stream(path):
+        raise HTTPException(status_code=400, detail=NO_VIDEO_DETAIL)
+    if shutil.which("ffprobe") is not None:
+        check_content_limits(probe_media(path), max_duration)
+
+
+def download_content(url: str, dst_path: str, max_duration: Optional[float] = None, on_chunk=None, cancel=None):
+    """Preflight content_url (see preflight_content) and then download it into dst_path."""
+    with metrics.span("download"):
+        if CONTENT_PREFLIGHT:
+            preflight_content(url, max_duration=max_duration)
+        download_file(url, dst_path, on_chunk=on_chunk, cancel=cancel)
+
+
+# Downloaded avatars are kept in a shared disk cache keyed by URL, with the ETag /
+# Last-Modified validators stored next to them. Entries checked less than
+# AVATAR_FRESH_SECONDS ago are used without any network request.
+AVATAR_CACHE_MAX_BYTES = int(os.environ.get("AVATAR_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+AVATAR_FRESH_SECONDS = int(os.environ.get("AVATAR_FRESH_SECONDS", "900"))
+_avatar_cache = None
+_avatar_meta = {}
+_avatar_meta_lock = threading.Lock()
+
+
+def get_avatar_cache():
+    global _avatar_cache
+    if _avatar_cache is None:
+        _avatar_cache = DiskLRUCache("avatars", AVATAR_CACHE_MAX_BYTES)
+    return _avatar_cache
+
+
+def _load_avatar_meta(cache, key):
+    with _avatar_meta_lock:
+        meta = _avatar_meta.get(key)
+    if meta is not None:
+        return meta
+    p = cache.get(key, ".json")
+    if p is None:
+        return None
+    try:
+        with open(p, "r", encoding="utf-8") as fh:
+            meta = json.load(fh)
+    except (OSError, ValueError):
+        return None
+    with _avatar_meta_lock:
+        _avatar_meta[key] = meta
+    return meta
+
+
+def _store_avatar_meta(cache, key, meta):
+    with _avatar_meta_lock:
+        _avatar_meta[key] = meta
+    tmp = cache.tmp_path(".json")
+    try:
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump(meta, fh)
+        cache.put(key, tmp, ".json")
+    except OSError:
+        cleanup_path(tmp)
+
+
+def fetch_avatar_cached(url: str, max_bytes: int = 5 * 1024 * 1024, timeout: int = 30):
+    """Return a local path to the avatar image at url (or None), using the avatar cache.
 
+    Fresh entries cost no network request; stale ones are revalidated with
+    If-None-Match / If-Modified-Since, and a 304 reuses the cached file. If the
+    revalidation fails the stale copy is used.
+    """
+    cache = get_avatar_cache()
+    key = make_key("avatar", url)
+    cached = cache.get(key, ".img")
+    meta = _load_avatar_meta(cache, key) if cached else None
+    if cached and meta and time.time() - meta.get("checked_at", 0) < AVATAR_FRESH_SECONDS:
+        metrics.cache_lookup("avatar", True)
+        return cached
 
-def download_avatar(url: str, dst_path: str, max_bytes: int = 5 * 1024 * 1024, timeout: int = 30):
-    """Download avatar image from URL. Smaller size limit than video files."""
+    headers = {}
+    if cached and meta:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    tmp = cache.tmp_path(".img")
     try:
-        with httpx.Client(timeout=timeout, follow_redirects=True) as client:
-            with client.stream("GET", url) as r:
-                r.raise_for_status()
-                # Check content type
-                content_type = r.headers.get("content-type", "").lower()
-                if not any(ct in content_type for ct in ["image/jpeg", "image/jpg", "image/png", "image/webp"]):
-                    print(f"Warning: Avatar URL mungkin bukan gambar: {content_type}")
-                total = 0
-                with open(dst_path, "wb") as fh:
-                    for chunk in r.iter_bytes(chunk_size=8192):
-                        if not chunk:
-                            continue
-                        fh.write(chunk)
-                        total += len(chunk)
-                        if total > max_bytes:
-                            raise HTTPException(status_code=413, detail="Avatar terlalu besar")
-                return True
+        client = get_http_client()
+        with client.stream("GET", url, headers=headers, timeout=timeout) as r:
+            if r.status_code == 304 and cached:
+                metrics.cache_lookup("avatar", True)
+                _store_avatar_meta(cache, key, dict(meta, checked_at=time.time()))
+                return cached
+            metrics.cache_lookup("avatar", False)
+            r.raise_for_status()
+            # Check content type
+            content_type = r.headers.get("content-type", "").lower()
+            if not any(ct in content_type for ct in ["image/jpeg", "image/jpg", "image/png", "image/webp"]):
+                print(f"Warning: Avatar URL mungkin bukan gambar: {content_type}")
+            total = 0
+            with open(tmp, "wb") as fh:
+                for chunk in r.iter_bytes(chunk_size=8192):
+                    if not chunk:
+                        continue
+                    fh.write(chunk)
+                    total += len(chunk)
+                    metrics.bytes_in.inc(len(chunk), source="avatar")
+                    if total > max_bytes:
+                        raise HTTPException(status_code=413, detail="Avatar terlalu besar")
+            new_meta = {
+                "etag": r.headers.get("etag"),
+                "last_modified": r.headers.get("last-modified"),
+                "checked_at": time.time(),
+            }
+    except HTTPException as e:
+        print(f"Warning: Gagal download avatar: {e.detail}")
+        cleanup_path(tmp)
+        return None
     except httpx.HTTPStatusError as e:
         print(f"Warning: Gagal download avatar: {e}")
-        return False
+        cleanup_path(tmp)
+        return cached
     except httpx.RequestError as e:
         print(f"Warning: Gagal menghubungi avatar URL: {e}")
-        return False
+        cleanup_path(tmp)
+        return cached
+
+    path = cache.put(key, tmp, ".img")
+    _store_avatar_meta(cache, key, new_meta)
+    return path
+
+
+# Streamed ingest: the content is probed from its first bytes (trying each of these sizes)
+# and, for containers that can be demuxed sequentially, piped into ffmpeg while downloading.
+INGEST_HEAD_SIZES = (512 * 1024, 2 * 1024 * 1024, 8 * 1024 * 1024)
+STREAMABLE_FORMATS = ("mov", "mp4", "matroska", "webm")
+
+
+class _IngestCancelled(Exception):
+    pass
+
+
+class StreamingDownload:
+    """Content download into a growing file that can be read while it is being written."""
+
+    def __init__(self, url: str, dst_path: str, max_duration: Optional[float] = None, cancel=None):
+        self.url = url
+        self.dst_path = dst_path
+        self.max_duration = max_duration
+        self.cancel_token = cancel
+        self.written = 0
+        self.done = False
+        self.cancelled = False
+        self.error = None
+        self.cond = threading.Condition()
+
+    def run(self):
+        try:
+            download_content(self.url, self.dst_path, max_duration=self.max_duration, on_chunk=self._on_chunk, cancel=self.cancel_token)
+        except _IngestCancelled:
+            pass
+        except Exception as e:
+            self.error = e
+            raise
+        finally:
+            with self.cond:
+                self.done = True
+                self.cond.notify_all()
+
+    def _on_chunk(self, n):
+        with self.cond:
+            if self.cancelled:
+                raise _IngestCancelled()
+            self.written += n
+            self.cond.notify_all()
+
+    def cancel(self):
+        with self.cond:
+            self.cancelled = True
+            self.cond.notify_all()
+
+    def _wait_for(self, nbytes):
+        with self.cond:
+            self.cond.wait_for(lambda: self.done or self.written >= nbytes)
+            return not self.done
+
+    def probe_head(self):
+        """Probe the first bytes of the download.
+
+        Returns the probe description if the content can be streamed into ffmpeg, or None
+        when the caller should wait for the whole file (download finished already, failed,
+        or the container needs seeking, e.g. an MP4 with its moov atom at the end).
+        """
+        for size in INGEST_HEAD_SIZES:
+            if not self._wait_for(size):
+                return None
+            with open(self.dst_path, "rb") as fh:
+                head = fh.read(size)
+            info = probe_media_bytes(head)
+            if info is None:
+                continue
+            fmt = info.get("format") or ""
+            if info["has_video"] and info["duration"] and any(f in fmt.split(",") for f in STREAMABLE_FORMATS):
+                return info
+            return None
+        return None
+
+    def chunks(self, chunk_size=64 * 1024):
+        """Iterate over the content from the first byte, waiting for data still being downloaded."""
+        with open(self.dst_path, "rb") as fh:
+            while True:
+                data = fh.read(chunk_size)
+                if data:
+                    yield data
+                    continue
+                with self.cond:
+                    finished = self.done or self.cancelled
+                    if not finished:
+                        self.cond.wait(timeout=1.0)
+                if finished:
+                    rest = fh.read()
+                    if rest:
+                        yield rest
+                    return
+
+
+def start_downloads(content_url: str, comments_list: list, tmpdir: str, ingest: Optional[StreamingDownload] = None, max_duration: Optional[float] = None, cancel=None):
+    """Start the content download and all avatar downloads in parallel on the shared pool.
+
+    Returns (content_path, content_future, avatar_futures) where avatar_futures maps the
+    comment index to a future resolving to the avatar path (or None on failure).
+    ingest: optional StreamingDownload used for the content instead of a plain download.
+    cancel: optional CancelToken stopping the content download (avatars go to the shared
+    cache and are left to finish).
+    """
+    if ingest is not None:
+        content_path = ingest.dst_path
+        content_future = _download_pool.submit(ingest.run)
+    else:
+        content_path = os.path.join(tmpdir, "content.mp4")
+        content_future = _download_pool.submit(download_content, content_url, content_path, max_duration, None, cancel)
+
+    avatar_futures = {}
+    for idx, comment in enumerate(comments_list):
+        if comment.get("avatar_url"):
+            # avatars are used straight from the avatar cache, no copy into tmpdir
+            avatar_futures[idx] = _download_pool.submit(fetch_avatar_cached, comment["avatar_url"])
+    return content_path, content_future, avatar_futures
+
+
+def collect_avatars(comments_list: list, avatar_futures: dict):
+    """Wait for the avatar downloads and set comment["avatar_path"] (None on failure)."""
+    for idx, comment in enumerate(comments_list):
+        fut = avatar_futures.get(idx)
+        try:
+            comment["avatar_path"] = fut.result() if fut else None
+        except Exception as e:
+            print(f"Warning: Gagal download avatar: {e}")
+            comment["avatar_path"] = None
+
+
+def render_comments(comments_list: list, out_path: str, use_html_renderer: bool, scale: float, tmpdir: str, cancel=None):
+    """Render the comments overlay PNG and return its size."""
+    # Lebar template komentar maksimal 90% dari lebar layar (TARGET_W)
+    comment_width = int(TARGET_W * 0.90)
+    with metrics.span("overlay_comments"):
+        # prefer HTML renderer if requested and available
+        if use_html_renderer:
+            try:
+                return make_comments_image_html(comments_list, out_path, width=comment_width, scale=scale, cancel=cancel)
+            except cancellation.Cancelled:
+                raise
+            except Exception:
+                # fallback to PIL renderer
+                pass
+        return make_comments_image(comments_list, out_path, width=comment_width, scale=scale, tmpdir=tmpdir)
+
+
+def render_header(text: str, out_path: str):
+    """Render the header overlay PNG and return its size."""
+    with metrics.span("overlay_header"):
+        return make_header_image(text or "", out_path, width=TARGET_W, height=160)
 
 
 def has_video_stream(path: str):
-    """Return True if the file contains at least one video stream (uses ffprobe)."""
-    ffprobe = shutil.which("ffprobe")
-    if ffprobe is None:
+    """Return True if the file contains at least one video stream (uses the shared ffprobe probe)."""
+    if shutil.which("ffprobe") is None:
         # If ffprobe is not available, conservatively assume it's ok
         return True
-    cmd = [
-        ffprobe,
-        "-v",
-        "error",
-        "-select_streams",
-        "v",
-        "-show_entries",
-        "stream=codec_type",
-        "-of",
-        "default=noprint_wrappers=1:nokey=1",
-        path,
-    ]
-    p = subprocess.run(cmd, capture_output=True, text=True)
-    if p.returncode != 0:
+    try:
+        return probe_media(path)["has_video"]
+    except RuntimeError:
         return False
-    out = p.stdout.strip()
-    return bool(out)
 
 
 def cleanup_path(path: str):
@@ -151,13 +616,16 @@ def startup():
     # check ffmpeg availability and prepare backgrounds
     ensure_ffmpeg_exists()
     ensure_background_templates()
+    resolve_fonts()
 
 
-@app.post("/render")
-def render(request: Request, req: RenderRequest, background_tasks: BackgroundTasks):
-    # validate
-    if not req.content_url:
-        raise HTTPException(status_code=400, detail="content_url diperlukan")
+@app.on_event("shutdown")
+def shutdown():
+    close_http_client()
+    close_html_renderer()
+
+
+def verify_api_key(request: Request):
     # simple one-layer API key protection (hardcoded per user request).
     # NOTE: hardcoding secrets in source is insecure for production. Remove or
     # switch to environment variables before sharing the repo.
@@ -174,123 +642,754 @@ def render(request: Request, req: RenderRequest, background_tasks: BackgroundTas
                 valid = True
         if not valid:
             raise HTTPException(status_code=401, detail="Unauthorized: invalid or missing API key")
+
+
+def validate_render_request(req):
+    if not req.content_url:
+        raise HTTPException(status_code=400, detail="content_url diperlukan")
     if req.background_option not in (1, 2, 3):
         raise HTTPException(status_code=400, detail="background_option harus 1,2 atau 3")
+    if req.encode_profile and req.encode_profile not in ENCODE_PROFILES and req.encode_profile != "auto":
+        raise HTTPException(status_code=400, detail="encode_profile harus draft, standard, quality atau auto")
+    if req.progress_id and not PROGRESS_ID_RE.match(req.progress_id):
+        raise HTTPException(status_code=400, detail="progress_id hanya boleh berisi huruf, angka, - dan _ (maksimal 64 karakter)")
+
+
+def find_background(option: int):
+    """Pick background asset bgN.*: try multiple extensions so users can drop a video (mp4/webm/mov) or image."""
+    bg_path = None
+    base_name = f"bg{int(option)}"
+    # prefer images first then videos, but allow either
+    allowed_exts = [
+        ".png",
+        ".jpg",
+        ".jpeg",
+        ".mp4",
+        ".webm",
+        ".mov",
+        ".mkv",
+    ]
+    for ext in allowed_exts:
+        p = os.path.join(BACKGROUND_DIR, base_name + ext)
+        if os.path.exists(p):
+            bg_path = p
+            break
+    if bg_path is None:
+        # fallback: try to find any file that starts with the base_name (bg1.*)
+        for fname in os.listdir(BACKGROUND_DIR):
+            if fname.startswith(base_name + "."):
+                bg_path = os.path.join(BACKGROUND_DIR, fname)
+                break
+    if bg_path is None:
+        raise HTTPException(status_code=500, detail=f"Background template untuk opsi {option} tidak ditemukan. Silakan letakkan file bernama {base_name}.(png|jpg|mp4) di folder backgrounds.")
+    return bg_path
 
-    tmpdir = tempfile.mkdtemp(prefix="shorts_")
-    background_tasks.add_task(cleanup_path, tmpdir)
 
+def _render_failed(tmpdir: str):
+    """Log the current exception to render_error.log in tmpdir and return the HTTP 502 to raise."""
+    # capture traceback into a file inside tmpdir for inspection
+    tb_text = traceback.format_exc()
+    try:
+        log_path = os.path.join(tmpdir, "render_error.log")
+        with open(log_path, "w", encoding="utf-8") as lf:
+            lf.write(tb_text)
+    except Exception:
+        pass
+    # also print to server stdout (uvicorn console)
+    print("Error during render:\n", tb_text)
+    # HTTP 502 to indicate upstream processing failure with a short message
+    return HTTPException(status_code=502, detail="Processing failed on server. Check server logs or render_error.log in temporary folder.")
+
+
+def _finish_ingest(ingest: StreamingDownload, content_future):
+    """Stop a streamed download once ffmpeg is done with it; True if it had already completed.
+
+    ffmpeg may have stopped reading early (max_duration): the download is stopped, but this
+    fails if it broke off before that, since the output would be truncated.
+    """
+    with ingest.cond:
+        # read before cancel(): once cancelled, done may also mean a download cut short
+        complete = ingest.done and ingest.error is None
+    if ingest.error is None:
+        ingest.cancel()
+    content_future.result()
+    return complete
+
+
+def _stop_ingest(ingest: Optional[StreamingDownload]):
+    if ingest is not None and not ingest.done:
+        # render failed while streaming: stop the download before tmpdir is removed
+        ingest.cancel()
+        with ingest.cond:
+            ingest.cond.wait_for(lambda: ingest.done, timeout=30)
+
+
+# renders currently encoding; sizes the encoder profile in "auto" mode
+_active_encodes = 0
+_active_encodes_lock = threading.Lock()
+
+
+def _encode_started(profile_name: Optional[str]):
+    """Count an encode as running and return its encoder settings for the current load."""
+    global _active_encodes
+    with _active_encodes_lock:
+        _active_encodes += 1
+        running = _active_encodes
+    _, queued = job_backend().queue_depth()
+    queued += admission.renders.waiting
+    return choose_encode_profile(profile_name, running=running, queued=queued, slow=progress.slow_count())
+
+
+def _degraded_encode(profile_name: Optional[str], encode: dict):
+    """True if "auto" picked a lower quality than it would on an idle server.
+
+    Such an output is not stored in the result cache, which keys on the literal "auto":
+    later requests, under any load, would otherwise get the draft encode.
+    """
+    return (profile_name or ENCODE_PROFILE) == "auto" and encode["name"] != choose_encode_profile("auto")["name"]
+
+
+def _encode_finished():
+    global _active_encodes
+    with _active_encodes_lock:
+        _active_encodes -= 1
+
+
+def _stream_rendered(first: bytes, chunks, ingest, content_future, tmpdir: str, progress_key: Optional[str] = None):
+    """Response body for stream_output: the already-read first chunk, then the rest as encoded."""
+    status = progress.FAILED
+    try:
+        if first:
+            yield first
+        yield from chunks
+        if ingest is not None:
+            _finish_ingest(ingest, content_future)
+        status = progress.DONE
+    except Exception:
+        # the status line is already sent; aborting the body tells the client it is incomplete
+        _render_failed(tmpdir)
+        raise
+    finally:
+        if progress_key:
+            progress.finish(progress_key, status)
+        chunks.close()
+        _encode_finished()
+        _stop_ingest(ingest)
+
+
+def _normalized_request(req: RenderRequest):
+    """JSON of the request fields that affect the output, with defaults filled in."""
+    data = req.dict(include={"background_option", "header_text", "comments", "use_html_renderer", "scale", "max_duration", "encode_profile"})
+    data["header_text"] = data["header_text"] or ""
+    data["comments"] = (data["comments"] or [])[:2]
+    data["use_html_renderer"] = bool(data["use_html_renderer"])
+    if not data["max_duration"] or data["max_duration"] <= 0:
+        data["max_duration"] = None
+    data["encode_profile"] = data["encode_profile"] or ENCODE_PROFILE
+    return json.dumps(data, sort_keys=True, ensure_ascii=False)
+
+
+def render_request_key(req: RenderRequest):
+    """Result cache key known before any download: request + content_url + background."""
+    bg_fp = file_fingerprint(find_background(req.background_option))
+    return make_key("render-request", req.content_url, _normalized_request(req), bg_fp, font_versions())
+
+
+def render_result_key(req: RenderRequest, content_path: str):
+    """Deterministic key of a render output: request + full content hash + background fingerprint."""
+    bg_fp = file_fingerprint(find_background(req.background_option))
+    # the whole content is hashed: a cached output is sent to clients, so content that only
+    # shares size, head and tail with another one must not match it
+    return make_key("render", _normalized_request(req), file_digest(content_path), bg_fp, font_versions())
+
+
+def render_deduped(req: RenderRequest, tmpdir: str, progress_key: Optional[str] = None, cancel: Optional[cancellation.CancelToken] = None):
+    """render_to_file through the result cache, coalescing concurrent identical requests.
+
+    progress_key, cancel: see render_to_file (a request coalesced into another one reports
+    no progress until it is done, and renders itself if the other one is cancelled).
+    """
+    progress_key = progress_key or req.progress_id
+    if not results.enabled():
+        return render_to_file(req, tmpdir, progress_key=progress_key, cancel=cancel)
+    request_key = render_request_key(req)
+
+    def run():
+        cached = results.lookup_request(request_key)
+        metrics.cache_lookup("result_request", cached is not None)
+        return cached or render_to_file(req, tmpdir, request_key=request_key, progress_key=progress_key, cancel=cancel)
+
+    if progress_key:
+        progress.start(progress_key)
     try:
         try:
-            # download content
-            content_path = os.path.join(tmpdir, "content.mp4")
-            download_file(req.content_url, content_path)
-
-            # validate downloaded file contains a video stream (avoid ffmpeg running on audio-only or HTML)
-            if not has_video_stream(content_path):
-                raise HTTPException(status_code=400, detail="content_url tidak berisi stream video yang valid (tidak ada video stream). Periksa URL atau upload file secara langsung.")
-
-            # prepare header and comments images
-            header_path = os.path.join(tmpdir, "header.png")
-            make_header_image(req.header_text or "", header_path, width=TARGET_W, height=160)
-
-            # download avatars for comments if provided
-            comments_list = [c.dict() for c in (req.comments or [])][:2]
-            for idx, comment in enumerate(comments_list):
-                if comment.get("avatar_url"):
-                    avatar_path = os.path.join(tmpdir, f"avatar_{idx}.jpg")
-                    if download_avatar(comment["avatar_url"], avatar_path):
-                        comment["avatar_path"] = avatar_path
-                    else:
-                        comment["avatar_path"] = None
-                else:
-                    comment["avatar_path"] = None
-
-            comment_img_path = os.path.join(tmpdir, "comments.png")
-            # Lebar template komentar maksimal 90% dari lebar layar (TARGET_W)
-            comment_width = int(TARGET_W * 0.90)
-            # prefer HTML renderer if requested and available
-            if req.use_html_renderer:
-                try:
-                    make_comments_image_html(comments_list, comment_img_path, width=comment_width, scale=req.scale)
-                except Exception:
-                    # fallback to PIL renderer
-                    make_comments_image(comments_list, comment_img_path, width=comment_width, scale=req.scale, tmpdir=tmpdir)
-            else:
-                make_comments_image(comments_list, comment_img_path, width=comment_width, scale=req.scale, tmpdir=tmpdir)
-
-            # pick background asset: try multiple extensions so users can drop a video (mp4/webm/mov) or image
-            bg_path = None
-            base_name = f"bg{int(req.background_option)}"
-            # prefer images first then videos, but allow either
-            allowed_exts = [
-                ".png",
-                ".jpg",
-                ".jpeg",
-                ".mp4",
-                ".webm",
-                ".mov",
-                ".mkv",
-            ]
-            for ext in allowed_exts:
-                p = os.path.join(BACKGROUND_DIR, base_name + ext)
-                if os.path.exists(p):
-                    bg_path = p
-                    break
-            if bg_path is None:
-                # fallback: try to find any file that starts with the base_name (bg1.*)
-                for fname in os.listdir(BACKGROUND_DIR):
-                    if fname.startswith(base_name + "."):
-                        bg_path = os.path.join(BACKGROUND_DIR, fname)
-                        break
-            if bg_path is None:
-                raise HTTPException(status_code=500, detail=f"Background template untuk opsi {req.background_option} tidak ditemukan. Silakan letakkan file bernama {base_name}.(png|jpg|mp4) di folder backgrounds.")
-
-            out_path = os.path.join(tmpdir, "out.mp4")
-
-            # compose video (this may take time)
-            compose_video_ffmpeg(content_path, bg_path, header_path, comment_img_path, out_path, target_w=TARGET_W, target_h=TARGET_H, max_duration=req.max_duration)
-
-            if not os.path.exists(out_path):
-                raise HTTPException(status_code=500, detail="Gagal membuat video")
-
-            # return file and schedule cleanup
-            # Stream the file in chunks and set explicit headers so proxies/tunnels (e.g. n8n dev tunnels)
-            # correctly detect EOF. StreamingResponse here avoids some sendfile/os-level streaming
-            # mismatches that can cause client-side hangs in certain proxy setups.
+            out_path = results.single_flight(request_key, run, cancel)
+        except cancellation.Cancelled:
+            if cancel is not None and cancel.cancelled:
+                raise
+            # the request this one was coalesced into was cancelled, this one was not
+            out_path = results.single_flight(request_key, run, cancel)
+        if not results.is_cached(out_path):
+            # the shared render was not cacheable and its output lives in another request's
+            # tmpdir, which is removed after that response: render separately
+            if not out_path.startswith(os.path.join(tmpdir, "")):
+                out_path = render_to_file(req, tmpdir, progress_key=progress_key, cancel=cancel)
+    except Exception as e:
+        if progress_key:
+            progress.finish(progress_key, progress.FAILED, str(getattr(e, "detail", None) or e))
+        raise
+    if progress_key:
+        progress.finish(progress_key)
+    return out_path
+
+
+@metrics.track_render("render")
+def render_to_file(req: RenderRequest, tmpdir: str, stream_output: bool = False, request_key: Optional[str] = None, progress_key: Optional[str] = None,
+                   cancel: Optional[cancellation.CancelToken] = None):
+    """Run the whole render pipeline for req inside tmpdir and return the output path.
+
+    With stream_output, return an iterator over the fragmented MP4 instead, produced while
+    ffmpeg encodes; its first chunk is read here so startup failures still become HTTP errors.
+
+    request_key: see render_request_key; when given, the output is looked up in and stored
+    into the result cache by its render_result_key (returning the cached path).
+
+    progress_key: key the encode progress is published under (see progress.py); defaults
+    to req.progress_id.
+
+    cancel: CancelToken of the render; cancelling it stops the download, the HTML page wait
+    and ffmpeg, and cancellation.Cancelled is raised.
+
+    HTTPException is raised for problems with the request itself; any other exception
+    is logged to render_error.log in tmpdir and re-raised as HTTP 502.
+    """
+    ingest = None
+    handed_off = False
+    progress_key = progress_key or req.progress_id
+    if progress_key:
+        progress.start(progress_key)
+    try:
+        if cancel is not None:
+            cancel.check()
+        # download content and avatars concurrently
+        comments_list = [c.dict() for c in (req.comments or [])][:2]
+        ingest = StreamingDownload(req.content_url, os.path.join(tmpdir, "content.mp4"), req.max_duration, cancel) if req.stream_ingest else None
+        if ingest is not None and cancel is not None:
+            cancel.on_cancel(ingest.cancel)
+        content_path, content_future, avatar_futures = start_downloads(req.content_url, comments_list, tmpdir, ingest=ingest, max_duration=req.max_duration, cancel=cancel)
+
+        # prepare header image while the downloads are running
+        header_path = os.path.join(tmpdir, "header.png")
+        header_size = render_header(req.header_text, header_path)
+
+        # with streamed ingest, only wait for enough bytes to probe the content
+        content_info = None
+        try:
+            if ingest is not None:
+                content_info = ingest.probe_head()
+            if content_info is None:
+                content_future.result()
+        finally:
+            # wait for the avatars in any case so no download writes into a removed tmpdir
+            collect_avatars(comments_list, avatar_futures)
+        if cancel is not None:
+            cancel.check()
+
+        # a streamed download was checked on its preflight probe already
+        if content_info is None:
+            check_downloaded_content(content_path, req.max_duration)
+
+        # same request on the same content already rendered (e.g. under another URL)
+        render_key = None
+        if request_key and content_info is None:
+            render_key = render_result_key(req, content_path)
+            cached = results.lookup(render_key)
+            metrics.cache_lookup("result", cached is not None)
+            if cached:
+                results.store_alias(request_key, render_key)
+                return cached
+
+        comment_img_path = os.path.join(tmpdir, "comments.png")
+        comment_size = render_comments(comments_list, comment_img_path, req.use_html_renderer, req.scale, tmpdir, cancel)
+
+        bg_path = find_background(req.background_option)
+
+        compose_kwargs = dict(target_w=TARGET_W, target_h=TARGET_H, max_duration=req.max_duration, header_size=header_size, comment_size=comment_size,
+                              content_info=content_info, content_stream=ingest.chunks if content_info else None,
+                              on_progress=progress.reporter(progress_key), cancel=cancel)
+        streaming_ingest = ingest if content_info is not None else None
+
+        compose_kwargs["encode"] = _encode_started(req.encode_profile)
+        if _degraded_encode(req.encode_profile, compose_kwargs["encode"]):
+            request_key = render_key = None
+        if stream_output:
+            chunks = compose_video_stream(content_path, bg_path, header_path, comment_img_path, **compose_kwargs)
             try:
-                size = os.path.getsize(out_path)
+                first = next(chunks, b"")
             except Exception:
-                size = None
-
-            headers = {"Content-Disposition": f"attachment; filename=\"result.mp4\""}
-            if size is not None:
-                headers["Content-Length"] = str(size)
-            # suggest closing the connection when done
-            headers.setdefault("Connection", "close")
-
-            def file_iterator(path, chunk_size=32 * 1024):
-                with open(path, "rb") as fh:
-                    while True:
-                        chunk = fh.read(chunk_size)
-                        if not chunk:
-                            break
-                        yield chunk
-
-            return StreamingResponse(file_iterator(out_path), media_type="video/mp4", headers=headers)
-        except Exception as e:
-            # capture traceback into a file inside tmpdir for inspection
-            tb_text = traceback.format_exc()
+                chunks.close()
+                _encode_finished()
+                raise
+            handed_off = True
+            return _stream_rendered(first, chunks, streaming_ingest, content_future, tmpdir, progress_key)
+
+        out_path = os.path.join(tmpdir, "out.mp4")
+
+        # compose video (this may take time)
+        try:
+            compose_video_ffmpeg(content_path, bg_path, header_path, comment_img_path, out_path, **compose_kwargs)
+        finally:
+            _encode_finished()
+
+        if streaming_ingest is not None:
+            # only a complete download can be fingerprinted
+            if _finish_ingest(streaming_ingest, content_future) and request_key:
+                render_key = render_result_key(req, content_path)
+
+        if not os.path.exists(out_path):
+            raise HTTPException(status_code=500, detail="Gagal membuat video")
+        if render_key:
+            out_path = results.store(render_key, out_path, request_key)
+        if progress_key:
+            progress.finish(progress_key)
+        return out_path
+    except (HTTPException, cancellation.Cancelled) as e:
+        if progress_key:
+            progress.finish(progress_key, progress.FAILED, e.detail)
+        raise
+    except Exception:
+        if progress_key:
+            progress.finish(progress_key, progress.FAILED, "Render gagal")
+        raise _render_failed(tmpdir)
+    finally:
+        if not handed_off:
+            _stop_ingest(ingest)
+
+
+@metrics.track_render("batch")
+def render_batch_to_files(req: BatchRenderRequest, tmpdir: str, cancel: Optional[cancellation.CancelToken] = None):
+    """Render every variant of req with one download, one probe and one ffmpeg run.
+
+    Returns the output paths in variant order. Errors, progress (under req.progress_id) and
+    cancel are handled like in render_to_file.
+    """
+    if req.progress_id:
+        progress.start(req.progress_id)
+    try:
+        # one flat list of comments across variants so all avatars download in parallel
+        variant_comments = [[c.dict() for c in (v.comments or [])][:2] for v in req.variants]
+        all_comments = [c for comments in variant_comments for c in comments]
+        content_path, content_future, avatar_futures = start_downloads(req.content_url, all_comments, tmpdir, max_duration=req.max_duration, cancel=cancel)
+
+        variants = []
+        for i, v in enumerate(req.variants):
+            header_path = os.path.join(tmpdir, f"header_{i}.png")
+            header_size = render_header(v.header_text, header_path)
+            variants.append({"header_img": header_path, "header_size": header_size, "out_path": os.path.join(tmpdir, f"variant_{i + 1:02d}.mp4")})
+
+        try:
+            content_future.result()
+        finally:
+            collect_avatars(all_comments, avatar_futures)
+        if cancel is not None:
+            cancel.check()
+
+        check_downloaded_content(content_path, req.max_duration)
+
+        for i, comments_list in enumerate(variant_comments):
+            comment_img_path = os.path.join(tmpdir, f"comments_{i}.png")
+            variants[i]["comment_img"] = comment_img_path
+            variants[i]["comment_size"] = render_comments(comments_list, comment_img_path, req.use_html_renderer, req.scale, tmpdir, cancel)
+
+        bg_path = find_background(req.background_option)
+        encode = _encode_started(req.encode_profile)
+        try:
+            compose_video_variants(content_path, bg_path, variants, target_w=TARGET_W, target_h=TARGET_H, max_duration=req.max_duration, encode=encode,
+                                   on_progress=progress.reporter(req.progress_id), cancel=cancel)
+        finally:
+            _encode_finished()
+
+        out_paths = [v["out_path"] for v in variants]
+        if not all(os.path.exists(p) for p in out_paths):
+            raise HTTPException(status_code=500, detail="Gagal membuat video")
+        if req.progress_id:
+            progress.finish(req.progress_id)
+        return out_paths
+    except (HTTPException, cancellation.Cancelled) as e:
+        if req.progress_id:
+            progress.finish(req.progress_id, progress.FAILED, e.detail)
+        raise
+    except Exception:
+        if req.progress_id:
+            progress.finish(req.progress_id, progress.FAILED, "Render gagal")
+        raise _render_failed(tmpdir)
+
+
+def file_iterator(path, chunk_size=32 * 1024):
+    with open(path, "rb") as fh:
+        while True:
+            chunk = fh.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def metered(chunks, kind: str):
+    """Pass a response body through, counting its bytes and timing the transfer ("response" stage)."""
+    t0 = time.perf_counter()
+    try:
+        for chunk in chunks:
+            metrics.bytes_out.inc(len(chunk), kind=kind)
+            yield chunk
+    finally:
+        metrics.observe_stage("response", time.perf_counter() - t0)
+
+
+def with_cleanup(chunks, *cleanups):
+    """Response body that runs cleanups() once it ends: exhausted, closed, or dropped unstarted.
+
+    Background tasks are skipped when the client disconnects mid-body (and a body whose
+    first send fails is never started, so a finally alone would not run either).
+    """
+    def cleanup():
+        for fn in cleanups:
+            fn()
+
+    def body():
+        try:
+            yield from chunks
+        finally:
+            done()
+
+    gen = body()
+    done = weakref.finalize(gen, cleanup)
+    return gen
+
+
+def video_file_response(out_path: str, request: Optional[Request] = None):
+    # Stream the file in chunks and set explicit headers so proxies/tunnels (e.g. n8n dev tunnels)
+    # correctly detect EOF. StreamingResponse here avoids some sendfile/os-level streaming
+    # mismatches that can cause client-side hangs in certain proxy setups.
+    try:
+        size = os.path.getsize(out_path)
+    except Exception:
+        size = None
+
+    headers = {"Content-Disposition": f"attachment; filename=\"result.mp4\""}
+    # outputs from the result cache are immutable: their render key is a strong ETag
+    etag = results.etag_for(out_path)
+    if etag:
+        headers["ETag"] = etag
+        if request is not None and etag in request.headers.get("if-none-match", ""):
+            return Response(status_code=304, headers={"ETag": etag})
+    if size is not None:
+        headers["Content-Length"] = str(size)
+    # suggest closing the connection when done
+    headers.setdefault("Connection", "close")
+
+    return StreamingResponse(metered(file_iterator(out_path), "video"), media_type="video/mp4", headers=headers)
+
+
+def admit_render():
+    """Take a render slot (see admission.py) or reject with 429; returns the release function."""
+    try:
+        return admission.renders.slot()
+    except admission.Overloaded as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+
+def render_timeout(req):
+    """Seconds a render of req may run: req.timeout, at most RENDER_DEADLINE (None: no limit)."""
+    limits = [t for t in (req.timeout, RENDER_DEADLINE) if t and t > 0]
+    return min(limits) if limits else None
+
+
+def watch_disconnect(request: Request, token: cancellation.CancelToken):
+    """Cancel token when the client of request goes away; returns a function that stops watching.
+
+    Must be called from the endpoint's worker thread: the check runs on the event loop,
+    polled every DISCONNECT_POLL_INTERVAL seconds from a helper thread.
+    """
+    try:
+        loop = anyio.from_thread.run_sync(asyncio.get_running_loop)
+    except RuntimeError:
+        return lambda: None
+    stop = threading.Event()
+
+    def watch():
+        while not stop.wait(DISCONNECT_POLL_INTERVAL) and not token.cancelled:
             try:
-                log_path = os.path.join(tmpdir, "render_error.log")
-                with open(log_path, "w", encoding="utf-8") as lf:
-                    lf.write(tb_text)
+                gone = asyncio.run_coroutine_threadsafe(request.is_disconnected(), loop).result(timeout=5)
             except Exception:
-                pass
-            # also print to server stdout (uvicorn console)
-            print("Error during /render:\n", tb_text)
-            # raise HTTP 502 to indicate upstream processing failure with a short message
-            raise HTTPException(status_code=502, detail="Processing failed on server. Check server logs or render_error.log in temporary folder.")
+                return
+            if gone:
+                token.cancel(cancellation.DISCONNECTED)
+                return
+
+    threading.Thread(target=watch, daemon=True, name="disconnect-watch").start()
+    return stop.set
+
+
+@app.post("/render")
+def render(request: Request, req: RenderRequest, background_tasks: BackgroundTasks):
+    verify_api_key(request)
+    validate_render_request(req)
+
+    if not req.stream_output and results.enabled():
+        # a result already in the cache costs no render slot
+        cached = results.lookup_request(render_request_key(req))
+        metrics.cache_lookup("result_request", cached is not None)
+        if cached:
+            if req.progress_id:
+                progress.start(req.progress_id)
+                progress.finish(req.progress_id)
+            return video_file_response(cached, request)
+
+    release = admit_render()
+    tmpdir = tempfile.mkdtemp(prefix="shorts_")
+    # cleanup will be performed by background task after the response is sent
+    background_tasks.add_task(cleanup_path, tmpdir)
+
+    # stopped by the deadline, POST /render/{progress_id}/cancel or the client disconnecting
+    cancel = cancellation.open_token(req.progress_id, render_timeout(req))
+    stop_watching = watch_disconnect(request, cancel)
+    try:
+        if req.stream_output:
+            # fragments are sent as they are encoded; length is unknown up front (chunked)
+            chunks = render_to_file(req, tmpdir, stream_output=True, cancel=cancel)
+            # the deadline and the slot still apply while streaming; a disconnect now closes the body
+            body = with_cleanup(metered(chunks, "stream"), lambda: cancellation.close_token(req.progress_id, cancel), release)
+            headers = {"Content-Disposition": "attachment; filename=\"result.mp4\"", "Connection": "close"}
+            return StreamingResponse(body, media_type="video/mp4", headers=headers)
+        out_path = render_deduped(req, tmpdir, cancel=cancel)
+    except BaseException:
+        cancellation.close_token(req.progress_id, cancel)
+        release()
+        raise
     finally:
-        # cleanup will be performed by background task registered earlier
-        pass
+        stop_watching()
+    cancellation.close_token(req.progress_id, cancel)
+    release()
+    # return file and schedule cleanup
+    return video_file_response(out_path, request)
+
+
+@app.post("/render/{progress_id}/cancel")
+def cancel_render(request: Request, progress_id: str):
+    """Stop the running /render or /render/batch request sent with this progress_id."""
+    verify_api_key(request)
+    if not cancellation.cancel(progress_id):
+        raise HTTPException(status_code=404, detail="Tidak ada render berjalan dengan progress_id ini")
+    return {"progress_id": progress_id, "cancelled": True}
+
+
+@app.post("/render/batch")
+def render_batch(request: Request, req: BatchRenderRequest, background_tasks: BackgroundTasks):
+    """Render 1..MAX_BATCH_VARIANTS header/comment variants of one content_url, returned as a ZIP."""
+    verify_api_key(request)
+    validate_render_request(req)
+    if not req.variants:
+        raise HTTPException(status_code=400, detail="variants tidak boleh kosong")
+    if len(req.variants) > MAX_BATCH_VARIANTS:
+        raise HTTPException(status_code=400, detail=f"Maksimal {MAX_BATCH_VARIANTS} variants per request")
+
+    # one slot for all variants: they are encoded by a single ffmpeg run
+    release = admit_render()
+    tmpdir = tempfile.mkdtemp(prefix="shorts_batch_")
+    background_tasks.add_task(cleanup_path, tmpdir)
+
+    cancel = cancellation.open_token(req.progress_id, render_timeout(req))
+    stop_watching = watch_disconnect(request, cancel)
+    try:
+        out_paths = render_batch_to_files(req, tmpdir, cancel=cancel)
+    finally:
+        stop_watching()
+        cancellation.close_token(req.progress_id, cancel)
+        release()
+    # MP4 does not compress further: store the files as they are
+    zip_path = os.path.join(tmpdir, "result.zip")
+    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_STORED) as zf:
+        for p in out_paths:
+            zf.write(p, os.path.basename(p))
+    headers = {
+        "Content-Disposition": "attachment; filename=\"result.zip\"",
+        "Content-Length": str(os.path.getsize(zip_path)),
+        "Connection": "close",
+    }
+    return StreamingResponse(metered(file_iterator(zip_path), "zip"), media_type="application/zip", headers=headers)
+
+
+def job_backend():
+    """Module holding the jobs (jobs or render_queue), see JOB_BACKEND."""
+    return render_queue if JOB_BACKEND == "queue" else jobs
+
+
+@app.post("/jobs", status_code=202)
+def submit_render_job(request: Request, req: RenderJobRequest):
+    """Queue a render and return immediately with a job id (poll /jobs/{id} or wait for callback_url)."""
+    verify_api_key(request)
+    validate_render_request(req)
+    try:
+        if JOB_BACKEND == "queue":
+            render_queue.sweep_jobs()
+            job = render_queue.enqueue(req.dict(), callback_url=req.callback_url, base_url=str(request.base_url), max_queued=jobs.JOB_QUEUE_SIZE)
+        else:
+            job_id = uuid.uuid4().hex
+
+            def run_job(tmpdir):
+                # jobs line up for a render slot without a time limit (they are already queued);
+                # the deadline counts from the start of the render, not from the submission
+                with admission.renders.admitted(timeout=None):
+                    cancel = cancellation.open_token(job_id, render_timeout(req))
+                    try:
+                        return render_deduped(req, tmpdir, progress_key=job_id, cancel=cancel)
+                    finally:
+                        cancellation.close_token(job_id, cancel)
+
+            job = jobs.submit_job(run_job, callback_url=req.callback_url, base_url=str(request.base_url), job_id=job_id)
+    except jobs.QueueFull:
+        raise HTTPException(status_code=503, detail="Antrian render penuh, coba lagi nanti", headers={"Retry-After": "30"})
+    return jobs.job_view(job)
+
+
+@app.get("/jobs/{job_id}")
+def get_render_job(request: Request, job_id: str):
+    verify_api_key(request)
+    job = job_backend().get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job tidak ditemukan")
+    view = jobs.job_view(job)
+    if job["status"] == jobs.RUNNING:
+        view["progress"] = job_progress(job)
+    return view
+
+
+def job_progress(job):
+    """Job status plus, while it runs, its latest progress report (percent, eta, speed, ...)."""
+    data = {}
+    if job["status"] == jobs.RUNNING:
+        data = (job.get("progress") if JOB_BACKEND == "queue" else progress.get(job["id"])) or {}
+    elif job["status"] == jobs.DONE:
+        data = {"percent": 100.0, "eta": 0.0}
+    data = dict(data, status=job["status"])
+    if job["status"] == jobs.FAILED:
+        data["error"] = job.get("error")
+    return data
+
+
+def _sse(event: str, data: dict):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+def progress_events(read):
+    """SSE body: a "progress" event per change and a final "done" event.
+
+    read(version) -> (version, state, finished) waits up to about a second for a state newer
+    than version; state is None while the render is not known (yet).
+    """
+    started = last_sent = time.monotonic()
+    version, last = -1, None
+    while True:
+        version, state, finished = read(version)
+        now = time.monotonic()
+        if state is None:
+            if now - started > PROGRESS_WAIT_START:
+                yield _sse("error", {"detail": "Render tidak ditemukan"})
+                return
+        elif state != last:
+            yield _sse("done" if finished else "progress", state)
+            last, last_sent = state, now
+            if finished:
+                return
+        if now - last_sent >= PROGRESS_KEEPALIVE:
+            yield b": keepalive\n\n"
+            last_sent = now
+
+
+def sse_response(events):
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(events, media_type="text/event-stream", headers=headers)
+
+
+@app.get("/progress/{progress_id}")
+def get_render_progress(request: Request, progress_id: str):
+    """Live progress (server-sent events) of the /render or /render/batch request sent with this progress_id."""
+    verify_api_key(request)
+    if not PROGRESS_ID_RE.match(progress_id):
+        raise HTTPException(status_code=400, detail="progress_id tidak valid")
+
+    def read(version):
+        version, state = progress.wait(progress_id, version, timeout=1.0)
+        return version, state, state is not None and state["status"] != progress.RUNNING
+
+    return sse_response(progress_events(read))
+
+
+@app.get("/jobs/{job_id}/progress")
+def get_render_job_progress(request: Request, job_id: str):
+    """Live progress (server-sent events) of a job until it is done or failed."""
+    verify_api_key(request)
+    backend = job_backend()
+    if backend.get_job(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job tidak ditemukan")
+
+    def read(version):
+        if JOB_BACKEND == "queue":
+            # written by the worker process about once a second
+            time.sleep(1.0)
+        else:
+            version, _ = progress.wait(job_id, version, timeout=1.0)
+        job = backend.get_job(job_id)
+        if job is None:
+            return version, {"status": jobs.FAILED, "error": "Job tidak ditemukan"}, True
+        return version, job_progress(job), job["status"] in (jobs.DONE, jobs.FAILED)
+
+    return sse_response(progress_events(read))
+
+
+@app.post("/jobs/{job_id}/cancel")
+def cancel_render_job(request: Request, job_id: str):
+    """Cancel a queued or running job; its ffmpeg process is stopped and the job ends as failed."""
+    verify_api_key(request)
+    job = job_backend().get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job tidak ditemukan")
+    if job["status"] in (jobs.DONE, jobs.FAILED):
+        raise HTTPException(status_code=409, detail=f"Job sudah selesai (status: {job['status']})")
+    if JOB_BACKEND == "queue":
+        # the worker rendering it polls the flag (see worker.py)
+        job = render_queue.request_cancel(job_id)
+    else:
+        # a job still waiting is cancelled as soon as it starts
+        cancellation.cancel(job_id, remember=True)
+    return jobs.job_view(job)
+
+
+@app.get("/jobs/{job_id}/result")
+def get_render_job_result(request: Request, job_id: str):
+    verify_api_key(request)
+    job = job_backend().get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job tidak ditemukan")
+    if job["status"] == jobs.FAILED:
+        raise HTTPException(status_code=job.get("error_status") or 502, detail=job.get("error") or "Render gagal")
+    if job["status"] != jobs.DONE or not job.get("result_path") or not os.path.exists(job["result_path"]):
+        raise HTTPException(status_code=409, detail=f"Job belum selesai (status: {job['status']})")
+    return video_file_response(job["result_path"], request)
+
+
+@app.get("/metrics")
+def get_metrics(request: Request):
+    """Render metrics in the Prometheus text format (stage latency histograms, bytes, cache hits, ffmpeg exits)."""
+    verify_api_key(request)
+    running, queued = job_backend().queue_depth()
+    gauges = {
+        "render_active_encodes": ("Encodes running in this process", _active_encodes),
+        "render_jobs_running": ("Jobs being rendered (JOB_BACKEND)", running),
+        "render_jobs_queued": ("Jobs waiting in the queue (JOB_BACKEND)", queued),
+        "render_slow_encodes": ("Running encodes below SLOW_ENCODE_SPEED", progress.slow_count()),
+        "render_admission_budget": ("Renders allowed to run at once in this process", admission.renders.budget),
+        "render_admission_running": ("Renders holding a slot", admission.renders.running),
+        "render_admission_waiting": ("Renders waiting for a slot", admission.renders.waiting),
+    }
+    return Response(metrics.exposition(gauges), media_type="text/plain; version=0.0.4; charset=utf-8")
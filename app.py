@@ -9,6 +9,7 @@ from video_utils import (
     compose_video_ffmpeg,
 )
 import tempfile
+import threading
 import os
 
 st.set_page_config(page_title="Short Template Generator", layout="centered")
@@ -71,7 +72,11 @@ if submit:
 
         out_path = os.path.join(tmpdir, "output.mp4")
 
-        with st.spinner("Membuat video... (ffmpeg akan berjalan, ini mungkin butuh beberapa detik)"):
+        # ffmpeg runs in a thread; its progress reports are shown while waiting
+        state = {}
+        errors = []
+
+        def run_compose():
             try:
                 compose_video_ffmpeg(
                     content_path,
@@ -80,10 +85,36 @@ if submit:
                     comment_img,
                     out_path,
                     max_duration=(duration_limit if duration_limit > 0 else None),
+                    on_progress=state.update,
                 )
             except Exception as e:
-                st.error(f"Terjadi error saat memproses video: {e}")
-                raise
+                errors.append(e)
+
+        with st.spinner("Membuat video... (ffmpeg akan berjalan, ini mungkin butuh beberapa detik)"):
+            bar = st.progress(0)
+            status = st.empty()
+            compose_thread = threading.Thread(target=run_compose, daemon=True)
+            compose_thread.start()
+            while compose_thread.is_alive():
+                compose_thread.join(0.5)
+                info = dict(state)
+                if info.get("percent") is None:
+                    continue
+                phase = "Menyiapkan background" if info["phase"] == "background" else "Encode video"
+                text = f"{phase}: {info['percent']:.0f}%"
+                if info.get("eta") is not None:
+                    text += f", sisa sekitar {info['eta']:.0f} detik"
+                if info.get("speed"):
+                    text += f" (kecepatan {info['speed']:.2f}x)"
+                if info.get("slow"):
+                    text += " - lebih lambat dari realtime"
+                bar.progress(min(100, int(info["percent"])))
+                status.caption(text)
+            bar.empty()
+            status.empty()
+        if errors:
+            st.error(f"Terjadi error saat memproses video: {errors[0]}")
+            raise errors[0]
 
         if os.path.exists(out_path):
             st.success("Video selesai dibuat — unduh di bawah")
@@ -0,0 +1,260 @@
+"""Stage-level render benchmark on synthetic fixtures.
+
+Generates deterministic media with ffmpeg's lavfi sources (content clips in several aspect
+ratios, durations and frame rates, plus background image/video) and times each render
+stage separately: probe, header overlay, comment overlay (PIL and HTML), background
+pre-processing and the final compose encode. Results are written as JSON and compared
+against a stored baseline; a stage that got slower than the tolerance is flagged and the
+exit status is 1.
+
+    python benchmark.py                      # run, write benchmark_results.json, compare to baseline
+    python benchmark.py --save-baseline      # run and store the results as the new baseline
+    python benchmark.py --stages compose --fixtures portrait_30fps_5s --repeat 5
+
+By default every run starts with empty render caches (cold); --warm keeps them.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import cache_utils
+import video_utils
+
+
+FIXTURE_DIR = os.path.join(tempfile.gettempdir(), "lynix_bench_fixtures")
+TARGET_W = 1080
+TARGET_H = 1920
+
+# name -> (width, height, fps, seconds)
+CONTENT_FIXTURES = {
+    "landscape_30fps_5s": (1280, 720, 30, 5),
+    "portrait_30fps_5s": (720, 1280, 30, 5),
+    "square_24fps_5s": (720, 720, 24, 5),
+    "landscape_60fps_10s": (1920, 1080, 60, 10),
+    "portrait_25fps_15s": (1080, 1920, 25, 15),
+}
+
+HEADER_TEXTS = {
+    "short": "Fakta menarik hari ini",
+    "emoji": "🔥🔥 Kamu WAJIB tahu ini 😱👉 sebelum terlambat!! 💯🙏🏽✨",
+    "long": "Ini adalah judul yang sangat panjang sekali untuk menguji pembungkusan teks dan elipsis " * 2,
+}
+
+COMMENT_SETS = {
+    "plain": [
+        {"author": "andi", "text": "Mantap, infonya berguna banget", "likes": 120, "time": "2 j"},
+    ],
+    "emoji": [
+        {"author": "sari 🌸", "text": "😂😂😂 relate banget 👍🏽👍🏿 🇮🇩❤️‍🔥 👨‍👩‍👧‍👦 ✨✨", "likes": 5400, "time": "1 h", "replies": "13"},
+        {"author": "budi", "text": "🔥" * 40, "likes": 88, "highlight": True},
+    ],
+    "long": [
+        {"author": "pengguna_dengan_nama_panjang", "text": "Komentar panjang yang harus dibungkus ke beberapa baris " * 4, "likes": 3},
+        {"author": "rina", "text": "Setuju! " * 30, "likes": 42, "time": "5 m"},
+    ],
+}
+
+STAGES = ("probe", "header", "comments", "comments_html", "bg_prep", "compose")
+
+
+def _ffmpeg(*args):
+    cmd = [video_utils.ensure_ffmpeg_exists(), "-v", "error", "-y"] + list(args)
+    subprocess.run(cmd, check=True, capture_output=True)
+
+
+def ensure_fixtures(names):
+    """Create the content clips and backgrounds that are missing; return their paths."""
+    os.makedirs(FIXTURE_DIR, exist_ok=True)
+    bitexact = ["-fflags", "+bitexact", "-flags:v", "+bitexact", "-flags:a", "+bitexact", "-threads", "1"]
+    paths = {}
+    for name in names:
+        w, h, fps, secs = CONTENT_FIXTURES[name]
+        p = os.path.join(FIXTURE_DIR, f"{name}.mp4")
+        if not os.path.exists(p):
+            _ffmpeg("-f", "lavfi", "-i", f"testsrc2=size={w}x{h}:rate={fps}:duration={secs}",
+                    "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=48000:duration={secs}",
+                    "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p", "-c:a", "aac",
+                    *bitexact, p + ".tmp.mp4")
+            os.replace(p + ".tmp.mp4", p)
+        paths[name] = p
+    bg_image = os.path.join(FIXTURE_DIR, "bg_image.png")
+    if not os.path.exists(bg_image):
+        _ffmpeg("-f", "lavfi", "-i", f"gradients=size={TARGET_W}x{TARGET_H}:seed=1", "-frames:v", "1", bg_image)
+    bg_video = os.path.join(FIXTURE_DIR, "bg_video.mp4")
+    if not os.path.exists(bg_video):
+        _ffmpeg("-f", "lavfi", "-i", "mandelbrot=size=576x1024:rate=25", "-t", "8",
+                "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p", *bitexact, bg_video + ".tmp.mp4")
+        os.replace(bg_video + ".tmp.mp4", bg_video)
+    return paths, bg_image, bg_video
+
+
+def reset_caches(root):
+    """Point the render caches at an empty directory and drop in-memory entries."""
+    cache_utils.CACHE_ROOT = root
+    video_utils._overlay_cache = None
+    video_utils._bg_cache = None
+    with video_utils._probe_cache_lock:
+        video_utils._probe_cache.clear()
+    with video_utils._avatar_thumbs_lock:
+        video_utils._avatar_thumbs.clear()
+
+
+def build_cases(stages, fixtures, paths, bg_image, bg_video, workdir):
+    """List of (key, callable) to time; key is "<stage>/<case>"."""
+    cases = []
+    header_path = os.path.join(workdir, "header.png")
+    comments_path = os.path.join(workdir, "comments.png")
+    comment_width = int(TARGET_W * 0.90)
+    if "probe" in stages:
+        for name in fixtures:
+            cases.append((f"probe/{name}", lambda p=paths[name]: video_utils.probe_media(p)))
+    if "header" in stages:
+        for name, text in HEADER_TEXTS.items():
+            cases.append((f"header/{name}", lambda t=text: video_utils.make_header_image(t, header_path, width=TARGET_W, height=160)))
+    if "comments" in stages:
+        for name, comments in COMMENT_SETS.items():
+            cases.append((f"comments/{name}", lambda c=comments: video_utils.make_comments_image(
+                [dict(x) for x in c], comments_path, width=comment_width, scale=1.0, tmpdir=workdir)))
+    if "comments_html" in stages:
+        for name, comments in COMMENT_SETS.items():
+            cases.append((f"comments_html/{name}", lambda c=comments: video_utils.make_comments_image_html(
+                [dict(x) for x in c], comments_path, width=comment_width, scale=1.0)))
+    if "bg_prep" in stages:
+        ffmpeg = video_utils.ensure_ffmpeg_exists()
+        for secs in (5,):
+            cases.append((f"bg_prep/video_{secs}s", lambda s=secs: video_utils.prepare_background(ffmpeg, bg_video, s, TARGET_W, TARGET_H)))
+    if "compose" in stages:
+        def compose(content, bg):
+            # overlays are rendered outside the timed call; compose needs them on disk
+            hs = video_utils.make_header_image(HEADER_TEXTS["short"], header_path, width=TARGET_W, height=160)
+            cs = video_utils.make_comments_image([dict(x) for x in COMMENT_SETS["plain"]], comments_path, width=comment_width, scale=1.0)
+            out = os.path.join(workdir, "out.mp4")
+            return lambda: video_utils.compose_video_ffmpeg(content, bg, header_path, comments_path, out,
+                                                            target_w=TARGET_W, target_h=TARGET_H, header_size=hs, comment_size=cs)
+        for name in fixtures:
+            cases.append((f"compose/{name}", ("prepare", lambda p=paths[name]: compose(p, bg_image))))
+            # a looping video background goes through a different filtergraph (and the bg cache)
+            cases.append((f"compose/{name}_video_bg", ("prepare", lambda p=paths[name]: compose(p, bg_video))))
+    return cases
+
+
+def run_benchmark(stages, fixtures, repeat, warm):
+    paths, bg_image, bg_video = ensure_fixtures(fixtures)
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="lynix_bench_") as workdir:
+        cache_root = os.path.join(workdir, "cache")
+        reset_caches(os.path.join(cache_root, "0"))
+        for key, fn in build_cases(stages, fixtures, paths, bg_image, bg_video, workdir):
+            runs = []
+            error = None
+            for i in range(repeat):
+                if not warm:
+                    reset_caches(os.path.join(cache_root, f"{key.replace('/', '_')}_{i}"))
+                call = fn[1]() if isinstance(fn, tuple) else fn
+                t0 = time.perf_counter()
+                try:
+                    call()
+                except Exception as e:
+                    error = f"{type(e).__name__}: {e}"
+                    break
+                runs.append(time.perf_counter() - t0)
+            if error:
+                results[key] = {"skipped": error.splitlines()[0][:200]}
+                print(f"{key:40s} skipped ({results[key]['skipped']})")
+                continue
+            results[key] = {"median": statistics.median(runs), "min": min(runs), "runs": runs}
+            print(f"{key:40s} median {results[key]['median']:8.3f}s  min {results[key]['min']:8.3f}s")
+    return results
+
+
+def environment():
+    ffmpeg = video_utils.ensure_ffmpeg_exists()
+    version = subprocess.run([ffmpeg, "-version"], capture_output=True, text=True).stdout.splitlines()
+    return {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "ffmpeg": version[0] if version else None,
+        "encode_profile": video_utils.ENCODE_PROFILE,
+        "single_pass": video_utils.COMPOSE_SINGLE_PASS,
+    }
+
+
+def compare(results, baseline, tolerance, min_delta):
+    """Return the list of regressions: stages whose median grew by more than tolerance (and min_delta seconds),
+    and stages that ran in the baseline but are skipped (raise) now."""
+    regressions = []
+    for key, cur in sorted(results.items()):
+        base = baseline.get("results", {}).get(key)
+        if not base or "median" not in base:
+            continue
+        if "median" not in cur:
+            regressions.append({"stage": key, "baseline": base["median"], "current": None, "ratio": None, "skipped": cur.get("skipped")})
+            continue
+        delta = cur["median"] - base["median"]
+        ratio = cur["median"] / base["median"] if base["median"] > 0 else float("inf")
+        if ratio > 1 + tolerance and delta > min_delta:
+            regressions.append({"stage": key, "baseline": base["median"], "current": cur["median"], "ratio": ratio})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stage-level render benchmark on synthetic fixtures")
+    parser.add_argument("--stages", default=",".join(STAGES), help=f"comma separated subset of {', '.join(STAGES)}")
+    parser.add_argument("--fixtures", default=",".join(CONTENT_FIXTURES), help="comma separated content fixtures")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case (median is reported)")
+    parser.add_argument("--warm", action="store_true", help="keep render caches between runs")
+    parser.add_argument("--output", default="benchmark_results.json", help="where to write the results JSON")
+    parser.add_argument("--baseline", default="benchmark_baseline.json", help="baseline JSON to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown ratio before a stage is flagged")
+    parser.add_argument("--min-delta", type=float, default=0.02, help="ignore slowdowns smaller than this many seconds")
+    args = parser.parse_args()
+
+    stages = [s for s in args.stages.split(",") if s]
+    fixtures = [f for f in args.fixtures.split(",") if f]
+    unknown = [s for s in stages if s not in STAGES] + [f for f in fixtures if f not in CONTENT_FIXTURES]
+    if unknown:
+        parser.error(f"unknown stage/fixture: {', '.join(unknown)}")
+
+    report = {"environment": environment(), "cold": not args.warm, "repeat": args.repeat,
+              "results": run_benchmark(stages, fixtures, max(1, args.repeat), args.warm)}
+    with open(args.output, "w", encoding="utf-8") as fh:
+        json.dump(report, fh, indent=2)
+    print(f"Hasil ditulis ke {args.output}")
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as fh:
+            json.dump(report, fh, indent=2)
+        print(f"Baseline disimpan ke {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"Baseline {args.baseline} belum ada; jalankan dengan --save-baseline untuk membuatnya")
+        return 0
+    with open(args.baseline, "r", encoding="utf-8") as fh:
+        baseline = json.load(fh)
+    regressions = compare(report["results"], baseline, args.tolerance, args.min_delta)
+    report["regressions"] = regressions
+    with open(args.output, "w", encoding="utf-8") as fh:
+        json.dump(report, fh, indent=2)
+    if regressions:
+        print("REGRESI terdeteksi:")
+        for r in regressions:
+            if r["current"] is None:
+                print(f"  {r['stage']:40s} {r['baseline']:.3f}s -> gagal ({r['skipped']})")
+            else:
+                print(f"  {r['stage']:40s} {r['baseline']:.3f}s -> {r['current']:.3f}s (x{r['ratio']:.2f})")
+        return 1
+    print("Tidak ada regresi dibanding baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,191 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+CACHE_ROOT = os.environ.get("LYNIX_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "lynix_cache")
+
+# fingerprint reads this many bytes from the head and the tail of a file
+_FINGERPRINT_CHUNK = 64 * 1024
+_STALE_TMP_SECONDS = 3600
+
+
+def file_fingerprint(path):
+    """Content fingerprint of a file: size + hash of its first and last 64 KB.
+
+    Cheap enough to run on every request (even for large background videos) and
+    independent of the file path, so identical files in different tmpdirs match.
+    """
+    size = os.path.getsize(path)
+    h = hashlib.sha256()
+    h.update(str(size).encode())
+    with open(path, "rb") as fh:
+        h.update(fh.read(_FINGERPRINT_CHUNK))
+        if size > _FINGERPRINT_CHUNK * 2:
+            fh.seek(-_FINGERPRINT_CHUNK, os.SEEK_END)
+            h.update(fh.read(_FINGERPRINT_CHUNK))
+        elif size > _FINGERPRINT_CHUNK:
+            h.update(fh.read())
+    return h.hexdigest()
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """sha256 of the whole file, for keys whose cached data is sent to clients.
+
+    file_fingerprint is enough to reuse derived data (probes, backgrounds), but two files
+    of the same size that differ only in the middle share it.
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(chunk_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def make_key(*parts):
+    """Build a stable cache key from arbitrary (str()-able) parts."""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(repr(part).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class DiskLRUCache:
+    """Directory of files addressed by key, bounded by total size with LRU eviction.
+
+    Entries are published with an atomic rename so several worker processes can
+    share the same directory; recency is tracked through the file mtime, which
+    is bumped on every hit.
+    """
+
+    def __init__(self, name, max_bytes):
+        self.dir = os.path.join(CACHE_ROOT, name)
+        self.max_bytes = int(max_bytes)
+        self._lock = threading.Lock()
+        os.makedirs(self.dir, exist_ok=True)
+
+    def path_for(self, key, ext=""):
+        return os.path.join(self.dir, key + ext)
+
+    def get(self, key, ext=""):
+        """Return the cached file path for key (marking it recently used) or None."""
+        p = self.path_for(key, ext)
+        try:
+            os.utime(p, None)
+        except OSError:
+            return None
+        return p
+
+    def tmp_path(self, ext=""):
+        """Path inside the cache dir to build a new entry into before put()."""
+        return os.path.join(self.dir, f".tmp-{os.getpid()}-{uuid.uuid4().hex}{ext}")
+
+    def put(self, key, src_path, ext=""):
+        """Move src_path into the cache under key and return the final path."""
+        dst = self.path_for(key, ext)
+        os.replace(src_path, dst)
+        self.evict()
+        return dst
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits in max_bytes."""
+        with self._lock:
+            entries = []
+            total = 0
+            try:
+                names = os.listdir(self.dir)
+            except OSError:
+                return
+            now = time.time()
+            for fname in names:
+                p = os.path.join(self.dir, fname)
+                try:
+                    st = os.stat(p)
+                except OSError:
+                    continue
+                if fname.startswith(".tmp-"):
+                    # leftovers of a worker that died mid-write
+                    if now - st.st_mtime > _STALE_TMP_SECONDS:
+                        try:
+                            os.remove(p)
+                        except OSError:
+                            pass
+                    continue
+                entries.append((st.st_mtime, st.st_size, p))
+                total += st.st_size
+            if total <= self.max_bytes:
+                return
+            entries.sort()
+            for _, size, p in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(p)
+                    total -= size
+                except OSError:
+                    pass
+
+
+class SpillLRUCache:
+    """In-memory LRU of byte blobs bounded by total size, backed by a DiskLRUCache.
+
+    Entries are written through to disk so other worker processes (and this one, after
+    an entry was evicted from memory) can still hit them; disk hits are promoted back
+    into memory.
+    """
+
+    def __init__(self, name, mem_max_bytes, disk_max_bytes):
+        self.mem_max_bytes = int(mem_max_bytes)
+        self.disk = DiskLRUCache(name, disk_max_bytes)
+        self._items = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached bytes for key or None."""
+        with self._lock:
+            data = self._items.get(key)
+            if data is not None:
+                self._items.move_to_end(key)
+                return data
+        p = self.disk.get(key)
+        if p is None:
+            return None
+        try:
+            with open(p, "rb") as fh:
+                data = fh.read()
+        except OSError:
+            return None
+        self._remember(key, data)
+        return data
+
+    def put(self, key, data):
+        self._remember(key, data)
+        tmp = self.disk.tmp_path()
+        try:
+            with open(tmp, "wb") as fh:
+                fh.write(data)
+            self.disk.put(key, tmp)
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+    def _remember(self, key, data):
+        if len(data) > self.mem_max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._items[key] = data
+            self._bytes += len(data)
+            while self._bytes > self.mem_max_bytes and self._items:
+                _, evicted = self._items.popitem(last=False)
+                self._bytes -= len(evicted)
@@ -0,0 +1,143 @@
+import threading
+import time
+
+import metrics
+
+
+# Cancellation of running renders: every render gets a CancelToken (with its deadline) and
+# the code holding a resource (download, browser page, ffmpeg process) registers a callback
+# that releases it as soon as the token is cancelled.
+
+DEADLINE = "deadline"
+DISCONNECTED = "disconnected"
+CANCELLED = "cancelled"
+
+_REASONS = {
+    DEADLINE: (504, "Render melebihi batas waktu"),
+    DISCONNECTED: (499, "Client menutup koneksi, render dihentikan"),
+    CANCELLED: (409, "Render dibatalkan"),
+}
+
+# explicit cancels for keys that have no token yet (e.g. a job still waiting) are kept this long
+PENDING_CANCEL_TTL = 600
+
+
+class Cancelled(Exception):
+    """Raised by CancelToken.check(); status_code/detail are reported like an HTTPException's."""
+
+    def __init__(self, reason=CANCELLED):
+        self.cancel_reason = reason
+        self.status_code, self.detail = _REASONS.get(reason, _REASONS[CANCELLED])
+        super().__init__(self.detail)
+
+
+class CancelToken:
+    """Cancellation flag with an optional deadline (seconds from now) and cancel callbacks."""
+
+    def __init__(self, timeout=None):
+        self.reason = None
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._closed = threading.Event()
+        self._timer = None
+        if timeout:
+            self._timer = threading.Timer(timeout, self.cancel, args=(DEADLINE,))
+            self._timer.daemon = True
+            self._timer.start()
+
+    @property
+    def cancelled(self):
+        return self.reason is not None
+
+    def cancel(self, reason=CANCELLED):
+        """Cancel the token and run the callbacks (once; later calls and calls after close() do nothing)."""
+        with self._lock:
+            if self.reason is not None or self._closed.is_set():
+                return
+            self.reason = reason
+            callbacks, self._callbacks = self._callbacks, []
+        metrics.cancellations.inc(reason=reason)
+        print(f"Render dihentikan ({reason})")
+        for fn in callbacks:
+            try:
+                fn()
+            except Exception as e:
+                print(f"Warning: pembatalan gagal: {e}")
+
+    def check(self):
+        """Raise Cancelled if the token was cancelled."""
+        if self.reason is not None:
+            raise Cancelled(self.reason)
+
+    def on_cancel(self, fn):
+        """Call fn() when the token is cancelled (right away if it already is); returns an unregister function."""
+        with self._lock:
+            if self.reason is None:
+                self._callbacks.append(fn)
+                return lambda: self._remove(fn)
+        fn()
+        return lambda: None
+
+    def _remove(self, fn):
+        with self._lock:
+            if fn in self._callbacks:
+                self._callbacks.remove(fn)
+
+    def wait(self, timeout):
+        """Sleep up to timeout seconds; True once the token is closed or cancelled."""
+        self._closed.wait(timeout)
+        return self._closed.is_set() or self.cancelled
+
+    def close(self):
+        """The render is over: stop the deadline timer and ignore later cancels."""
+        with self._lock:
+            self._closed.set()
+            self._callbacks = []
+        if self._timer is not None:
+            self._timer.cancel()
+
+
+_tokens = {}
+_pending = {}
+_tokens_lock = threading.Lock()
+
+
+def open_token(key=None, timeout=None):
+    """New token for a render, registered under key (job id or progress_id) for cancel()."""
+    token = CancelToken(timeout)
+    if key:
+        with _tokens_lock:
+            _tokens[key] = token
+            pending = _pending.pop(key, None)
+        if pending is not None:
+            token.cancel(CANCELLED)
+    return token
+
+
+def close_token(key, token):
+    token.close()
+    if key:
+        with _tokens_lock:
+            if _tokens.get(key) is token:
+                del _tokens[key]
+
+
+def cancel(key, remember=False):
+    """Cancel the render registered under key; returns False if none is running (yet).
+
+    remember: keep the cancel for PENDING_CANCEL_TTL seconds, so a render that registers
+    the key later (e.g. a queued job when it starts) is cancelled immediately.
+    """
+    with _tokens_lock:
+        token = _tokens.get(key)
+        if token is None:
+            if not remember:
+                return False
+            now = time.time()
+            for k, t in list(_pending.items()):
+                if now - t > PENDING_CANCEL_TTL:
+                    del _pending[k]
+            _pending[key] = now
+            return False
+    token.cancel(CANCELLED)
+    return True
@@ -0,0 +1,142 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+
+# number of renders running at the same time (each one is an ffmpeg process)
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", "2"))
+# jobs allowed to wait for a worker; submissions beyond this are rejected
+JOB_QUEUE_SIZE = int(os.environ.get("JOB_QUEUE_SIZE", "20"))
+# finished jobs (and their output files) are kept this long, in seconds
+JOB_TTL = int(os.environ.get("JOB_TTL", "3600"))
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class QueueFull(Exception):
+    pass
+
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="render")
+# one slot per running or waiting job
+_slots = threading.BoundedSemaphore(RENDER_WORKERS + JOB_QUEUE_SIZE)
+
+
+def submit_job(render_fn, callback_url=None, base_url="", job_id=None):
+    """Queue render_fn(tmpdir) -> output path on the worker pool and return the job dict.
+
+    job_id: id to use instead of a new random one (e.g. when render_fn needs to know it).
+    Raises QueueFull when all workers are busy and the wait queue is full.
+    """
+    sweep_jobs()
+    if not _slots.acquire(blocking=False):
+        raise QueueFull()
+    job_id = job_id or uuid.uuid4().hex
+    job = {
+        "id": job_id,
+        "status": QUEUED,
+        "created_at": time.time(),
+        "started_at": None,
+        "finished_at": None,
+        "error": None,
+        "error_status": None,
+        "result_path": None,
+        "tmpdir": None,
+        "callback_url": callback_url,
+        "base_url": base_url.rstrip("/"),
+    }
+    with _jobs_lock:
+        _jobs[job_id] = job
+    try:
+        _executor.submit(_run_job, job, render_fn)
+    except Exception:
+        _slots.release()
+        with _jobs_lock:
+            _jobs.pop(job_id, None)
+        raise
+    return job
+
+
+def _run_job(job, render_fn):
+    job["status"] = RUNNING
+    job["started_at"] = time.time()
+    try:
+        job["tmpdir"] = tempfile.mkdtemp(prefix="shorts_job_")
+        job["result_path"] = render_fn(job["tmpdir"])
+        job["status"] = DONE
+    except Exception as e:
+        # HTTPException carries status_code/detail; keep them so the result endpoint can report them
+        job["error_status"] = getattr(e, "status_code", None)
+        job["error"] = str(getattr(e, "detail", None) or e)
+        job["status"] = FAILED
+        print(f"Job {job['id']} failed:\n", traceback.format_exc())
+    finally:
+        job["finished_at"] = time.time()
+        _slots.release()
+    if job.get("callback_url"):
+        send_callback(job)
+
+
+def send_callback(job, timeout=15):
+    """POST the job status to its callback_url. Failures are only logged."""
+    try:
+        with httpx.Client(timeout=timeout, follow_redirects=True) as client:
+            r = client.post(job["callback_url"], json=job_view(job))
+            r.raise_for_status()
+    except Exception as e:
+        print(f"Warning: callback untuk job {job['id']} gagal: {e}")
+
+
+def get_job(job_id):
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+
+def job_view(job):
+    """Public (JSON-serialisable) representation of a job."""
+    base = job.get("base_url", "")
+    view = {
+        "job_id": job["id"],
+        "status": job["status"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+        "status_url": f"{base}/jobs/{job['id']}",
+    }
+    if job["status"] == DONE:
+        view["result_url"] = f"{base}/jobs/{job['id']}/result"
+    if job["status"] == FAILED:
+        view["error"] = job["error"]
+    return view
+
+
+def queue_depth():
+    """Return (running, queued) job counts."""
+    with _jobs_lock:
+        statuses = [j["status"] for j in _jobs.values()]
+    return statuses.count(RUNNING), statuses.count(QUEUED)
+
+
+def sweep_jobs():
+    """Forget finished jobs older than JOB_TTL and delete their temporary folders."""
+    now = time.time()
+    expired = []
+    with _jobs_lock:
+        for job_id, job in list(_jobs.items()):
+            if job["finished_at"] is not None and now - job["finished_at"] > JOB_TTL:
+                expired.append(_jobs.pop(job_id))
+    for job in expired:
+        if job.get("tmpdir"):
+            shutil.rmtree(job["tmpdir"], ignore_errors=True)
@@ -0,0 +1,157 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Process-wide render metrics, served in the Prometheus text format by GET /metrics.
+
+# upper bounds (seconds) of the latency histogram buckets; +Inf is implicit
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+
+_lock = threading.Lock()
+_metrics = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def lines(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{_format_labels(zip(self.labelnames, key))} {_format_value(value)}"
+
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        # labels -> [count per bucket (not cumulative)..., sum, count]
+        self._values = {}
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with _lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def lines(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for key, series in sorted(self._values.items()):
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, n in zip(self.buckets, series):
+                cumulative += n
+                yield f"{self.name}_bucket{_format_labels(labels + [('le', _format_value(float(bound)))])} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(labels)} {_format_value(series[-2])}"
+            yield f"{self.name}_count{_format_labels(labels)} {series[-1]}"
+
+
+stage_seconds = Histogram(
+    "render_stage_duration_seconds",
+    "Duration of one render stage (download, probe, overlay, background, encode, response)",
+    ("stage",),
+)
+render_seconds = Histogram(
+    "render_duration_seconds",
+    "Duration of a render until its output is ready (or starts streaming)",
+    ("kind", "status"),
+)
+bytes_in = Counter("render_bytes_in_total", "Bytes downloaded for renders", ("source",))
+bytes_out = Counter("render_bytes_out_total", "Bytes sent in render responses", ("kind",))
+cache_requests = Counter("render_cache_requests_total", "Cache lookups by cache and result (hit/miss)", ("cache", "result"))
+ffmpeg_exits = Counter("ffmpeg_exit_total", "Finished ffmpeg processes by stage and exit code", ("stage", "code"))
+slow_encodes = Counter("ffmpeg_slow_encodes_total", "ffmpeg runs that fell below SLOW_ENCODE_SPEED", ("stage",))
+admissions = Counter("render_admissions_total", "Admission decisions (admitted, waited, rejected, timeout)", ("result",))
+cancellations = Counter("render_cancellations_total", "Renders stopped early by reason (deadline, disconnected, cancelled)", ("reason",))
+compose_plans = Counter("render_compose_plan_total", "Operations chosen per stream by the compose plan (copy, scale, aac, ...)", ("stream", "op"))
+
+
+def observe_stage(stage, seconds):
+    stage_seconds.observe(seconds, stage=stage)
+
+
+@contextmanager
+def span(stage):
+    """Time the block as one observation of stage (also when it raises)."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - t0)
+
+
+@contextmanager
+def track_render(kind):
+    """Time a whole render; status is ok, rejected (HTTP 4xx), cancelled or failed. Usable as a decorator."""
+    t0 = time.perf_counter()
+    status = "failed"
+    try:
+        yield
+        status = "ok"
+    except Exception as e:
+        if getattr(e, "cancel_reason", None):
+            status = "cancelled"
+        elif (getattr(e, "status_code", None) or 500) < 500:
+            status = "rejected"
+        raise
+    finally:
+        render_seconds.observe(time.perf_counter() - t0, kind=kind, status=status)
+
+
+def cache_lookup(cache, hit):
+    cache_requests.inc(cache=cache, result="hit" if hit else "miss")
+
+
+def ffmpeg_exited(stage, returncode):
+    ffmpeg_exits.inc(stage=stage, code=returncode)
+
+
+def exposition(gauges=None):
+    """All metrics in the Prometheus text format; gauges: extra {name: (help, value)} read at scrape time."""
+    out = []
+    with _lock:
+        for metric in _metrics:
+            out.extend(metric.lines())
+    for name, (help_text, value) in sorted((gauges or {}).items()):
+        out.append(f"# HELP {name} {help_text}")
+        out.append(f"# TYPE {name} gauge")
+        out.append(f"{name} {_format_value(value)}")
+    return "\n".join(out) + "\n"
@@ -0,0 +1,122 @@
+import os
+import threading
+import time
+
+
+# Live render progress by key (a job id or a client-chosen progress_id), read by the SSE
+# endpoints. Finished entries are kept PROGRESS_TTL seconds for late readers.
+PROGRESS_TTL = int(os.environ.get("PROGRESS_TTL", "600"))
+
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+_entries = {}
+_cond = threading.Condition()
+_listeners = []
+
+
+def _sweep(now):
+    for key, entry in list(_entries.items()):
+        if entry["finished_at"] is not None and now - entry["finished_at"] > PROGRESS_TTL:
+            del _entries[key]
+
+
+def _changed(key, entry):
+    """Bump the entry's version and wake waiters (call with _cond held); returns its view for _notify."""
+    entry["version"] += 1
+    entry["updated_at"] = time.time()
+    _cond.notify_all()
+    return view(entry)
+
+
+def _notify(key, data):
+    # called without _cond held: a listener may be slow (e.g. a database write) and must not
+    # block the progress updates of other renders, which come from ffmpeg's stderr readers
+    for listener in list(_listeners):
+        try:
+            listener(key, data)
+        except Exception as e:
+            print(f"Warning: progress listener gagal: {e}")
+
+
+def start(key):
+    """Mark key as running (kept as it is if it already runs)."""
+    with _cond:
+        now = time.time()
+        _sweep(now)
+        entry = _entries.get(key)
+        if entry is not None and entry["status"] == RUNNING:
+            return
+        _entries[key] = {"status": RUNNING, "progress": None, "error": None, "version": 0,
+                         "started_at": now, "updated_at": now, "finished_at": None}
+        data = _changed(key, _entries[key])
+    _notify(key, data)
+
+
+def update(key, info):
+    """Store the latest progress dict (see video_utils.progress_report) for a running key."""
+    with _cond:
+        entry = _entries.get(key)
+        if entry is None or entry["status"] != RUNNING:
+            return
+        entry["progress"] = info
+        data = _changed(key, entry)
+    _notify(key, data)
+
+
+def reporter(key):
+    """on_progress callback for the compose functions, or None without a key."""
+    if not key:
+        return None
+    return lambda info: update(key, info)
+
+
+def finish(key, status=DONE, error=None):
+    with _cond:
+        entry = _entries.get(key)
+        if entry is None or entry["status"] != RUNNING:
+            return
+        entry["status"] = status
+        entry["error"] = error
+        entry["finished_at"] = time.time()
+        data = _changed(key, entry)
+    _notify(key, data)
+
+
+def view(entry):
+    """Public dict of an entry: status plus the fields of the latest progress report."""
+    data = {"status": entry["status"]}
+    data.update(entry["progress"] or {})
+    if entry["status"] == DONE:
+        data.update(percent=100.0, eta=0.0)
+    if entry["error"]:
+        data["error"] = entry["error"]
+    return data
+
+
+def get(key):
+    with _cond:
+        entry = _entries.get(key)
+        return None if entry is None else view(entry)
+
+
+def wait(key, version=-1, timeout=15.0):
+    """Block until key has a version newer than version (or timeout); return (version, view) or (version, None)."""
+    with _cond:
+        _cond.wait_for(lambda: key in _entries and _entries[key]["version"] > version, timeout=timeout)
+        entry = _entries.get(key)
+        if entry is None:
+            return version, None
+        return entry["version"], view(entry)
+
+
+def slow_count():
+    """Running renders whose encode is currently below realtime (progress "slow")."""
+    with _cond:
+        return sum(1 for e in _entries.values() if e["status"] == RUNNING and (e["progress"] or {}).get("slow"))
+
+
+def add_listener(fn):
+    """Call fn(key, view) on every change (e.g. to copy progress to the render queue)."""
+    _listeners.append(fn)
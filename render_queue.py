@@ -0,0 +1,264 @@
+import json
+import os
+import shutil
+import sqlite3
+import time
+import uuid
+
+from cache_utils import CACHE_ROOT
+from jobs import DONE, FAILED, JOB_TTL, QUEUED, RUNNING, QueueFull, send_callback
+
+
+# Durable render queue shared by the API (producer) and worker.py processes (consumers).
+# Workers on other machines need the database and RENDER_RESULTS_DIR on a shared disk.
+RENDER_QUEUE_DB = os.environ.get("RENDER_QUEUE_DB") or os.path.join(CACHE_ROOT, "render_queue.sqlite3")
+RENDER_RESULTS_DIR = os.environ.get("RENDER_RESULTS_DIR") or os.path.join(CACHE_ROOT, "queue_results")
+# a running job whose worker stopped renewing its lease for this long is handed to another worker
+RENDER_QUEUE_LEASE = int(os.environ.get("RENDER_QUEUE_LEASE", "300"))
+# attempts (including lease expiries) before a job is marked failed
+RENDER_QUEUE_MAX_ATTEMPTS = int(os.environ.get("RENDER_QUEUE_MAX_ATTEMPTS", "3"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    lease_until REAL,
+    worker TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    error_status INTEGER,
+    result_path TEXT,
+    callback_url TEXT,
+    base_url TEXT NOT NULL DEFAULT '',
+    progress TEXT,
+    cancel_requested INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at);
+"""
+
+_initialized = False
+
+
+def _connect():
+    """New connection in autocommit mode (transactions are opened explicitly)."""
+    global _initialized
+    os.makedirs(os.path.dirname(RENDER_QUEUE_DB), exist_ok=True)
+    conn = sqlite3.connect(RENDER_QUEUE_DB, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    if not _initialized:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+        # databases created before these columns existed
+        for column in ("progress TEXT", "cancel_requested INTEGER NOT NULL DEFAULT 0"):
+            try:
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN {column}")
+            except sqlite3.OperationalError:
+                pass
+        _initialized = True
+    return conn
+
+
+def _job_dict(row):
+    """Row as the job dict used by jobs.job_view (plus the request payload)."""
+    job = dict(row)
+    job["payload"] = json.loads(job["payload"])
+    job["progress"] = json.loads(job["progress"]) if job.get("progress") else None
+    return job
+
+
+def enqueue(payload, callback_url=None, base_url="", max_queued=None):
+    """Store a render request payload as a queued job and return the job dict.
+
+    Raises QueueFull when max_queued jobs are already waiting.
+    """
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        if max_queued is not None:
+            (queued,) = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (QUEUED,)).fetchone()
+            if queued >= max_queued:
+                conn.execute("ROLLBACK")
+                raise QueueFull()
+        job_id = uuid.uuid4().hex
+        conn.execute(
+            "INSERT INTO jobs (id, payload, status, created_at, callback_url, base_url) VALUES (?, ?, ?, ?, ?, ?)",
+            (job_id, json.dumps(payload), QUEUED, time.time(), callback_url, base_url.rstrip("/")),
+        )
+        conn.execute("COMMIT")
+        return get_job(job_id, conn)
+    finally:
+        conn.close()
+
+
+def claim(worker_id):
+    """Take the oldest runnable job for worker_id (leased for RENDER_QUEUE_LEASE seconds) or return None.
+
+    Jobs whose lease expired (their worker died) are taken again, until they have been
+    attempted RENDER_QUEUE_MAX_ATTEMPTS times.
+    """
+    conn = _connect()
+    try:
+        while True:
+            now = time.time()
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT id, attempts FROM jobs WHERE status = ? OR (status = ? AND lease_until < ?) "
+                "ORDER BY created_at LIMIT 1",
+                (QUEUED, RUNNING, now),
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            if row["attempts"] >= RENDER_QUEUE_MAX_ATTEMPTS:
+                conn.execute(
+                    "UPDATE jobs SET status = ?, finished_at = ?, error = ?, lease_until = NULL WHERE id = ?",
+                    (FAILED, now, "Worker berhenti saat render (batas percobaan tercapai)", row["id"]),
+                )
+                conn.execute("COMMIT")
+                failed = get_job(row["id"], conn)
+                if failed and failed.get("callback_url"):
+                    send_callback(failed)
+                continue
+            conn.execute(
+                "UPDATE jobs SET status = ?, worker = ?, started_at = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                (RUNNING, worker_id, now, now + RENDER_QUEUE_LEASE, row["id"]),
+            )
+            conn.execute("COMMIT")
+            return get_job(row["id"], conn)
+    finally:
+        conn.close()
+
+
+def renew_lease(job_id, worker_id):
+    """Extend the lease of a running job; False if the job is no longer this worker's."""
+    conn = _connect()
+    try:
+        cur = conn.execute(
+            "UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND status = ?",
+            (time.time() + RENDER_QUEUE_LEASE, job_id, worker_id, RUNNING),
+        )
+        return cur.rowcount == 1
+    finally:
+        conn.close()
+
+
+def set_progress(job_id, progress):
+    """Store the latest progress dict of a running job (see progress.py)."""
+    conn = _connect()
+    try:
+        conn.execute("UPDATE jobs SET progress = ? WHERE id = ? AND status = ?", (json.dumps(progress), job_id, RUNNING))
+    finally:
+        conn.close()
+
+
+def request_cancel(job_id):
+    """Cancel a job: a queued one fails right away, a running one is flagged for its worker.
+
+    Returns the job dict (None if unknown).
+    """
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(
+            "UPDATE jobs SET status = ?, finished_at = ?, error = ?, error_status = ? WHERE id = ? AND status = ?",
+            (FAILED, time.time(), "Render dibatalkan", 409, job_id, QUEUED),
+        )
+        conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = ?", (job_id, RUNNING))
+        conn.execute("COMMIT")
+        return get_job(job_id, conn)
+    finally:
+        conn.close()
+
+
+def cancel_requested(job_id):
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row["cancel_requested"])
+    finally:
+        conn.close()
+
+
+def publish_result(job_id, worker_id, src_path):
+    """Copy a finished output to RENDER_RESULTS_DIR and mark the job done.
+
+    Returns False (and publishes nothing) if the job is no longer worker_id's, e.g. because
+    its lease expired and another worker took it.
+    """
+    os.makedirs(RENDER_RESULTS_DIR, exist_ok=True)
+    dst = os.path.join(RENDER_RESULTS_DIR, f"{job_id}.mp4")
+    tmp = f"{dst}.{uuid.uuid4().hex}.tmp"
+    shutil.copyfile(src_path, tmp)
+    try:
+        return _finish(job_id, worker_id, DONE, result_path=dst, move=(tmp, dst))
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def fail(job_id, worker_id, error, error_status=None):
+    """Mark the job failed; False if it is no longer worker_id's."""
+    return _finish(job_id, worker_id, FAILED, error=error, error_status=error_status)
+
+
+def _finish(job_id, worker_id, status, result_path=None, error=None, error_status=None, move=None):
+    # move: (src, dst) renamed in the same transaction, only if the job is still ours
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        owned = conn.execute("SELECT 1 FROM jobs WHERE id = ? AND worker = ? AND status = ?", (job_id, worker_id, RUNNING)).fetchone()
+        if owned is None:
+            conn.execute("ROLLBACK")
+            return False
+        if move is not None:
+            os.replace(*move)
+        conn.execute(
+            "UPDATE jobs SET status = ?, finished_at = ?, lease_until = NULL, result_path = ?, error = ?, error_status = ? WHERE id = ?",
+            (status, time.time(), result_path, error, error_status, job_id),
+        )
+        conn.execute("COMMIT")
+        return True
+    finally:
+        conn.close()
+
+
+def get_job(job_id, conn=None):
+    own = conn is None
+    conn = conn or _connect()
+    try:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return _job_dict(row) if row else None
+    finally:
+        if own:
+            conn.close()
+
+
+def queue_depth():
+    """Return (running, queued) job counts."""
+    conn = _connect()
+    try:
+        counts = dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+    finally:
+        conn.close()
+    return counts.get(RUNNING, 0), counts.get(QUEUED, 0)
+
+
+def sweep_jobs():
+    """Forget finished jobs older than JOB_TTL and delete their result files."""
+    conn = _connect()
+    try:
+        cutoff = time.time() - JOB_TTL
+        rows = conn.execute("SELECT id, result_path FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?", (cutoff,)).fetchall()
+        for row in rows:
+            if row["result_path"]:
+                try:
+                    os.remove(row["result_path"])
+                except OSError:
+                    pass
+        conn.execute("DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?", (cutoff,))
+    finally:
+        conn.close()
@@ -0,0 +1,123 @@
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+from cache_utils import DiskLRUCache
+
+
+# finished renders kept for identical requests; 0 disables the result cache
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+# how long a content_url is assumed to keep pointing at the same content, in seconds
+RESULT_ALIAS_TTL = int(os.environ.get("RESULT_ALIAS_TTL", "600"))
+
+_result_cache = None
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def enabled():
+    return RESULT_CACHE_MAX_BYTES > 0
+
+
+def get_result_cache():
+    global _result_cache
+    if _result_cache is None:
+        _result_cache = DiskLRUCache("results", RESULT_CACHE_MAX_BYTES)
+    return _result_cache
+
+
+def lookup(render_key):
+    """Return the cached output for render_key (request + content/background fingerprints) or None."""
+    return get_result_cache().get(render_key, ".mp4")
+
+
+def lookup_request(request_key):
+    """Return the cached output for a request seen less than RESULT_ALIAS_TTL seconds ago, or None.
+
+    Unlike lookup(), this needs no content download: request_key covers the content_url only.
+    """
+    cache = get_result_cache()
+    p = cache.get(request_key, ".req")
+    if p is None:
+        return None
+    try:
+        with open(p, "r", encoding="utf-8") as fh:
+            alias = json.load(fh)
+    except (OSError, ValueError):
+        return None
+    if time.time() - alias.get("created_at", 0) > RESULT_ALIAS_TTL:
+        return None
+    return lookup(alias["render_key"])
+
+
+def store_alias(request_key, render_key):
+    cache = get_result_cache()
+    tmp = cache.tmp_path(".req")
+    try:
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump({"render_key": render_key, "created_at": time.time()}, fh)
+        cache.put(request_key, tmp, ".req")
+    except OSError:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+def store(render_key, src_path, request_key=None):
+    """Move a finished output into the result cache and return its new path."""
+    cache = get_result_cache()
+    tmp = cache.tmp_path(".mp4")
+    shutil.move(src_path, tmp)
+    path = cache.put(render_key, tmp, ".mp4")
+    if request_key:
+        store_alias(request_key, render_key)
+    return path
+
+
+def is_cached(path):
+    return bool(path) and os.path.dirname(os.path.abspath(path)) == os.path.abspath(get_result_cache().dir)
+
+
+def etag_for(path):
+    """Strong ETag for an output in the result cache (its render key), None for other files."""
+    if not is_cached(path):
+        return None
+    return '"%s"' % os.path.splitext(os.path.basename(path))[0][:32]
+
+
+# how often a caller waiting for another one's result checks its own cancel token (seconds)
+FOLLOWER_POLL_INTERVAL = 0.2
+
+
+def single_flight(key, fn, cancel=None):
+    """Run fn() once for concurrent callers with the same key; the others get its result (or exception).
+
+    cancel: CancelToken of the caller; a caller waiting for another one's result stops
+    waiting (cancellation.Cancelled) as soon as its own token is cancelled.
+    """
+    with _inflight_lock:
+        fut = _inflight.get(key)
+        leader = fut is None
+        if leader:
+            fut = Future()
+            _inflight[key] = fut
+    if not leader:
+        while True:
+            try:
+                return fut.result(timeout=None if cancel is None else FOLLOWER_POLL_INTERVAL)
+            except FutureTimeout:
+                cancel.check()
+    try:
+        result = fn()
+        fut.set_result(result)
+        return result
+    except BaseException as e:
+        fut.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
@@ -1,9 +1,26 @@
 import shutil
+import signal
 import subprocess
 import os
 from PIL import Image, ImageDraw, ImageFont
 import math
+import functools
+import json
+import re
+import struct
+import queue
+import threading
+import time
+import base64
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from html import escape as html_escape
 from io import BytesIO
+
+import metrics
+from cancellation import Cancelled
+from cache_utils import DiskLRUCache, SpillLRUCache, file_fingerprint, make_key
 try:
     from playwright.sync_api import sync_playwright
     _HAS_PLAYWRIGHT = True
@@ -18,83 +35,389 @@ def ensure_ffmpeg_exists():
     return ffmpeg
 
 
-def get_duration(path):
-    """Dapatkan durasi video (detik) menggunakan ffprobe."""
+PROBE_CACHE_SIZE = 256
+_probe_cache = OrderedDict()
+_probe_cache_lock = threading.Lock()
+
+
+def _parse_fps(rate):
+    try:
+        num, den = rate.split("/")
+        return float(num) / float(den) if float(den) else None
+    except (AttributeError, ValueError):
+        return None
+
+
+def _stream_rotation(stream):
+    rotation = 0
+    try:
+        rotation = int(float((stream.get("tags") or {}).get("rotate", 0)))
+    except ValueError:
+        pass
+    for side in stream.get("side_data_list") or []:
+        if "rotation" in side:
+            try:
+                rotation = int(float(side["rotation"]))
+            except (TypeError, ValueError):
+                pass
+    return rotation % 360
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_probe(data):
+    """Turn ffprobe's -show_format -show_streams JSON into the media description used everywhere.
+
+    Keys: duration, format, bit_rate, streams, has_video, has_audio, video, audio.
+    video: codec, width, height (display size, rotation applied), coded_width, coded_height,
+    fps, rotation, pix_fmt, sar. audio: codec, profile, sample_rate, channels, bit_rate.
+    """
+    fmt = data.get("format") or {}
+    streams = data.get("streams") or []
+    info = {
+        "duration": _to_float(fmt.get("duration")),
+        "format": fmt.get("format_name"),
+        "bit_rate": _to_int(fmt.get("bit_rate")),
+        "streams": [
+            {"index": st.get("index"), "codec_type": st.get("codec_type"), "codec_name": st.get("codec_name")}
+            for st in streams
+        ],
+        "video": None,
+        "audio": None,
+    }
+    for st in streams:
+        if st.get("codec_type") == "video" and info["video"] is None:
+            if (st.get("disposition") or {}).get("attached_pic"):
+                # cover art inside an audio file is not a video stream
+                continue
+            w, h = _to_int(st.get("width")), _to_int(st.get("height"))
+            rotation = _stream_rotation(st)
+            dw, dh = (h, w) if rotation in (90, 270) else (w, h)
+            info["video"] = {
+                "codec": st.get("codec_name"),
+                "width": dw,
+                "height": dh,
+                "coded_width": w,
+                "coded_height": h,
+                "fps": _parse_fps(st.get("avg_frame_rate")) or _parse_fps(st.get("r_frame_rate")),
+                "rotation": rotation,
+                "pix_fmt": st.get("pix_fmt"),
+                "sar": st.get("sample_aspect_ratio"),
+                "duration": _to_float(st.get("duration")),
+            }
+        elif st.get("codec_type") == "audio" and info["audio"] is None:
+            info["audio"] = {
+                "codec": st.get("codec_name"),
+                "profile": st.get("profile"),
+                "sample_rate": _to_int(st.get("sample_rate")),
+                "channels": _to_int(st.get("channels")),
+                "bit_rate": _to_int(st.get("bit_rate")),
+            }
+    info["has_video"] = info["video"] is not None and bool(info["video"]["width"])
+    info["has_audio"] = info["audio"] is not None
+    if info["duration"] is None and info["video"] is not None:
+        info["duration"] = info["video"]["duration"]
+    return info
+
+
+def probe_media(path):
+    """Probe a media file once with ffprobe and return its description (see parse_probe).
+
+    Results are cached by file fingerprint, so static backgrounds and a content file that
+    was already validated are never probed again. Raises RuntimeError when ffprobe is
+    missing or cannot read the file.
+    """
     ffprobe = shutil.which("ffprobe")
     if ffprobe is None:
         raise RuntimeError("ffprobe tidak ditemukan. ffprobe biasanya termasuk dalam paket ffmpeg.")
-    cmd = [
-        ffprobe,
-        "-v",
-        "error",
-        "-show_entries",
-        "format=duration",
-        "-of",
-        "default=noprint_wrappers=1:nokey=1",
-        path,
-    ]
-    p = subprocess.run(cmd, capture_output=True, text=True)
+    try:
+        key = file_fingerprint(path)
+    except OSError as e:
+        raise RuntimeError(f"ffprobe error: {e}")
+    with _probe_cache_lock:
+        info = _probe_cache.get(key)
+        if info is not None:
+            _probe_cache.move_to_end(key)
+    metrics.cache_lookup("probe", info is not None)
+    if info is not None:
+        return info
+    cmd = [ffprobe, "-v", "error", "-show_format", "-show_streams", "-of", "json", path]
+    with metrics.span("probe"):
+        p = subprocess.run(cmd, capture_output=True, text=True)
     if p.returncode != 0:
         raise RuntimeError(f"ffprobe error: {p.stderr}")
     try:
-        return float(p.stdout.strip())
-    except:
-        return None
+        info = parse_probe(json.loads(p.stdout or "{}"))
+    except ValueError as e:
+        raise RuntimeError(f"ffprobe error: {e}")
+    with _probe_cache_lock:
+        _probe_cache[key] = info
+        while len(_probe_cache) > PROBE_CACHE_SIZE:
+            _probe_cache.popitem(last=False)
+    return info
 
 
-def make_header_image(text, out_path, width=1080, height=160, bg_color=(245, 237, 221), text_color=(0, 0, 0)):
-    # simple header: rectangle with text centered
-    img = Image.new("RGBA", (width, height), bg_color + (255,))
-    draw = ImageDraw.Draw(img)
-    
-    # choose font (try bold then regular)
+def probe_media_bytes(data):
+    """Probe the first bytes of a media file (ffprobe reading stdin).
+
+    Returns the same description as probe_media, or None when ffprobe is missing or the
+    data cannot be parsed (e.g. an MP4 whose moov atom is at the end of the file).
+    """
+    ffprobe = shutil.which("ffprobe")
+    if ffprobe is None:
+        return None
+    cmd = [ffprobe, "-v", "error", "-show_format", "-show_streams", "-of", "json", "-i", "pipe:0"]
+    with metrics.span("probe"):
+        p = subprocess.run(cmd, input=data, capture_output=True)
+    if p.returncode != 0:
+        return None
     try:
-        # try bold Windows font first
-        font = ImageFont.truetype(os.path.join(os.path.dirname(__file__), "arialbd.ttf"), 56)
-    except Exception:
+        return parse_probe(json.loads(p.stdout or b"{}"))
+    except ValueError:
+        return None
+
+
+def get_duration(path):
+    """Dapatkan durasi video (detik) menggunakan ffprobe."""
+    return probe_media(path)["duration"]
+
+
+FONT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Candidate files per font face, in order of preference. Bundled fonts are resolved
+# relative to this module (never the CWD).
+FONT_CANDIDATES = {
+    "regular": [os.path.join(FONT_DIR, "arial.ttf")],
+    "bold": [os.path.join(FONT_DIR, "arialbd.ttf"), os.path.join(FONT_DIR, "arial.ttf")],
+    "emoji": [
+        "C:/Windows/Fonts/seguiemj.ttf",  # Windows Segoe UI Emoji
+        "C:/Windows/Fonts/msyh.ttc",      # Windows Microsoft YaHei (supports emoji)
+        "/System/Library/Fonts/Apple Color Emoji.ttc",  # macOS
+        "/usr/share/fonts/truetype/noto/NotoColorEmoji.ttf",  # Linux Noto Color Emoji
+        "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",  # Linux DejaVu (partial emoji)
+    ],
+}
+
+_font_paths = None
+_font_paths_lock = threading.Lock()
+
+
+def resolve_fonts():
+    """Return {face: [existing font files]}; the filesystem is only checked on the first call."""
+    global _font_paths
+    with _font_paths_lock:
+        if _font_paths is None:
+            _font_paths = {face: [p for p in paths if os.path.exists(p)] for face, paths in FONT_CANDIDATES.items()}
+        return _font_paths
+
+
+@functools.lru_cache(maxsize=256)
+def get_font(face, size):
+    """Cached font for (face, size). Falls back to Pillow's default font if no file loads."""
+    for font_path in resolve_fonts().get(face, []):
         try:
-            font = ImageFont.truetype(os.path.join(os.path.dirname(__file__), "arial.ttf"), 56)
+            return ImageFont.truetype(font_path, size)
         except Exception:
-            font = ImageFont.load_default()
+            # e.g. bitmap emoji fonts only load at fixed sizes
+            continue
+    return ImageFont.load_default()
+
+
+@functools.lru_cache(maxsize=1)
+def font_versions():
+    """Fingerprints of the resolved font files; part of every overlay cache key."""
+    return tuple((face, tuple(file_fingerprint(p) for p in paths)) for face, paths in sorted(resolve_fonts().items()))
+
+
+# Rendered header/comment overlays, keyed by a hash of every rendering input.
+OVERLAY_CACHE_MEM_BYTES = int(os.environ.get("OVERLAY_CACHE_MEM_BYTES", str(64 * 1024 * 1024)))
+OVERLAY_CACHE_MAX_BYTES = int(os.environ.get("OVERLAY_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+_overlay_cache = None
 
-    def text_size(txt, fnt):
-        # cross-version compatible text size (Pillow >=8: textbbox; older: textsize)
+
+def get_overlay_cache():
+    global _overlay_cache
+    if _overlay_cache is None:
+        _overlay_cache = SpillLRUCache("overlays", OVERLAY_CACHE_MEM_BYTES, OVERLAY_CACHE_MAX_BYTES)
+    return _overlay_cache
+
+
+def png_size(data):
+    """(width, height) from the IHDR chunk of PNG bytes."""
+    return struct.unpack(">II", data[16:24])
+
+
+def _overlay_from_cache(key, out_path):
+    """Write the cached overlay for key to out_path and return its size, or None on a miss."""
+    data = get_overlay_cache().get(key)
+    metrics.cache_lookup("overlay", data is not None)
+    if data is None:
+        return None
+    with open(out_path, "wb") as fh:
+        fh.write(data)
+    return png_size(data)
+
+
+def _save_overlay(img, out_path, key):
+    """Encode img as PNG once, write it to out_path, store it in the overlay cache and return its size."""
+    buf = BytesIO()
+    img.save(buf, format="PNG")
+    data = buf.getvalue()
+    with open(out_path, "wb") as fh:
+        fh.write(data)
+    get_overlay_cache().put(key, data)
+    return img.size
+
+
+def _comments_cache_key(renderer, comments, *params):
+    items = []
+    for c in comments[:2]:
+        avatar_path = c.get("avatar_path")
+        try:
+            avatar = file_fingerprint(avatar_path) if avatar_path else None
+        except OSError:
+            avatar = None
+        items.append((c.get("author", ""), c.get("text", ""), c.get("likes", ""), bool(c.get("highlight")), avatar))
+    return make_key("comments", renderer, items, params, font_versions())
+
+
+@functools.lru_cache(maxsize=16384)
+def _text_metrics(font, text):
+    """(advance, ink_left, ink_right, ink_height) of a single-line string, cached per (font, text)."""
+    try:
+        x0, y0, x1, y1 = font.getbbox(text)
+    except Exception:
         try:
-            bbox = draw.textbbox((0, 0), txt, font=fnt)
-            return (bbox[2] - bbox[0], bbox[3] - bbox[1])
+            w, h = font.getsize(text)
         except Exception:
-            try:
-                return draw.textsize(txt, font=fnt)
-            except Exception:
-                try:
-                    return fnt.getsize(txt)
-                except Exception:
-                    return (0, 0)
+            w, h = (0, 0)
+        x0, y0, x1, y1 = 0, 0, w, h
+    try:
+        adv = font.getlength(text)
+    except Exception:
+        adv = x1
+    return adv, x0, x1, y1 - y0
 
-    # wrap text if needed
-    max_width = width - 40
-    lines = []
+
+def measure_text(font, text):
+    """Cached (width, height) of the ink box of text; same numbers as ImageDraw.textbbox at (0, 0)."""
+    _, x0, x1, h = _text_metrics(font, text)
+    return (x1 - x0, h)
+
+
+def _longest_fitting_prefix(text, font, max_width, suffix=""):
+    """Length of the longest prefix of text whose ink width (with suffix) fits max_width (binary search)."""
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if measure_text(font, text[:mid] + suffix)[0] <= max_width:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def wrap_text(text, font, max_width, max_lines=None, ellipsis="..."):
+    """Greedy word wrap: return the lines of text whose ink width fits max_width.
+
+    Each word is measured once (metrics are cached) and line widths are estimated from
+    word advances, so wrapping is linear in the text length; only a word that lands near
+    the edge is checked by measuring the whole line, so kerning across the joins cannot
+    move a break and the breaks are those of measuring every line. A word wider than a
+    whole line is broken at the longest fitting prefix (binary search). If the text
+    needs more than max_lines lines, the last kept line is truncated to end in ellipsis.
+    """
     words = text.split()
+    if not words:
+        return [""]
+    space_adv = _text_metrics(font, " ")[0]
+    lines = []
     cur = ""
+    cur_left = 0  # ink left bearing of the first word of cur
+    cur_next = 0  # pen position where the next word would start (after a space)
+    joins = 0  # words joined onto the first one of cur; each may shift the estimate by its kerning
+
     for w in words:
-        test = (cur + " " + w).strip()
-        if text_size(test, font)[0] <= max_width:
-            cur = test
-        else:
+        if max_lines is not None and len(lines) > max_lines:
+            break
+        adv, x0, x1, _ = _text_metrics(font, w)
+        if cur:
+            estimate = cur_next + x1 - cur_left
+            if abs(estimate - max_width) <= (joins + 1) * space_adv:
+                fits = measure_text(font, cur + " " + w)[0] <= max_width
+            else:
+                fits = estimate <= max_width
+            if fits:
+                cur = cur + " " + w
+                cur_next += adv + space_adv
+                joins += 1
+                continue
+        if cur:
             lines.append(cur)
-            cur = w
+        if x1 - x0 > max_width:
+            # word is too long for a line of its own: break it into fitting chunks
+            while len(w) > 1 and measure_text(font, w)[0] > max_width:
+                n = max(1, _longest_fitting_prefix(w, font, max_width))
+                lines.append(w[:n])
+                w = w[n:]
+                if max_lines is not None and len(lines) > max_lines:
+                    break
+            adv, x0, x1, _ = _text_metrics(font, w)
+        cur = w
+        cur_left = x0
+        cur_next = adv + space_adv
+        joins = 0
     if cur:
         lines.append(cur)
 
-    total_h = sum(text_size(l, font)[1] for l in lines)
+    if max_lines is not None and len(lines) > max_lines:
+        lines = lines[:max_lines]
+        last = lines[-1]
+        if ellipsis and not last.endswith(ellipsis):
+            n = _longest_fitting_prefix(last, font, max_width, suffix=ellipsis)
+            lines[-1] = last[:n].rstrip() + ellipsis
+    return lines
+
+
+def make_header_image(text, out_path, width=1080, height=160, bg_color=(245, 237, 221), text_color=(0, 0, 0)):
+    """Render the header overlay to out_path and return its (width, height); cached by all inputs."""
+    key = make_key("header", text, width, height, bg_color, text_color, font_versions())
+    size = _overlay_from_cache(key, out_path)
+    if size is not None:
+        return size
+
+    # simple header: rectangle with text centered
+    img = Image.new("RGBA", (width, height), bg_color + (255,))
+    draw = ImageDraw.Draw(img)
+    
+    # choose font (bold, falls back to regular)
+    font = get_font("bold", 56)
+
+    # wrap text if needed
+    max_width = width - 40
+    lines = wrap_text(text, font, max_width) if text.strip() else []
+
+    total_h = sum(measure_text(font, l)[1] for l in lines)
     y = (height - total_h) // 2
     for l in lines:
-        w, h = text_size(l, font)
+        w, h = measure_text(font, l)
         x = (width - w) // 2
         draw.text((x, y), l, font=font, fill=text_color)
         y += h
 
-    img.save(out_path)
+    return _save_overlay(img, out_path, key)
 
 
 def round_rect(draw, xy, radius, fill):
@@ -108,54 +431,26 @@ def make_comment_image(author, text, likes, out_path, width=460, height=220, bg=
     # rounded background
     round_rect(draw, (0, 0, width, height), radius=16, fill=bg)
 
-    try:
-           name_font = ImageFont.truetype(os.path.join(os.path.dirname(__file__), "arialbd.ttf"), 28)
-           text_font = ImageFont.truetype(os.path.join(os.path.dirname(__file__), "arial.ttf"), 22)
-    except Exception:
-        name_font = ImageFont.load_default()
-        text_font = ImageFont.load_default()
-
-    def text_size_comment(txt, fnt):
-        try:
-            bbox = draw.textbbox((0, 0), txt, font=fnt)
-            return (bbox[2] - bbox[0], bbox[3] - bbox[1])
-        except Exception:
-            try:
-                return draw.textsize(txt, font=fnt)
-            except Exception:
-                try:
-                    return fnt.getsize(txt)
-                except Exception:
-                    return (0, 0)
+    name_font = get_font("bold", 28)
+    text_font = get_font("regular", 22)
 
     padding = 14
     x = padding
     y = padding
     draw.text((x, y), author, font=name_font, fill=(0,0,0))
-    y += text_size_comment(author, name_font)[1] + 6
+    y += measure_text(name_font, author)[1] + 6
 
     # wrap comment text
     max_w = width - padding*2
-    lines = []
-    words = text.split()
-    cur = ""
-    for w in words:
-        test = (cur + " " + w).strip()
-        if text_size_comment(test, text_font)[0] <= max_w:
-            cur = test
-        else:
-            lines.append(cur)
-            cur = w
-    if cur:
-        lines.append(cur)
+    lines = wrap_text(text, text_font, max_w, max_lines=6)
 
-    for l in lines[:6]:  # limit lines
+    for l in lines:
         draw.text((x, y), l, font=text_font, fill=(20,20,20))
-        y += text_size_comment(l, text_font)[1] + 4
+        y += measure_text(text_font, l)[1] + 4
 
     # likes at bottom-right
     likes_text = f"{likes}"
-    lw, lh = text_size_comment(likes_text, text_font)
+    lw, lh = measure_text(text_font, likes_text)
     draw.text((width - lw - padding, height - lh - padding), likes_text, font=text_font, fill=(100,100,100))
 
     img.save(out_path)
@@ -163,119 +458,118 @@ def make_comment_image(author, text, likes, out_path, width=460, height=220, bg=
 
 def get_emoji_font(size=24):
     """Try to get a font that supports emoji. Falls back to default if not available."""
-    # Try common emoji-supporting fonts (order matters)
-    emoji_font_paths = [
-        "C:/Windows/Fonts/seguiemj.ttf",  # Windows Segoe UI Emoji
-        "C:/Windows/Fonts/msyh.ttc",      # Windows Microsoft YaHei (supports emoji)
-        "/System/Library/Fonts/Apple Color Emoji.ttc",  # macOS
-        "/usr/share/fonts/truetype/noto/NotoColorEmoji.ttf",  # Linux Noto Color Emoji
-        "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",  # Linux DejaVu (partial emoji)
-    ]
-    for font_path in emoji_font_paths:
-        if os.path.exists(font_path):
-            try:
-                return ImageFont.truetype(font_path, size)
-            except Exception:
-                continue
-    # Fallback to default font
-    return ImageFont.load_default()
-
-
-def is_emoji(char):
-    """Check if a character is an emoji."""
-    # Simple emoji detection - covers most common emoji ranges
-    code = ord(char)
-    return (
-        (0x1F600 <= code <= 0x1F64F) or  # Emoticons
-        (0x1F300 <= code <= 0x1F5FF) or  # Misc Symbols and Pictographs
-        (0x1F680 <= code <= 0x1F6FF) or  # Transport and Map
-        (0x1F1E0 <= code <= 0x1F1FF) or  # Regional indicators
-        (0x2600 <= code <= 0x26FF) or    # Misc symbols
-        (0x2700 <= code <= 0x27BF) or    # Dingbats
-        (0xFE00 <= code <= 0xFE0F) or    # Variation Selectors
-        (0x1F900 <= code <= 0x1F9FF) or  # Supplemental Symbols
-        (0x1FA00 <= code <= 0x1FAFF)     # Chess Symbols and Extended
-    )
+    return get_font("emoji", size)
+
+
+# Code points drawn with the emoji font (the common emoji blocks plus a few symbols
+# outside them), compiled once into a regex that matches whole emoji clusters:
+# skin tone modifiers, variation selectors, keycaps and ZWJ sequences stay in one run.
+_EMOJI_BASE = (
+    "\U0001F600-\U0001F64F"  # Emoticons
+    "\U0001F300-\U0001F5FF"  # Misc Symbols and Pictographs
+    "\U0001F680-\U0001F6FF"  # Transport and Map
+    "\U0001F1E0-\U0001F1FF"  # Regional indicators
+    "\u2600-\u26FF"          # Misc symbols
+    "\u2700-\u27BF"          # Dingbats
+    "\uFE00-\uFE0F"          # Variation Selectors
+    "\U0001F900-\U0001F9FF"  # Supplemental Symbols
+    "\U0001FA00-\U0001FAFF"  # Chess Symbols and Extended
+    "\u203C\u2049\u2B50\u2B55\u2B1B\u2B1C\u2B05-\u2B07"  # !!, ?!, stars, circles, squares, arrows
+)
+_EMOJI_MODIFIER = "[\uFE0E\uFE0F\U0001F3FB-\U0001F3FF]"
+_EMOJI_CLUSTER = (
+    f"(?:[0-9#*]\uFE0F?\u20E3"  # keycap
+    f"|[{_EMOJI_BASE}]{_EMOJI_MODIFIER}*(?:\u200D[{_EMOJI_BASE}]{_EMOJI_MODIFIER}*)*)"
+)
+_EMOJI_RUN_RE = re.compile(f"(?:{_EMOJI_CLUSTER})+")
+
+
+@functools.lru_cache(maxsize=4096)
+def segment_emoji_runs(text):
+    """Split text into [(is_emoji, run), ...] alternating between plain text and emoji runs."""
+    runs = []
+    pos = 0
+    for m in _EMOJI_RUN_RE.finditer(text):
+        if m.start() > pos:
+            runs.append((False, text[pos:m.start()]))
+        runs.append((True, m.group()))
+        pos = m.end()
+    if pos < len(text):
+        runs.append((False, text[pos:]))
+    return tuple(runs)
 
 
 def draw_text_with_emoji(draw, position, text, text_font, emoji_font, fill=(0,0,0)):
     """Draw text with proper emoji rendering using composite font.
     Uses text_font for regular text and emoji_font for emoji characters.
+    The text is segmented into font runs once; each run is a single draw call.
     """
     x, y = position
-    current_x = x
-    
-    # Render character by character or word by word, using appropriate font for each
-    i = 0
-    while i < len(text):
-        char = text[i]
-        
-        # Check if this is an emoji (could be multi-byte)
-        # Handle emoji sequences (some emojis are 2-char sequences)
-        emoji_char = char
-        emoji_len = 1
-        
-        # Check if next character is part of emoji sequence (variation selector, skin tone, etc)
-        if i + 1 < len(text):
-            next_char = text[i + 1]
-            if ord(next_char) in (0xFE00, 0xFE0F) or (0x1F3FB <= ord(next_char) <= 0x1F3FF):
-                emoji_char = char + next_char
-                emoji_len = 2
-        
-        if is_emoji(char):
-            # Render emoji with emoji font
+    for emoji_run, run in segment_emoji_runs(text):
+        font = emoji_font if emoji_run else text_font
+        try:
+            draw.text((x, y), run, font=font, fill=fill)
+        except Exception:
+            if not emoji_run:
+                continue
+            # Fallback to text font if emoji font fails
+            font = text_font
             try:
-                draw.text((current_x, y), emoji_char, font=emoji_font, fill=fill)
-                # Get width of emoji
-                try:
-                    bbox = draw.textbbox((0, 0), emoji_char, font=emoji_font)
-                    char_width = bbox[2] - bbox[0]
-                except:
-                    try:
-                        char_width = emoji_font.getlength(emoji_char)
-                    except:
-                        char_width = text_font.getlength(emoji_char)
-                current_x += char_width
-                i += emoji_len - 1  # Skip processed characters
+                draw.text((x, y), run, font=font, fill=fill)
             except Exception:
-                # Fallback to text font if emoji font fails
-                try:
-                    draw.text((current_x, y), emoji_char, font=text_font, fill=fill)
-                    try:
-                        bbox = draw.textbbox((0, 0), emoji_char, font=text_font)
-                        char_width = bbox[2] - bbox[0]
-                    except:
-                        char_width = text_font.getlength(emoji_char)
-                    current_x += char_width
-                    i += emoji_len - 1
-                except:
-                    # Last resort: skip character
-                    i += emoji_len
-        else:
-            # Render regular text with text font
-            # Find the end of the current word/sequence (non-emoji sequence)
-            end = i + 1
-            while end < len(text) and not is_emoji(text[end]):
-                end += 1
-            
-            word = text[i:end]
-            if word:
-                try:
-                    draw.text((current_x, y), word, font=text_font, fill=fill)
-                    try:
-                        bbox = draw.textbbox((0, 0), word, font=text_font)
-                        word_width = bbox[2] - bbox[0]
-                    except:
-                        try:
-                            word_width = text_font.getlength(word)
-                        except:
-                            word_width = len(word) * 10  # Fallback estimate
-                    current_x += word_width
-                except:
-                    pass
-            i = end
-        
-        i += 1
+                # Last resort: skip the run
+                continue
+        x += _text_metrics(font, run)[0]
+
+
+AVATAR_THUMB_CACHE_SIZE = 512
+_avatar_thumbs = OrderedDict()
+_avatar_thumbs_lock = threading.Lock()
+
+
+def get_avatar_thumbnail(avatar_path, diameter):
+    """Circular RGBA thumbnail of the avatar at avatar_path, or None if it cannot be loaded.
+
+    Thumbnails are cached per (content fingerprint, diameter), so a repeat avatar costs a
+    small read and a dictionary lookup instead of decode + LANCZOS resize + masking. The
+    fingerprint, unlike the mtime, is not changed by the avatar cache marking a hit as used.
+    """
+    if not avatar_path:
+        return None
+    try:
+        key = (file_fingerprint(avatar_path), diameter)
+    except OSError:
+        return None
+    with _avatar_thumbs_lock:
+        thumb = _avatar_thumbs.get(key)
+        if thumb is not None:
+            _avatar_thumbs.move_to_end(key)
+            return thumb
+    try:
+        avatar_img = Image.open(avatar_path)
+        # Convert to RGBA if needed
+        if avatar_img.mode != "RGBA":
+            avatar_img = avatar_img.convert("RGBA")
+        # Resize to square
+        avatar_img = avatar_img.resize((diameter, diameter), Image.LANCZOS)
+    except Exception as e:
+        print(f"Warning: Gagal load avatar: {e}")
+        return None
+    # Apply circular mask
+    avatar_img.putalpha(_circle_mask(diameter))
+    with _avatar_thumbs_lock:
+        _avatar_thumbs[key] = avatar_img
+        while len(_avatar_thumbs) > AVATAR_THUMB_CACHE_SIZE:
+            _avatar_thumbs.popitem(last=False)
+    return avatar_img
+
+
+@functools.lru_cache(maxsize=32)
+def _circle_mask(diameter):
+    mask = Image.new("L", (diameter, diameter), 0)
+    mask_draw = ImageDraw.Draw(mask)
+    mask_draw.ellipse((0, 0, diameter, diameter), fill=255)
+    return mask
 
 
 def make_comments_image(comments, out_path, width=972, padding=14, bg=(255,255,255,255), scale=1.5, tmpdir=None):
@@ -283,7 +577,13 @@ def make_comments_image(comments, out_path, width=972, padding=14, bg=(255,255,2
     comments: list of dicts with keys 'author','text','likes','avatar_path'
     scale: scale factor to apply to all geometry and typography (1.0 = native, 1.5 = 150%)
     tmpdir: temporary directory for avatar files (optional)
+    Returns the (width, height) of the image; results are cached by all rendering inputs.
     """
+    key = _comments_cache_key("pil", comments, width, padding, bg, float(scale))
+    size = _overlay_from_cache(key, out_path)
+    if size is not None:
+        return size
+
     s = float(scale)
 
     # scaled font sizes
@@ -291,32 +591,11 @@ def make_comments_image(comments, out_path, width=972, padding=14, bg=(255,255,2
     handle_fs = max(8, int(20 * s))
     text_fs = max(10, int(22 * s))
     
-    # Try to get fonts with emoji support
-    emoji_font = get_emoji_font()
-    try:
-        name_font = ImageFont.truetype("arialbd.ttf", name_fs)
-        handle_font = ImageFont.truetype("arial.ttf", handle_fs)
-        text_font = ImageFont.truetype("arial.ttf", text_fs)
-    except Exception:
-        name_font = ImageFont.load_default()
-        handle_font = ImageFont.load_default()
-        text_font = ImageFont.load_default()
-
-    # compute per-comment height by measuring wrapped text
-    draw_dummy = ImageDraw.Draw(Image.new("RGBA", (10,10)))
-
-    def text_size_local(txt, fnt):
-        try:
-            bbox = draw_dummy.textbbox((0,0), txt, font=fnt)
-            return (bbox[2]-bbox[0], bbox[3]-bbox[1])
-        except Exception:
-            try:
-                return draw_dummy.textsize(txt, font=fnt)
-            except Exception:
-                try:
-                    return fnt.getsize(txt)
-                except Exception:
-                    return (0,0)
+    name_font = get_font("bold", name_fs)
+    handle_font = get_font("regular", handle_fs)
+    text_font = get_font("regular", text_fs)
+    # emoji font matching the text font size
+    emoji_font_scaled = get_emoji_font(int(22 * s))
 
     per_comment_heights = []
     wrapped_texts = []
@@ -338,79 +617,12 @@ def make_comments_image(comments, out_path, width=972, padding=14, bg=(255,255,2
     MAX_TEXT_LINES = 3  # Maksimal 3 baris untuk text komentar
     
     for c in comments[:2]:
-        full_text = c.get("text", "")
-        
-        # Always wrap text to fit within text_area_width
-        # Split text into words and wrap them
-        lines = []
-        words = full_text.split() if full_text else []
-        
-        if words:
-            cur = ""
-            for w in words:
-                # Jika sudah mencapai maksimal 3 baris, stop wrapping
-                if len(lines) >= MAX_TEXT_LINES:
-                    break
-                
-                test = (cur + " " + w).strip() if cur else w
-                # Measure text width (try to account for emoji)
-                test_w = text_size_local(test, text_font)[0]
-                # Add some buffer for emoji (they might be wider)
-                if test_w <= text_area_width * 0.95:  # 95% to leave some buffer
-                    cur = test
-                else:
-                    if cur:
-                        lines.append(cur)
-                        if len(lines) >= MAX_TEXT_LINES:
-                            break
-                    # If single word is too long, split it (for very long words)
-                    if text_size_local(w, text_font)[0] > text_area_width * 0.95:
-                        # Word is too long, try to split it character by character
-                        word_cur = ""
-                        for char in w:
-                            if len(lines) >= MAX_TEXT_LINES:
-                                break
-                            word_test = word_cur + char
-                            if text_size_local(word_test, text_font)[0] <= text_area_width * 0.95:
-                                word_cur = word_test
-                            else:
-                                if word_cur:
-                                    lines.append(word_cur)
-                                    if len(lines) >= MAX_TEXT_LINES:
-                                        break
-                                word_cur = char
-                        cur = word_cur
-                        if len(lines) >= MAX_TEXT_LINES:
-                            break
-                    else:
-                        cur = w
-            
-            # Add current line if we haven't reached max lines
-            if cur:
-                if len(lines) < MAX_TEXT_LINES:
-                    # Masih ada slot, tambahkan baris baru
-                    lines.append(cur)
-                elif len(lines) == MAX_TEXT_LINES:
-                    # Sudah mencapai max, append ke baris terakhir dengan ellipsis jika perlu
-                    # Tapi jika cur terlalu panjang, kita skip saja (tidak perlu ellipsis di baris terakhir)
-                    # Atau kita bisa tambahkan ellipsis ke baris terakhir yang sudah ada
-                    last_line = lines[-1] if lines else ""
-                    # Cek apakah baris terakhir perlu ellipsis
-                    if last_line and not last_line.endswith("..."):
-                        # Tambahkan ellipsis ke baris terakhir jika masih ada space
-                        ellipsis = "..."
-                        test_line = last_line + ellipsis
-                        if text_size_local(test_line, text_font)[0] <= text_area_width * 0.95:
-                            lines[-1] = test_line
-        else:
-            lines = [""]
-        
-        # Pastikan maksimal 3 baris (safety check)
-        lines = lines[:MAX_TEXT_LINES]
+        # wrap to the text area (95% to leave some buffer for emoji), max 3 lines with ellipsis
+        lines = wrap_text(c.get("text", "") or "", text_font, text_area_width * 0.95, max_lines=MAX_TEXT_LINES)
 
         wrapped_texts.append(lines)
-        header_h = text_size_local(c.get("author",""), name_font)[1]
-        text_h = sum(text_size_local(l, text_font)[1] + line_spacing_unit for l in lines)
+        header_h = measure_text(name_font, c.get("author",""))[1]
+        text_h = sum(measure_text(text_font, l)[1] + line_spacing_unit for l in lines)
         comment_h = pad*2 + header_h + name_text_gap + text_h
         if comment_h < int(100 * s):
             comment_h = int(100 * s)
@@ -430,32 +642,14 @@ def make_comments_image(comments, out_path, width=972, padding=14, bg=(255,255,2
         av_y = y
         # av_d already scaled above
         
-        # Load avatar image if provided
-        avatar_img = None
-        avatar_path = c.get("avatar_path")
-        if avatar_path and os.path.exists(avatar_path):
-            try:
-                avatar_img = Image.open(avatar_path)
-                # Convert to RGBA if needed
-                if avatar_img.mode != "RGBA":
-                    avatar_img = avatar_img.convert("RGBA")
-                # Resize to square
-                avatar_img = avatar_img.resize((av_d, av_d), Image.LANCZOS)
-            except Exception as e:
-                print(f"Warning: Gagal load avatar: {e}")
-                avatar_img = None
+        # Load avatar thumbnail (already resized and masked) if provided
+        avatar_img = get_avatar_thumbnail(c.get("avatar_path"), av_d)
         
         # Draw avatar background / placeholder
         draw.ellipse((av_x, av_y, av_x+av_d, av_y+av_d), fill=(230,230,230))
         
-        # Draw avatar image if available (create circular mask)
+        # Draw avatar image if available
         if avatar_img:
-            # Create circular mask
-            mask = Image.new("L", (av_d, av_d), 0)
-            mask_draw = ImageDraw.Draw(mask)
-            mask_draw.ellipse((0, 0, av_d, av_d), fill=255)
-            # Apply mask to avatar
-            avatar_img.putalpha(mask)
             # Paste avatar onto main image
             img.paste(avatar_img, (av_x, av_y), avatar_img)
         
@@ -467,21 +661,20 @@ def make_comments_image(comments, out_path, width=972, padding=14, bg=(255,255,2
         name_x = av_x + av_d + int(12 * s)
         name_y = y
         draw.text((name_x, name_y), c.get("author",""), font=name_font, fill=(0,0,0))
-        name_h = text_size_local(c.get("author",""), name_font)[1]
+        name_h = measure_text(name_font, c.get("author",""))[1]
 
         # comment text (increased gap after name and line spacing) with emoji support
         tx = name_x
         ty = name_y + name_h + int(12 * s)
-        emoji_font_scaled = get_emoji_font(int(22 * s))  # Match text font size
         for line in wrapped_texts[idx]:
             # Render text with proper emoji support
             draw_text_with_emoji(draw, (tx, ty), line, text_font, emoji_font_scaled, fill=(20,20,20))
-            ty += text_size_local(line, text_font)[1] + int(8 * s)
+            ty += measure_text(text_font, line)[1] + int(8 * s)
 
         # bottom row: show only likes (heart + count) aligned to the right
         bottom_y = y + per_comment_heights[idx] - int(24 * s)
         likes = c.get("likes", "")
-        lw, lh = text_size_local(str(likes), handle_font)
+        lw, lh = measure_text(handle_font, str(likes))
         heart_size = int(18 * s)
         right_x = img_width - lw - heart_size - pad - int(6 * s)
 
@@ -509,39 +702,228 @@ def make_comments_image(comments, out_path, width=972, padding=14, bg=(255,255,2
             # divider
             draw.line((pad, y-int(4 * s), img_width-pad, y-int(4 * s)), fill=(230,230,230), width=max(1, int(1 * s)))
 
-    img.save(out_path)
+    return _save_overlay(img, out_path, key)
+
+
+# Tailwind utilities used by the comments template, precompiled so rendering needs no
+# network access (the CDN script used to be fetched and JIT-compiled on every call).
+_COMMENTS_CSS = """
+*, ::before, ::after { box-sizing: border-box; border: 0 solid #e5e7eb; }
+html, body { margin: 0; padding: 0; background: transparent; }
+body { font-family: ui-sans-serif, system-ui, sans-serif, "Apple Color Emoji", "Segoe UI Emoji", "Segoe UI Symbol", "Noto Color Emoji"; line-height: 1.5; }
+img, svg { display: block; vertical-align: middle; }
+.card { width: 390px; background: #fff; border-radius: 0.75rem; overflow: hidden; border-width: 1px; border-color: #e5e7eb;
+        box-shadow: 0 10px 15px -3px rgb(0 0 0 / 0.1), 0 4px 6px -4px rgb(0 0 0 / 0.1); }
+.p-4 { padding: 1rem; }
+.border-b { border-bottom-width: 1px; }
+.border-gray-100 { border-color: #f3f4f6; }
+.flex { display: flex; }
+.items-start { align-items: flex-start; }
+.items-center { align-items: center; }
+.justify-end { justify-content: flex-end; }
+.space-x-3 > * + * { margin-left: 0.75rem; }
+.space-x-2 > * + * { margin-left: 0.5rem; }
+.avatar { width: 2.5rem; height: 2.5rem; border-radius: 9999px; flex-shrink: 0; background: #e5e7eb; object-fit: cover; }
+.border-2 { border-width: 2px; }
+.border-sky-400 { border-color: #38bdf8; }
+.flex-1 { flex: 1 1 0%; }
+.font-semibold { font-weight: 600; }
+.text-sm { font-size: 0.875rem; line-height: 1.25rem; }
+.text-15 { font-size: 15px; }
+.leading-snug { line-height: 1.375; }
+.mt-05 { margin-top: 0.125rem; }
+.mt-2 { margin-top: 0.5rem; }
+.text-gray-500 { color: #6b7280; }
+.text-gray-400 { color: #9ca3af; }
+.text-gray-700 { color: #374151; }
+.w-5 { width: 1.25rem; }
+.h-5 { height: 1.25rem; }
+"""
 
+# number of warm Chromium pages (one browser per worker thread) = renders in flight
+HTML_RENDER_PAGES = int(os.environ.get("HTML_RENDER_PAGES", "2"))
+HTML_RENDER_TIMEOUT = float(os.environ.get("HTML_RENDER_TIMEOUT", "30"))
 
-def make_comments_image_html(comments, out_path, width=972, scale=1.5):
+
+class _BrowserWorker(threading.Thread):
+    """Thread owning one long-lived headless Chromium and page.
+
+    Playwright's sync API objects may only be used from the thread that created them,
+    so each worker keeps its own browser and serves render tasks from the shared queue.
+    """
+
+    def __init__(self, tasks):
+        super().__init__(daemon=True, name="html-render")
+        self.tasks = tasks
+        self.pw = None
+        self.browser = None
+        self.page = None
+
+    def _ensure_page(self):
+        if self.page is not None and not self.page.is_closed():
+            return self.page
+        if self.pw is None:
+            self.pw = sync_playwright().start()
+        if self.browser is None or not self.browser.is_connected():
+            self.browser = self.pw.chromium.launch()
+        self.page = self.browser.new_page(viewport={"width": 972, "height": 800})
+        return self.page
+
+    def _close(self):
+        try:
+            if self.browser is not None:
+                self.browser.close()
+        except Exception:
+            pass
+        try:
+            if self.pw is not None:
+                self.pw.stop()
+        except Exception:
+            pass
+        self.pw = self.browser = self.page = None
+
+    def run(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                self._close()
+                return
+            fut, abandoned, html, out_path, width = task
+            if not fut.set_running_or_notify_cancel():
+                continue
+            # screenshot into a private file: a caller that gave up may already have written
+            # out_path with the PIL fallback
+            tmp_path = f"{out_path}.{uuid.uuid4().hex}.png"
+            try:
+                page = self._ensure_page()
+                page.set_viewport_size({"width": width, "height": 800})
+                page.set_content(html, wait_until="load")
+                page.locator(".card").screenshot(path=tmp_path, omit_background=True)
+                with _html_commit_lock:
+                    if abandoned.is_set():
+                        os.remove(tmp_path)
+                        fut.set_exception(FutureTimeout())
+                    else:
+                        os.replace(tmp_path, out_path)
+                        fut.set_result(out_path)
+            except Exception as e:
+                # start from a fresh browser next time, the current one may be broken
+                self._close()
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                fut.set_exception(e)
+
+
+_html_tasks = queue.Queue()
+_html_workers = []
+_html_workers_lock = threading.Lock()
+# orders a worker publishing its screenshot against the caller giving up on it
+_html_commit_lock = threading.Lock()
+
+
+def _abandon_html_task(fut, abandoned):
+    """Give up on a render task so a late screenshot is discarded; False if it finished first."""
+    with _html_commit_lock:
+        if fut.done() and not fut.cancelled():
+            return False
+        abandoned.set()
+        fut.cancel()
+        return True
+
+
+def _render_html_to_png(html, out_path, width, cancel=None):
+    with _html_workers_lock:
+        _html_workers[:] = [w for w in _html_workers if w.is_alive()]
+        while len(_html_workers) < HTML_RENDER_PAGES:
+            w = _BrowserWorker(_html_tasks)
+            w.start()
+            _html_workers.append(w)
+    fut = Future()
+    abandoned = threading.Event()
+    _html_tasks.put((fut, abandoned, html, out_path, width))
+    if cancel is None:
+        try:
+            return fut.result(timeout=HTML_RENDER_TIMEOUT)
+        except FutureTimeout:
+            if not _abandon_html_task(fut, abandoned):
+                return fut.result()
+            raise
+    # a page cannot be closed from this thread: on cancel a task still queued is dropped and
+    # the caller returns at once, a screenshot in progress finishes in its browser worker
+    # (and is discarded)
+    deadline = time.monotonic() + HTML_RENDER_TIMEOUT
+    while True:
+        try:
+            return fut.result(timeout=min(0.2, max(0.0, deadline - time.monotonic())))
+        except FutureTimeout:
+            if cancel.cancelled or time.monotonic() >= deadline:
+                if not _abandon_html_task(fut, abandoned):
+                    return fut.result()
+                cancel.check()
+                raise
+
+
+def close_html_renderer():
+    """Stop the warm browser pool (call on application shutdown)."""
+    with _html_workers_lock:
+        for _ in _html_workers:
+            _html_tasks.put(None)
+        _html_workers.clear()
+
+
+def _avatar_data_uri(path):
+    """Inline a downloaded avatar as a data: URI so the page never fetches it."""
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with open(path, "rb") as fh:
+            data = fh.read()
+        mime = Image.MIME.get(Image.open(BytesIO(data)).format, "image/png")
+        return f"data:{mime};base64," + base64.b64encode(data).decode("ascii")
+    except Exception:
+        return None
+
+
+def make_comments_image_html(comments, out_path, width=972, scale=1.5, cancel=None):
     """Render the exact HTML/Tailwind template using Playwright (headless Chromium) and save as PNG.
     Falls back to make_comments_image if Playwright not available.
     scale: final scale factor to apply to the resulting PNG (if Playwright used, image will be resized)
+    Uses a warm browser pool and inlined CSS/avatars, so no browser start-up or network per call.
+    cancel: optional CancelToken (see cancellation.py); raises Cancelled instead of waiting for the page.
     """
     if not _HAS_PLAYWRIGHT:
         # fallback (pass scale to PIL renderer)
         return make_comments_image(comments, out_path, width=width, scale=scale)
 
+    key = _comments_cache_key("html", comments, width, float(scale))
+    size = _overlay_from_cache(key, out_path)
+    if size is not None:
+        return size
+
     # build HTML using the provided template structure
-    # simple inline Tailwind from CDN is used
     html_comments = ""
     for idx, c in enumerate(comments[:2]):
         border = "border-b border-gray-100" if idx == 0 else ""
         highlight_border = "border-2 border-sky-400" if c.get("highlight") else ""
-        # Use avatar_url if provided, otherwise use placeholder
-        avatar_src = c.get("avatar_url") or "https://via.placeholder.com/40"
+        # Use the downloaded avatar if available, otherwise a grey placeholder circle
+        avatar_src = _avatar_data_uri(c.get("avatar_path"))
+        if avatar_src:
+            avatar_html = f'<img src="{avatar_src}" class="avatar {highlight_border}" alt="profile">'
+        else:
+            avatar_html = f'<div class="avatar {highlight_border}"></div>'
         html_comments += f'''
         <div class="p-4 {border}">
             <div class="flex items-start space-x-3">
-                <img src="{avatar_src}" class="w-10 h-10 rounded-full {highlight_border}" alt="profile" onerror="this.src='https://via.placeholder.com/40'">
+                {avatar_html}
                 <div class="flex-1">
-                    <div class="font-semibold text-sm">{c.get('author','')}</div>
-                    <div class="text-[15px] leading-snug mt-0.5 {'font-semibold' if c.get('highlight') else ''}">{c.get('text','')}</div>
+                    <div class="font-semibold text-sm">{html_escape(str(c.get('author','')))}</div>
+                    <div class="text-15 leading-snug mt-05 {'font-semibold' if c.get('highlight') else ''}">{html_escape(str(c.get('text','')))}</div>
                     <div class="flex justify-end items-center mt-2">
                         <div class="flex items-center space-x-2 text-gray-500">
                             <svg xmlns="http://www.w3.org/2000/svg" class="w-5 h-5 text-gray-400" fill="currentColor" viewBox="0 0 24 24">
                                 <path d="M12 21.35l-1.45-1.32C5.4 15.36 2 12.28 2 8.5 2 6 3.99 4 6.5 4c1.74 0 3.41 1.01 4.13 2.44h.75C13.09 5.01 14.76 4 16.5 4 19.01 4 21 6 21 8.5c0 3.78-3.4 6.86-8.55 11.54L12 21.35z"/>
                             </svg>
-                            <span class="text-sm text-gray-700">{c.get('likes','')}</span>
+                            <span class="text-sm text-gray-700">{html_escape(str(c.get('likes','')))}</span>
                         </div>
                     </div>
                 </div>
@@ -549,150 +931,483 @@ def make_comments_image_html(comments, out_path, width=972, scale=1.5):
         </div>
 '''
 
-        html = f"""
+    html = f"""
 <!doctype html>
 <html>
 <head>
     <meta charset="utf-8">
     <meta name="viewport" content="width=device-width, initial-scale=1">
-    <script src="https://cdn.tailwindcss.com"></script>
-    <style> body {{ margin:0; padding:0; background:transparent; }} </style>
+    <style>{_COMMENTS_CSS}</style>
 </head>
 <body>
-    <div class="w-[390px] bg-white min-h-screen shadow-lg rounded-xl overflow-hidden border border-gray-200">
+    <div class="card">
         {html_comments}
     </div>
 </body>
 </html>
 """
 
-        # render with playwright
-        with sync_playwright() as p:
-                browser = p.chromium.launch()
-                page = browser.new_page(viewport={"width": width, "height": 800})
-                page.set_content(html, wait_until="networkidle")
-                # get height
-                height = page.evaluate('document.querySelector(".w-[390px]").scrollHeight')
-                page.set_viewport_size({"width": width, "height": int(height)})
-                page.screenshot(path=out_path, full_page=False)
-                browser.close()
-
-        # if scale != 1, resize the saved PNG to scale it
-        try:
-            s = float(scale)
-            if s != 1.0:
-                img = Image.open(out_path)
-                nw = int(img.width * s)
-                nh = int(img.height * s)
-                img = img.resize((nw, nh), Image.LANCZOS)
-                img.save(out_path)
-        except Exception:
-            # silently ignore resize failures
-            pass
+    # render with the warm browser pool (screenshot of the card element only)
+    _render_html_to_png(html, out_path, width, cancel)
 
+    img = Image.open(out_path)
+    img.load()
+    # if scale != 1, resize the saved PNG to scale it
+    try:
+        s = float(scale)
+        if s != 1.0:
+            nw = int(img.width * s)
+            nh = int(img.height * s)
+            img = img.resize((nw, nh), Image.LANCZOS)
+    except Exception:
+        # silently ignore resize failures
+        pass
+    return _save_overlay(img, out_path, key)
 
-def compose_video_ffmpeg(content_path, bg_path, header_img, comment_img, out_path, target_w=1080, target_h=1920, max_duration=None):
-    ffmpeg = ensure_ffmpeg_exists()
-    # get content duration
-    dur = get_duration(content_path)
-    if max_duration is not None and max_duration > 0:
-        dur = min(dur, float(max_duration)) if dur is not None else float(max_duration)
 
-    inputs = []
-    filter_inputs = []
-    # Background: to ensure the background always fills the target frame and matches duration,
-    # pre-process it into a temporary scaled video (bg_processed.mp4) that is exactly target size
-    work_dir = os.path.dirname(out_path)
-    bg_processed = os.path.join(work_dir, "bg_processed.mp4")
+IMAGE_EXTS = (".jpg", ".jpeg", ".png")
+
+# Pre-processed backgrounds are shared across requests (and worker processes) through a
+# disk cache. Durations are rounded up to BG_CACHE_BUCKET seconds so a handful of
+# entries serve every content length; the final encode trims with -t anyway.
+BG_CACHE_BUCKET = float(os.environ.get("BG_CACHE_BUCKET", "10"))
+BG_CACHE_MAX_BYTES = int(os.environ.get("BG_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+_bg_cache = None
+_bg_key_locks = {}
+_bg_key_locks_guard = threading.Lock()
+
+# One ffmpeg run per render (background fed directly into the final graph) unless disabled.
+COMPOSE_SINGLE_PASS = os.environ.get("COMPOSE_SINGLE_PASS", "1").lower() not in ("0", "false", "no")
+# frame rate of a still-image background (same as ffmpeg's -loop 1 image input default)
+IMAGE_BG_FPS = 25
+
+
+def get_bg_cache():
+    global _bg_cache
+    if _bg_cache is None:
+        _bg_cache = DiskLRUCache("backgrounds", BG_CACHE_MAX_BYTES)
+    return _bg_cache
 
-    if bg_path is None:
-        # generate a solid color background video
-        black = os.path.join(work_dir, "black_bg.png")
-        Image.new("RGB", (target_w, target_h), (10,10,10)).save(black)
-        bg_path = black
 
-    # choose processing based on extension
+def _bg_key_lock(key):
+    with _bg_key_locks_guard:
+        lock = _bg_key_locks.get(key)
+        if lock is None:
+            lock = _bg_key_locks[key] = threading.Lock()
+        return lock
+
+
+def prepare_background(ffmpeg, bg_path, dur, target_w, target_h, on_progress=None, cancel=None):
+    """Return a background video scaled/padded to target size covering at least dur seconds.
+
+    The pre-encode is looked up in the background cache first (keyed by file fingerprint,
+    target size and bucketed duration). On a cache hit no ffmpeg process is started.
+    Falls back to the original bg_path if pre-processing fails.
+    on_progress, cancel: see run_ffmpeg (progress is reported with phase "background").
+    """
     ext = os.path.splitext(bg_path)[1].lower()
+    is_image = ext in IMAGE_EXTS
+    if dur is not None and BG_CACHE_BUCKET > 0:
+        t = math.ceil(float(dur) / BG_CACHE_BUCKET) * BG_CACHE_BUCKET
+    else:
+        t = dur
+    if is_image and t is None:
+        t = 5
+
+    cache = get_bg_cache()
     try:
-        if ext in [".jpg", ".jpeg", ".png"]:
-            # image -> create a looping video trimmed to duration
-            t = str(dur or 5)
-            proc_cmd = [
-                ffmpeg, "-y", "-loop", "1", "-i", bg_path,
-                "-vf", f"scale={target_w}:{target_h}:force_original_aspect_ratio=decrease,pad={target_w}:{target_h}:(ow-iw)/2:(oh-ih)/2,setsar=1",
-                "-t", t, "-c:v", "libx264", "-pix_fmt", "yuv420p", bg_processed
-            ]
-            subprocess.run(proc_cmd, check=True, capture_output=True)
-        else:
-            # video background -> loop or trim to duration and scale/pad
-            bg_dur = get_duration(bg_path)
-            t = str(dur) if dur is not None else None
-            if bg_dur is not None and dur is not None and bg_dur < dur:
-                # loop source to cover duration
+        key = make_key("bg", file_fingerprint(bg_path), is_image, target_w, target_h, t)
+    except OSError:
+        return bg_path
+
+    with _bg_key_lock(key):
+        hit = cache.get(key, ".mp4")
+        metrics.cache_lookup("background", bool(hit))
+        if hit:
+            return hit
+
+        bg_processed = cache.tmp_path(".mp4")
+        bg_dur = None
+        vf = f"scale={target_w}:{target_h}:force_original_aspect_ratio=decrease,pad={target_w}:{target_h}:(ow-iw)/2:(oh-ih)/2,setsar=1"
+        try:
+            if is_image:
+                # image -> create a looping video trimmed to duration
                 proc_cmd = [
-                    ffmpeg, "-y", "-stream_loop", "-1", "-i", bg_path,
-                    "-vf", f"scale={target_w}:{target_h}:force_original_aspect_ratio=decrease,pad={target_w}:{target_h}:(ow-iw)/2:(oh-ih)/2,setsar=1",
-                    "-t", str(dur), "-c:v", "libx264", "-pix_fmt", "yuv420p", bg_processed
+                    ffmpeg, "-y", "-loop", "1", "-i", bg_path,
+                    "-vf", vf,
+                    "-t", str(t), "-c:v", "libx264", "-pix_fmt", "yuv420p", bg_processed
                 ]
             else:
-                # no need to loop; just trim/scale if necessary
-                cmd = [ffmpeg, "-y", "-i", bg_path, "-vf", f"scale={target_w}:{target_h}:force_original_aspect_ratio=decrease,pad={target_w}:{target_h}:(ow-iw)/2:(oh-ih)/2,setsar=1", "-c:v", "libx264", "-pix_fmt", "yuv420p"]
-                if t:
-                    cmd += ["-t", t]
-                cmd += [bg_processed]
-                proc_cmd = cmd
-            subprocess.run(proc_cmd, check=True, capture_output=True)
-    except subprocess.CalledProcessError as e:
-        # if processing background failed, fall back to using the original bg_path as input
-        # but log the error to help debugging
+                # video background -> loop or trim to duration and scale/pad
+                bg_dur = get_duration(bg_path)
+                if bg_dur is not None and t is not None and bg_dur < t:
+                    # loop source to cover duration
+                    proc_cmd = [
+                        ffmpeg, "-y", "-stream_loop", "-1", "-i", bg_path,
+                        "-vf", vf,
+                        "-t", str(t), "-c:v", "libx264", "-pix_fmt", "yuv420p", bg_processed
+                    ]
+                else:
+                    # no need to loop; just trim/scale if necessary
+                    proc_cmd = [ffmpeg, "-y", "-i", bg_path, "-vf", vf, "-c:v", "libx264", "-pix_fmt", "yuv420p"]
+                    if t:
+                        proc_cmd += ["-t", str(t)]
+                    proc_cmd += [bg_processed]
+            returncode, err_txt = run_ffmpeg(proc_cmd, stage="background", on_progress=on_progress, duration=t or bg_dur, cancel=cancel)
+        except OSError as e:
+            returncode, err_txt = None, str(e)
+        except Cancelled:
+            if os.path.exists(bg_processed):
+                os.remove(bg_processed)
+            raise
+        if returncode != 0:
+            # if processing background failed, fall back to using the original bg_path as input
+            # but log the error to help debugging
+            print("Warning: background pre-processing failed, falling back. Error:\n", err_txt)
+            if os.path.exists(bg_processed):
+                os.remove(bg_processed)
+            return bg_path
+        return cache.put(key, bg_processed, ".mp4")
+
+
+# Live progress: ffmpeg writes key=value blocks (-progress) to stderr, each one ending with
+# "progress=continue" (or "progress=end"); the rest of stderr is kept for error messages.
+PROGRESS_ARGS = ["-progress", "pipe:2", "-nostats"]
+PROGRESS_KEYS = ("frame", "fps", "bitrate", "total_size", "out_time_us", "out_time_ms", "out_time",
+                 "dup_frames", "drop_frames", "speed", "progress")
+# encodes slower than this (seconds of output per second) are flagged as below realtime,
+# once they ran for SLOW_ENCODE_GRACE seconds
+SLOW_ENCODE_SPEED = float(os.environ.get("SLOW_ENCODE_SPEED", "0.5"))
+SLOW_ENCODE_GRACE = 5.0
+
+
+def progress_report(phase, out_time, fps, speed, duration, elapsed, done=False):
+    """Progress dict passed to on_progress callbacks: percent and ETA derived from duration."""
+    percent = eta = None
+    if duration:
+        percent = 100.0 if done else min(100.0, max(0.0, out_time / duration * 100))
+        if done:
+            eta = 0.0
+        elif speed:
+            eta = max(0.0, (duration - out_time) / speed)
+    return {
+        "phase": phase,
+        "out_time": round(out_time, 3),
+        "fps": fps,
+        "speed": speed,
+        "percent": None if percent is None else round(percent, 1),
+        "eta": None if eta is None else round(eta, 1),
+        "elapsed": round(elapsed, 1),
+        "slow": bool(speed is not None and not done and elapsed >= SLOW_ENCODE_GRACE and speed < SLOW_ENCODE_SPEED),
+        "done": done,
+    }
+
+
+class FFmpegProgress:
+    """Incremental parser of ffmpeg's -progress output calling on_progress(progress_report) per block."""
+
+    def __init__(self, on_progress, duration=None, phase="encode"):
+        self.on_progress = on_progress
+        self.duration = duration
+        self.phase = phase
+        self.values = {}
+        self.started = time.monotonic()
+        self.slow_reported = False
+
+    def feed(self, line):
+        """Consume one stderr line; returns False when it is not part of the progress output."""
+        key, sep, value = line.strip().partition("=")
+        if not sep or (key not in PROGRESS_KEYS and not key.startswith("stream_")):
+            return False
+        self.values[key] = value.strip()
+        if key == "progress":
+            self.report(value.strip() == "end")
+        return True
+
+    def report(self, done=False):
+        out_us = _to_float(self.values.get("out_time_us"))
+        out_time = max(0.0, out_us / 1e6) if out_us is not None else 0.0
+        elapsed = time.monotonic() - self.started
+        speed = _to_float(self.values.get("speed", "").rstrip("x"))
+        if speed is None and elapsed > 0 and out_time > 0:
+            speed = out_time / elapsed
+        info = progress_report(self.phase, out_time, _to_float(self.values.get("fps")), speed, self.duration, elapsed, done)
+        if info["slow"] and not self.slow_reported:
+            self.slow_reported = True
+            metrics.slow_encodes.inc(stage=self.phase)
+            print(f"Warning: ffmpeg ({self.phase}) berjalan di bawah realtime (speed {speed:.2f}x)")
         try:
-            err_txt = e.stderr.decode('utf-8') if e.stderr else str(e)
-        except Exception:
-            err_txt = str(e)
-        print("Warning: background pre-processing failed, falling back. Error:\n", err_txt)
-        if os.path.exists(bg_processed):
-            os.remove(bg_processed)
-        bg_processed = bg_path
+            self.on_progress(info)
+        except Exception as e:
+            print(f"Warning: progress callback gagal: {e}")
 
-    # use the processed background video (or fallback) as the first input
-    inputs += ["-i", bg_processed]
 
-    # content
-    inputs += ["-i", content_path]
+def _read_stderr(pipe, progress=None):
+    """Read an ffmpeg stderr pipe to the end, feeding progress lines to progress; return the other text."""
+    if progress is None:
+        return pipe.read().decode("utf-8", "replace")
+    lines = []
+    for raw in iter(pipe.readline, b""):
+        line = raw.decode("utf-8", "replace")
+        if not progress.feed(line):
+            lines.append(line)
+    return "".join(lines)
 
-    # header image and comment image
-    inputs += ["-i", header_img, "-i", comment_img]
 
-    # compute content target width as 90% of background width
-    content_w = int(math.floor(target_w * 0.90))
+def _popen_ffmpeg(cmd, cancel=None, **kwargs):
+    """Start ffmpeg; with a cancel token it runs in its own process group, killed on cancel.
 
-    # probe original content size to calculate the scaled height
-    def get_size(path):
-        ffprobe = shutil.which("ffprobe")
-        if ffprobe is None:
-            return None
-        cmd = [
-            ffprobe,
-            "-v",
-            "error",
-            "-select_streams",
-            "v:0",
-            "-show_entries",
-            "stream=width,height",
-            "-of",
-            "csv=p=0:s=x",
-            path,
-        ]
-        p = subprocess.run(cmd, capture_output=True, text=True)
-        if p.returncode != 0:
-            return None
+    Returns (process, unregister) where unregister() removes the cancel callback.
+    """
+    if cancel is None:
+        return subprocess.Popen(cmd, **kwargs), lambda: None
+    cancel.check()
+    p = subprocess.Popen(cmd, start_new_session=(os.name == "posix"), **kwargs)
+    return p, cancel.on_cancel(lambda: _kill_process(p))
+
+
+def _kill_process(p):
+    """Kill p and everything in its process group (just p where groups are not available)."""
+    if p.poll() is not None:
+        return
+    try:
+        if os.name == "posix" and os.getpgid(p.pid) == p.pid:
+            os.killpg(p.pid, signal.SIGKILL)
+        else:
+            p.kill()
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def run_ffmpeg(cmd, stdin_chunks=None, stage="encode", on_progress=None, duration=None, cancel=None):
+    """Run an ffmpeg command and return (returncode, stderr text).
+
+    stdin_chunks: optional callable returning an iterator of bytes that is written to the
+    process' stdin from a helper thread (for commands reading an input from pipe:0).
+    stage: name the run time and exit code are recorded under (see metrics.py).
+    on_progress: optional callable receiving a progress dict (see progress_report) about
+    twice a second while ffmpeg runs; duration (seconds of output) gives percent and ETA.
+    cancel: optional CancelToken; cancelling it kills the process group and raises Cancelled.
+    """
+    progress = FFmpegProgress(on_progress, duration, stage) if on_progress else None
+    if progress is not None:
+        cmd = cmd[:1] + PROGRESS_ARGS + cmd[1:]
+    with metrics.span(stage):
+        if stdin_chunks is None and progress is None and cancel is None:
+            p = subprocess.run(cmd, capture_output=True, text=True)
+            stderr = p.stderr
+        else:
+            p, unregister = _popen_ffmpeg(cmd, cancel, stdin=subprocess.PIPE if stdin_chunks else subprocess.DEVNULL,
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            try:
+                feeder = _start_stdin_feeder(p, stdin_chunks) if stdin_chunks else None
+                stderr = _read_stderr(p.stderr, progress)
+                p.wait()
+                if feeder is not None:
+                    feeder.join()
+            finally:
+                unregister()
+    metrics.ffmpeg_exited(stage, p.returncode)
+    if cancel is not None:
+        cancel.check()
+    return p.returncode, stderr
+
+
+def _start_stdin_feeder(p, stdin_chunks):
+    """Write stdin_chunks() into p.stdin from a helper thread and close it at the end."""
+    def feed():
         try:
-            parts = p.stdout.strip().split("x")
-            return (int(parts[0]), int(parts[1]))
-        except Exception:
-            return None
+            for chunk in stdin_chunks():
+                p.stdin.write(chunk)
+        except (BrokenPipeError, OSError):
+            # ffmpeg stopped reading (e.g. -t reached); the rest of the input is not needed
+            pass
+        finally:
+            try:
+                p.stdin.close()
+            except OSError:
+                pass
+
+    feeder = threading.Thread(target=feed, daemon=True, name="ffmpeg-stdin")
+    feeder.start()
+    return feeder
+
+
+def stream_ffmpeg(cmd, stdin_chunks=None, chunk_size=64 * 1024, stage="encode", on_progress=None, duration=None, cancel=None):
+    """Run an ffmpeg command writing to pipe:1 and yield its output as soon as it is produced.
+
+    Raises RuntimeError after the last chunk if ffmpeg failed. Closing the generator early
+    (e.g. the client went away) kills the process. on_progress/duration/cancel: see run_ffmpeg.
+    """
+    t0 = time.perf_counter()
+    progress = FFmpegProgress(on_progress, duration, stage) if on_progress else None
+    if progress is not None:
+        cmd = cmd[:1] + PROGRESS_ARGS + cmd[1:]
+    p, unregister = _popen_ffmpeg(cmd, cancel, stdin=subprocess.PIPE if stdin_chunks else subprocess.DEVNULL,
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    feeder = _start_stdin_feeder(p, stdin_chunks) if stdin_chunks else None
+    # stderr must be drained concurrently or ffmpeg blocks once the pipe buffer is full
+    stderr = []
+    drain = threading.Thread(target=lambda: stderr.append(_read_stderr(p.stderr, progress)), daemon=True, name="ffmpeg-stderr")
+    drain.start()
+    try:
+        while True:
+            data = p.stdout.read1(chunk_size)
+            if not data:
+                break
+            yield data
+        p.wait()
+        drain.join()
+        if cancel is not None:
+            cancel.check()
+        if p.returncode != 0:
+            err = "".join(stderr)
+            raise RuntimeError(f"ffmpeg failed: {err}\nCMD: {' '.join(cmd)}")
+    finally:
+        unregister()
+        if p.poll() is None:
+            _kill_process(p)
+            p.wait()
+        drain.join()
+        if feeder is not None:
+            feeder.join()
+        p.stdout.close()
+        metrics.observe_stage(stage, time.perf_counter() - t0)
+        metrics.ffmpeg_exited(stage, p.returncode)
+
+
+# Encoder profiles for the final x264 encode. "standard" is the historical setting
+# (scaler and lookahead left at their ffmpeg defaults).
+ENCODE_PROFILES = {
+    "draft": {"preset": "ultrafast", "crf": 28, "scaler": "fast_bilinear", "lookahead": 10},
+    "standard": {"preset": "veryfast", "crf": 23, "scaler": None, "lookahead": None},
+    "quality": {"preset": "slow", "crf": 20, "scaler": "lanczos", "lookahead": 60},
+}
+# profile used when the caller does not pick one: a name above or "auto"
+ENCODE_PROFILE = os.environ.get("ENCODE_PROFILE", "standard")
+
+
+def choose_encode_profile(name=None, running=1, queued=0, cpu_count=None, slow=0):
+    """Resolve a profile name (or "auto") into encoder settings.
+
+    running/queued: renders currently in progress (including this one) and waiting. In
+    auto mode the cores are shared between the running renders through a per-job thread
+    count, and "draft" is used while renders are waiting or slow (running encodes below
+    realtime, see SLOW_ENCODE_SPEED) is nonzero, so a burst drains faster instead of every
+    render slowing down together. Returns a dict with name, preset, crf, scaler,
+    lookahead and threads (None = let x264 decide).
+    """
+    name = name or ENCODE_PROFILE
+    threads = None
+    if name == "auto":
+        running = max(1, running)
+        cores = cpu_count or os.cpu_count() or 1
+        name = "draft" if queued >= running or slow else "standard"
+        threads = max(1, cores // running)
+    if name not in ENCODE_PROFILES:
+        raise ValueError(f"Unknown encode profile: {name}")
+    return dict(ENCODE_PROFILES[name], name=name, threads=threads)
+
+
+def _x264_args(encode):
+    args = ["-c:v", "libx264", "-crf", str(encode["crf"]), "-preset", encode["preset"]]
+    if encode["lookahead"] is not None:
+        args += ["-rc-lookahead", str(encode["lookahead"])]
+    if encode["threads"]:
+        args += ["-threads", str(encode["threads"])]
+    return args
+
+
+# AAC that can be copied into the output as it is instead of being re-encoded
+AUDIO_COPY_PROFILES = ("LC", "HE-AAC", "HE-AACv2")
+AUDIO_COPY_SAMPLE_RATES = (44100, 48000)
+AUDIO_COPY_MAX_BITRATE = 320000
+
+
+def _audio_copy_ok(audio):
+    return bool(
+        audio
+        and audio["codec"] == "aac"
+        and (audio["profile"] or "LC") in AUDIO_COPY_PROFILES
+        and audio["sample_rate"] in AUDIO_COPY_SAMPLE_RATES
+        and (audio["channels"] or 0) in (1, 2)
+        and (audio["bit_rate"] or 0) <= AUDIO_COPY_MAX_BITRATE
+    )
+
+
+def _probe_or_none(path):
+    try:
+        return probe_media(path)
+    except RuntimeError:
+        return None
+
+
+def _log_plan(plan):
+    for stream, op in plan.items():
+        metrics.compose_plans.inc(stream=stream, op=op)
+    print("Compose plan: " + " ".join(f"{stream}={op}" for stream, op in plan.items()))
+
+
+# fragmented MP4 written to stdout: an empty moov up front, then one moof/mdat per keyframe,
+# so every fragment can be sent to the client as soon as it is encoded
+STREAM_KEYFRAME_SECONDS = 2
+FRAG_MP4_OUTPUT = [
+    "-force_key_frames", f"expr:gte(t,n_forced*{STREAM_KEYFRAME_SECONDS})",
+    "-movflags", "frag_keyframe+empty_moov+default_base_moof",
+    "-f", "mp4", "pipe:1",
+]
+
+
+def _compose_cmd_builder(content_path, bg_path, overlays, work_dir, target_w, target_h, max_duration, content_info, content_stream, encode=None, segment=None):
+    """Work out the layout for compose and return (build_cmd, bg_path, dur, plan).
+
+    overlays: list of (header_img, comment_img, header_size, comment_size, output) tuples,
+    one per output; output is the list of output arguments (e.g. [out_path]). With several
+    overlays the background and the content are decoded and scaled once and split into one
+    overlay branch per output.
+
+    build_cmd(bg_inputs, bg_loop=None, bg_info=None) returns the ffmpeg command for the given
+    background input arguments; bg_info is the probe of that input, used to skip no-op filters.
+    encode: settings from choose_encode_profile (default profile if None).
+
+    The returned plan dict records, per stream, the operation build_cmd chose (copy or
+    re-encode audio, which filters run on content and background); see _log_plan.
+
+    segment: optional (start, length) in seconds; the command then renders only that part
+    of the content, video only (see compose_video_ffmpeg's segments).
+    """
+    ffmpeg = ensure_ffmpeg_exists()
+    if encode is None:
+        encode = choose_encode_profile()
+    scale_flags = f":flags={encode['scaler']}" if encode["scaler"] else ""
+    # probe content once: duration and size for the layout
+    if content_info is None:
+        content_info = probe_media(content_path)
+    dur = content_info["duration"]
+    if max_duration is not None and max_duration > 0:
+        dur = min(dur, float(max_duration)) if dur is not None else float(max_duration)
+
+    if bg_path is None:
+        # generate a solid color background video
+        black = os.path.join(work_dir, "black_bg.png")
+        Image.new("RGB", (target_w, target_h), (10,10,10)).save(black)
+        bg_path = black
+
+    # content, then header image and comment image of every output (background input is chosen per mode below)
+    inputs = ["-i", "pipe:0" if content_stream else content_path]
+    if segment is not None:
+        # input seek: the segment starts on a keyframe, so decoding starts exactly there
+        seg_start, dur = segment
+        inputs = ["-ss", f"{seg_start:.6f}", "-t", f"{dur:.6f}"] + inputs
+    for header_img, comment_img, _, _, _ in overlays:
+        inputs += ["-i", header_img, "-i", comment_img]
+
+    # compute content target width as 90% of background width
+    content_w = int(math.floor(target_w * 0.90))
 
-    orig_size = get_size(content_path)
+    # original content size (display orientation) to calculate the scaled height
+    video = content_info["video"]
+    orig_size = (video["width"], video["height"]) if video and video["width"] and video["height"] else None
     if orig_size:
         orig_w, orig_h = orig_size
         content_h = int(math.floor(orig_h * (content_w / orig_w)))
@@ -703,68 +1418,389 @@ def compose_video_ffmpeg(content_path, bg_path, header_img, comment_img, out_pat
     content_x = int((target_w - content_w) // 2)
     content_y = int((target_h - content_h) // 2)
 
-    # header/comment image sizes
-    try:
-        header_w, header_h = Image.open(header_img).size
-    except Exception:
-        header_w, header_h = (target_w, 160)
-    try:
-        comment_w, comment_h = Image.open(comment_img).size
-    except Exception:
-        comment_w, comment_h = (460, 220)
-
-    # default positions (attached to container)
-    header_x_default = 0
-    header_y_default = 20
-    comment_x_default = int((target_w - comment_w) // 2)
-    comment_y_default = int(target_h - comment_h - 20)
-
     # check content aspect to decide behavior: if content is "less vertical than 3:4" -> width/height > 3/4
     attach_to_content = False
     if orig_size:
         if (orig_w / orig_h) > (3/4):
             attach_to_content = True
 
-    if attach_to_content:
-        # header attached to top of content, comment attached to bottom of content
-        header_x = int((target_w - header_w) // 2)
-        header_y = int(max(0, content_y - header_h))
-        comment_x = int((target_w - comment_w) // 2)
-        comment_y = int(min(target_h - comment_h, content_y + content_h))
-    else:
-        header_x = header_x_default
-        header_y = header_y_default
-        comment_x = comment_x_default
-        comment_y = comment_y_default
+    def overlay_positions(header_img, comment_img, header_size, comment_size):
+        # header/comment image sizes
+        try:
+            header_w, header_h = header_size or Image.open(header_img).size
+        except Exception:
+            header_w, header_h = (target_w, 160)
+        try:
+            comment_w, comment_h = comment_size or Image.open(comment_img).size
+        except Exception:
+            comment_w, comment_h = (460, 220)
+
+        if attach_to_content:
+            # header attached to top of content, comment attached to bottom of content
+            header_x = int((target_w - header_w) // 2)
+            header_y = int(max(0, content_y - header_h))
+            comment_x = int((target_w - comment_w) // 2)
+            comment_y = int(min(target_h - comment_h, content_y + content_h))
+        else:
+            # default positions (attached to container)
+            header_x = 0
+            header_y = 20
+            comment_x = int((target_w - comment_w) // 2)
+            comment_y = int(target_h - comment_h - 20)
+        return header_x, header_y, comment_x, comment_y
+
+    positions = [overlay_positions(h, c, hs, cs) for h, c, hs, cs, _ in overlays]
+
+    # cheapest valid operation per stream: copy compatible audio, skip no-op filters
+    audio = content_info["audio"]
+    copy_audio = _audio_copy_ok(audio)
+    content_filters = []
+    if not (video and video["width"] == content_w and video["height"] == content_h):
+        content_filters.append(f"scale={content_w}:{content_h}:force_original_aspect_ratio=disable{scale_flags}")
+    if not (video and video["sar"] == "1:1"):
+        content_filters.append("setsar=1")
+    plan = {
+        "audio": "none" if audio is None else ("copy" if copy_audio else "aac"),
+        "segments": "1",
+        "content": ",".join(f.split("=")[0] for f in content_filters) or "as-is",
+    }
 
     # build filter_complex
-    # indices: 0:bg, 1:content, 2:header, 3:comment
+    # indices: 0:bg, 1:content, then 2+2i:header and 3+2i:comment of output i
     # scale background to target, pad if needed
-    fc = (
-        f"[0:v]scale={target_w}:{target_h}:force_original_aspect_ratio=decrease,pad={target_w}:{target_h}:(ow-iw)/2:(oh-ih)/2,setsar=1[bg];"
-        f"[1:v]scale={content_w}:{content_h}:force_original_aspect_ratio=disable,setsar=1[vid];"
-        f"[bg][vid]overlay={content_x}:{content_y}[tmp1];"
-        f"[tmp1][2:v]overlay={header_x}:{header_y}[tmp2];"
-        f"[tmp2][3:v]overlay={comment_x}:{comment_y}[outv]"
+    def build_cmd(bg_inputs, bg_loop=None, bg_info=None):
+        # a looped background never ends on its own, so let the content decide when to stop
+        bg_overlay = f"overlay={content_x}:{content_y}:shortest=1" if bg_loop else f"overlay={content_x}:{content_y}"
+        bg_video = bg_info["video"] if bg_info else None
+        bg_filters = []
+        if not (bg_video and bg_video["width"] == target_w and bg_video["height"] == target_h):
+            bg_filters += [
+                f"scale={target_w}:{target_h}:force_original_aspect_ratio=decrease{scale_flags}",
+                f"pad={target_w}:{target_h}:(ow-iw)/2:(oh-ih)/2",
+            ]
+        if not (bg_video and bg_video["sar"] == "1:1"):
+            bg_filters.append("setsar=1")
+        plan["background"] = ",".join(f.split("=")[0] for f in bg_filters) or "as-is"
+        if bg_loop == "still":
+            # a still image is decoded and scaled once, then repeated by the loop filter
+            bg_filters.append(f"loop=loop=-1:size=1:start=0,settb=1/{IMAGE_BG_FPS},setpts=N")
+        content_chain = ",".join(content_filters)
+        fc = (
+            f"[0:v]{','.join(bg_filters) or 'null'}[bg];"
+            + (f"[1:v]{content_chain}[vid];[bg][vid]" if content_chain else "[bg][1:v]")
+            + f"{bg_overlay}[tmp1]"
+        )
+        if len(overlays) == 1:
+            bases = ["tmp1"]
+            out_labels = ["outv"]
+        else:
+            bases = [f"base{i}" for i in range(len(overlays))]
+            out_labels = [f"outv{i}" for i in range(len(overlays))]
+            fc += f";[tmp1]split={len(overlays)}" + "".join(f"[{b}]" for b in bases)
+        for i, (header_x, header_y, comment_x, comment_y) in enumerate(positions):
+            tmp2 = "tmp2" if len(overlays) == 1 else f"tmp2_{i}"
+            fc += (
+                f";[{bases[i]}][{2 + 2 * i}:v]overlay={header_x}:{header_y}[{tmp2}];"
+                f"[{tmp2}][{3 + 2 * i}:v]overlay={comment_x}:{comment_y}[{out_labels[i]}]"
+            )
+
+        cmd = [ffmpeg, "-y"]
+        if encode["threads"]:
+            # keep the filtergraph within the same per-job thread budget as the encoder
+            cmd += ["-filter_complex_threads", str(encode["threads"])]
+        cmd += bg_inputs + inputs + ["-filter_complex", fc]
+        for i, overlay in enumerate(overlays):
+            if segment is not None:
+                # audio is muxed once over the joined segments
+                cmd += ["-map", f"[{out_labels[i]}]", "-an"] + _x264_args(encode) + ["-shortest"]
+            else:
+                cmd += ["-map", f"[{out_labels[i]}]", "-map", "1:a?"] + _x264_args(encode) + [
+                    "-c:a", "copy" if copy_audio else "aac",
+                    "-shortest",
+                ]
+            # if duration known, add -t to force output length (ensure loops are trimmed).
+            # Must come before the output path or ffmpeg ignores it as a trailing option.
+            if dur is not None:
+                cmd += ["-t", str(dur)]
+            cmd += overlay[4]
+        return cmd
+
+    return build_cmd, bg_path, dur, plan
+
+
+def _single_pass_cmd(build_cmd, bg_path):
+    bg_info = _probe_or_none(bg_path)
+    if os.path.splitext(bg_path)[1].lower() in IMAGE_EXTS:
+        return build_cmd(["-i", bg_path], "still", bg_info)
+    return build_cmd(["-stream_loop", "-1", "-i", bg_path], "stream", bg_info)
+
+
+def _two_step_cmd(build_cmd, bg_path, dur, target_w, target_h, on_progress=None, cancel=None):
+    bg_processed = prepare_background(ensure_ffmpeg_exists(), bg_path, dur, target_w, target_h, on_progress, cancel)
+    # use the processed background video (or fallback) as the first input
+    return build_cmd(["-i", bg_processed], bg_info=_probe_or_none(bg_processed))
+
+
+# Segment-parallel compose for long content: the timeline is cut at content keyframes into
+# up to COMPOSE_SEGMENTS parts rendered by parallel ffmpeg processes and joined without
+# re-encoding. "0" disables it, "auto" uses one segment per core.
+COMPOSE_SEGMENTS = os.environ.get("COMPOSE_SEGMENTS", "0")
+# content shorter than this (seconds) is always rendered in one piece
+SEGMENT_MIN_SECONDS = float(os.environ.get("SEGMENT_MIN_SECONDS", "60"))
+# shortest segment worth its own process, in seconds
+SEGMENT_MIN_LENGTH = 10.0
+
+
+def keyframe_times(path):
+    """Timestamps (seconds) of the video keyframes of path, read from the packet index without decoding."""
+    ffprobe = shutil.which("ffprobe")
+    if not ffprobe:
+        return []
+    p = subprocess.run(
+        [ffprobe, "-v", "error", "-select_streams", "v:0", "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", path],
+        capture_output=True, text=True,
     )
+    if p.returncode != 0:
+        return []
+    times = []
+    for line in p.stdout.splitlines():
+        pts, _, flags = line.partition(",")
+        if "K" in flags:
+            t = _to_float(pts)
+            if t is not None:
+                times.append(t)
+    return sorted(times)
+
+
+def plan_segments(keyframes, dur, count):
+    """Split [0, dur) into at most count (start, length) parts starting on keyframes."""
+    bounds = [0.0]
+    for i in range(1, count):
+        target = dur * i / count
+        # nearest keyframe to the even split point
+        best = min(keyframes, key=lambda t: abs(t - target), default=None)
+        if best is not None and best - bounds[-1] >= SEGMENT_MIN_LENGTH and dur - best >= SEGMENT_MIN_LENGTH:
+            bounds.append(best)
+    bounds.append(dur)
+    return [(start, end - start) for start, end in zip(bounds, bounds[1:])]
+
+
+def _segment_count(segments):
+    if segments is None:
+        segments = COMPOSE_SEGMENTS
+    if segments == "auto":
+        return os.cpu_count() or 1
+    try:
+        return int(segments)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _compose_segmented(content_path, bg_path, header_img, comment_img, out_path, target_w, target_h, max_duration, header_size, comment_size, content_info, encode, count, on_progress=None, cancel=None):
+    """Render the parts from plan_segments in parallel and join them; False if not worth it or failed."""
+    if content_info is None:
+        content_info = probe_media(content_path)
+    dur = content_info["duration"]
+    if max_duration is not None and max_duration > 0 and dur is not None:
+        dur = min(dur, float(max_duration))
+    if not dur or dur < SEGMENT_MIN_SECONDS:
+        return False
+    parts = plan_segments(keyframe_times(content_path), dur, count)
+    if len(parts) < 2:
+        return False
+
+    if encode is None:
+        encode = choose_encode_profile()
+    # the cores are shared between the parallel segment encoders
+    encode = dict(encode, threads=max(1, (encode["threads"] or os.cpu_count() or 1) // len(parts)))
+    work_dir = os.path.dirname(out_path)
+    ffmpeg = ensure_ffmpeg_exists()
+    if bg_path is None:
+        # created once here rather than by every part in parallel
+        bg_path = os.path.join(work_dir, "black_bg.png")
+        Image.new("RGB", (target_w, target_h), (10,10,10)).save(bg_path)
+
+    # the parts report separately; on_progress gets their sum over the whole duration
+    part_progress = {}
+    part_progress_lock = threading.Lock()
+    started = time.monotonic()
+
+    def part_reporter(i):
+        def report(info):
+            with part_progress_lock:
+                part_progress[i] = info
+                running = [p for p in part_progress.values() if not p["done"]]
+                out_time = sum(p["out_time"] for p in part_progress.values())
+                fps = sum(p["fps"] or 0 for p in running) or None
+                speed = sum(p["speed"] or 0 for p in running) or None
+                on_progress(progress_report("encode", out_time, fps, speed, dur, time.monotonic() - started))
+        return report
+
+    def render_part(i, start, length):
+        part_path = os.path.join(work_dir, f"segment_{i:03d}.mp4")
+        build_cmd, part_bg, _, plan = _compose_cmd_builder(
+            content_path, bg_path, [(header_img, comment_img, header_size, comment_size, [part_path])], work_dir,
+            target_w, target_h, None, content_info, None, encode, segment=(start, length))
+        bg_info = _probe_or_none(part_bg)
+        if os.path.splitext(part_bg)[1].lower() in IMAGE_EXTS:
+            cmd = build_cmd(["-i", part_bg], "still", bg_info)
+        else:
+            # continue a looping background video where the previous segment left it
+            bg_dur = (bg_info or {}).get("duration") or 0
+            offset = start % bg_dur if bg_dur else 0
+            cmd = build_cmd(["-stream_loop", "-1", "-ss", f"{offset:.6f}", "-i", part_bg], "stream", bg_info)
+        returncode, stderr = run_ffmpeg(cmd, stage="encode_segment", on_progress=part_reporter(i) if on_progress else None,
+                                        duration=length, cancel=cancel)
+        if returncode != 0:
+            raise RuntimeError(f"ffmpeg failed: {stderr}\nCMD: {' '.join(cmd)}")
+        return part_path, plan
 
-    cmd = [ffmpeg, "-y"] + inputs + [
-        "-filter_complex", fc,
-        "-map", "[outv]",
-        "-map", "1:a?",
-        "-c:v", "libx264",
-        "-crf", "23",
-        "-preset", "veryfast",
-        "-c:a", "aac",
-        "-shortest",
-        out_path,
-    ]
-
-    # if duration known, add -t to force output length (ensure loops are trimmed)
-    if dur is not None:
-        cmd += ["-t", str(dur)]
+    try:
+        with ThreadPoolExecutor(max_workers=len(parts), thread_name_prefix="segment") as pool:
+            futures = [pool.submit(render_part, i, start, length) for i, (start, length) in enumerate(parts)]
+            rendered = [f.result() for f in futures]
+    except RuntimeError as e:
+        print("Warning: segmented compose failed, rendering in one piece. Error:\n", e)
+        return False
+
+    list_path = os.path.join(work_dir, "segments.txt")
+    with open(list_path, "w", encoding="utf-8") as fh:
+        for part_path, _ in rendered:
+            fh.write(f"file '{part_path}'\n")
+
+    # audio taken once from the whole content, so there is no seam at the joins
+    audio = content_info["audio"]
+    copy_audio = _audio_copy_ok(audio)
+    cmd = [ffmpeg, "-y", "-f", "concat", "-safe", "0", "-i", list_path, "-i", content_path,
+           "-map", "0:v", "-map", "1:a?", "-c:v", "copy", "-c:a", "copy" if copy_audio else "aac",
+           "-t", str(dur), out_path]
+    plan = dict(rendered[0][1], segments=str(len(parts)))
+    plan["audio"] = "none" if audio is None else ("copy" if copy_audio else "aac")
+    _log_plan(plan)
+    # a stream copy, short next to the encode: not reported separately, so the percent the
+    # parts reached is not reset to 0 for it
+    returncode, stderr = run_ffmpeg(cmd, stage="concat", cancel=cancel)
+    if returncode != 0:
+        print("Warning: joining segments failed, rendering in one piece. Error:\n", stderr)
+        return False
+    return True
+
+
+def compose_video_ffmpeg(content_path, bg_path, header_img, comment_img, out_path, target_w=1080, target_h=1920, max_duration=None, single_pass=None, header_size=None, comment_size=None, content_info=None, content_stream=None, encode=None, segments=None, on_progress=None, cancel=None):
+    """Compose the final portrait video: background, scaled content, header and comment overlays.
+
+    header_size/comment_size: (width, height) of the overlays as returned by the make_*
+    functions; when given, the PNGs are not opened again just to read their size.
+
+    content_info/content_stream: streamed ingest. content_info is the probe of the content
+    (e.g. from probe_media_bytes on the first bytes) and content_stream a callable returning
+    an iterator over the content bytes from the start; the content is then read by ffmpeg
+    from a pipe while it is still downloading instead of from content_path.
+
+    single_pass: feed the background straight into the final filtergraph (image decoded once
+    and repeated by the loop filter, video via -stream_loop -1) so the whole render is one
+    ffmpeg run. When False, or if the
+    single-pass run fails, the background is pre-encoded first (see prepare_background).
+    Defaults to COMPOSE_SINGLE_PASS.
+
+    encode: encoder settings from choose_encode_profile; defaults to the ENCODE_PROFILE profile.
+
+    segments: split content of at least SEGMENT_MIN_SECONDS into up to this many keyframe-
+    aligned parts encoded in parallel and joined with the concat demuxer ("auto": one per
+    core). Defaults to COMPOSE_SEGMENTS; not used for streamed ingest.
+
+    on_progress: callable receiving progress dicts (percent/ETA of the output duration, see
+    progress_report) from the final encode and the background pre-encode.
+
+    cancel: optional CancelToken (see cancellation.py); cancelling it kills the running
+    ffmpeg process right away and raises Cancelled.
+    """
+    if single_pass is None:
+        single_pass = COMPOSE_SINGLE_PASS
+    count = _segment_count(segments)
+    if count > 1 and content_stream is None:
+        if _compose_segmented(content_path, bg_path, header_img, comment_img, out_path, target_w, target_h, max_duration,
+                              header_size, comment_size, content_info, encode, count, on_progress, cancel):
+            return
+    build_cmd, bg_path, dur, plan = _compose_cmd_builder(
+        content_path, bg_path, [(header_img, comment_img, header_size, comment_size, [out_path])], os.path.dirname(out_path),
+        target_w, target_h, max_duration, content_info, content_stream, encode)
+
+    if single_pass:
+        cmd = _single_pass_cmd(build_cmd, bg_path)
+        _log_plan(plan)
+        returncode, stderr = run_ffmpeg(cmd, content_stream, on_progress=on_progress, duration=dur, cancel=cancel)
+        if returncode == 0:
+            return
+        print("Warning: single-pass compose failed, falling back to two-step. Error:\n", stderr)
+
+    cmd = _two_step_cmd(build_cmd, bg_path, dur, target_w, target_h, on_progress, cancel)
+    _log_plan(plan)
 
     # run ffmpeg
-    p = subprocess.run(cmd, capture_output=True, text=True)
-    if p.returncode != 0:
-        raise RuntimeError(f"ffmpeg failed: {p.stderr}\nCMD: {' '.join(cmd)}")
+    returncode, stderr = run_ffmpeg(cmd, content_stream, on_progress=on_progress, duration=dur, cancel=cancel)
+    if returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {stderr}\nCMD: {' '.join(cmd)}")
+
+
+def compose_video_stream(content_path, bg_path, header_img, comment_img, target_w=1080, target_h=1920, max_duration=None, single_pass=None, header_size=None, comment_size=None, content_info=None, content_stream=None, encode=None, chunk_size=64 * 1024, on_progress=None, cancel=None):
+    """Like compose_video_ffmpeg, but yield the result as fragmented MP4 while it is encoded.
+
+    Nothing is written to disk for the output; the first bytes arrive after roughly one
+    fragment (STREAM_KEYFRAME_SECONDS of video). The single-pass run only falls back to the
+    two-step render if it fails before producing any output; later failures raise
+    RuntimeError mid-stream. on_progress/cancel: see compose_video_ffmpeg.
+    """
+    if single_pass is None:
+        single_pass = COMPOSE_SINGLE_PASS
+    build_cmd, bg_path, dur, plan = _compose_cmd_builder(
+        content_path, bg_path, [(header_img, comment_img, header_size, comment_size, FRAG_MP4_OUTPUT)], os.path.dirname(header_img),
+        target_w, target_h, max_duration, content_info, content_stream, encode)
+
+    if single_pass:
+        produced = False
+        cmd = _single_pass_cmd(build_cmd, bg_path)
+        _log_plan(plan)
+        try:
+            for chunk in stream_ffmpeg(cmd, content_stream, chunk_size, on_progress=on_progress, duration=dur, cancel=cancel):
+                produced = True
+                yield chunk
+            return
+        except RuntimeError as e:
+            if produced:
+                raise
+            print("Warning: single-pass compose failed, falling back to two-step. Error:\n", e)
+
+    cmd = _two_step_cmd(build_cmd, bg_path, dur, target_w, target_h, on_progress, cancel)
+    _log_plan(plan)
+    yield from stream_ffmpeg(cmd, content_stream, chunk_size, on_progress=on_progress, duration=dur, cancel=cancel)
+
+
+def compose_video_variants(content_path, bg_path, variants, target_w=1080, target_h=1920, max_duration=None, single_pass=None, content_info=None, encode=None, on_progress=None, cancel=None):
+    """Compose several videos that differ only in their header/comment overlays in one ffmpeg run.
+
+    variants: list of dicts with header_img, comment_img, out_path and optionally
+    header_size/comment_size (see compose_video_ffmpeg). The background and the content are
+    decoded and scaled once and split into one overlay branch and encoder per variant.
+    on_progress/cancel: see compose_video_ffmpeg.
+    """
+    if single_pass is None:
+        single_pass = COMPOSE_SINGLE_PASS
+    overlays = [(v["header_img"], v["comment_img"], v.get("header_size"), v.get("comment_size"), [v["out_path"]]) for v in variants]
+    build_cmd, bg_path, dur, plan = _compose_cmd_builder(
+        content_path, bg_path, overlays, os.path.dirname(variants[0]["out_path"]),
+        target_w, target_h, max_duration, content_info, None, encode)
+
+    if single_pass:
+        cmd = _single_pass_cmd(build_cmd, bg_path)
+        _log_plan(plan)
+        returncode, stderr = run_ffmpeg(cmd, on_progress=on_progress, duration=dur, cancel=cancel)
+        if returncode == 0:
+            return
+        print("Warning: single-pass compose failed, falling back to two-step. Error:\n", stderr)
+
+    cmd = _two_step_cmd(build_cmd, bg_path, dur, target_w, target_h, on_progress, cancel)
+    _log_plan(plan)
+    returncode, stderr = run_ffmpeg(cmd, on_progress=on_progress, duration=dur, cancel=cancel)
+    if returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {stderr}\nCMD: {' '.join(cmd)}")
@@ -0,0 +1,141 @@
+"""Standalone render worker.
+
+Takes jobs from the durable render queue (render_queue.py) that the API fills when it
+runs with JOB_BACKEND=queue, renders them and publishes the results back to the queue.
+Several worker processes, on this machine or on others sharing the queue database and
+RENDER_RESULTS_DIR, can drain the same queue.
+
+    python worker.py [--threads N] [--once]
+"""
+import argparse
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import traceback
+
+import cancellation
+import jobs
+import progress
+import render_queue
+from api import RenderJobRequest, render_deduped, render_timeout, shutdown, startup
+
+
+# seconds between polls of an empty queue
+POLL_INTERVAL = float(os.environ.get("WORKER_POLL_INTERVAL", "1"))
+# seconds between checks of the cancel flag of a running job
+CANCEL_POLL_INTERVAL = 2.0
+# progress of a running job is written to the queue database at most this often (seconds)
+PROGRESS_WRITE_INTERVAL = 1.0
+_progress_written = {}
+
+
+def store_progress(job_id, view):
+    """progress listener: copy the progress of a running job to the queue for the API's SSE endpoint."""
+    if view["status"] != progress.RUNNING:
+        _progress_written.pop(job_id, None)
+        return
+    now = time.monotonic()
+    if now - _progress_written.get(job_id, 0) < PROGRESS_WRITE_INTERVAL and not view.get("done"):
+        return
+    _progress_written[job_id] = now
+    render_queue.set_progress(job_id, view)
+
+
+def process_job(job, worker_id):
+    """Render one claimed job, keeping its lease alive, and publish the result or the error.
+
+    The lease thread also polls the cancel flag set by POST /jobs/{id}/cancel and stops the
+    render (ffmpeg included) when it is set, or when the lease was lost to another worker;
+    the job's deadline is enforced by its token.
+    """
+    lease_stop = threading.Event()
+    tmpdir = tempfile.mkdtemp(prefix="shorts_worker_")
+    cancel = None
+    owned = False
+    try:
+        req = RenderJobRequest(**job["payload"])
+        cancel = cancellation.open_token(job["id"], render_timeout(req))
+
+        def keep_lease():
+            renewed = time.monotonic()
+            while not lease_stop.wait(CANCEL_POLL_INTERVAL):
+                if render_queue.cancel_requested(job["id"]):
+                    cancel.cancel(cancellation.CANCELLED)
+                if time.monotonic() - renewed >= render_queue.RENDER_QUEUE_LEASE / 3:
+                    if not render_queue.renew_lease(job["id"], worker_id):
+                        # taken over by another worker after the lease expired: stop rendering
+                        print(f"Job {job['id']} diambil alih worker lain, render dihentikan ({worker_id})")
+                        cancel.cancel(cancellation.CANCELLED)
+                        return
+                    renewed = time.monotonic()
+
+        threading.Thread(target=keep_lease, daemon=True, name="lease").start()
+        out_path = render_deduped(req, tmpdir, progress_key=job["id"], cancel=cancel)
+        owned = render_queue.publish_result(job["id"], worker_id, out_path)
+        print(f"Job {job['id']} selesai ({worker_id})")
+    except Exception as e:
+        # HTTPException carries status_code/detail; keep them so the result endpoint can report them
+        owned = render_queue.fail(job["id"], worker_id, str(getattr(e, "detail", None) or e), getattr(e, "status_code", None))
+        print(f"Job {job['id']} failed:\n", traceback.format_exc())
+    finally:
+        lease_stop.set()
+        if cancel is not None:
+            cancellation.close_token(job["id"], cancel)
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    if not owned:
+        # the job belongs to another worker now, which reports it
+        print(f"Job {job['id']} bukan milik {worker_id} lagi, hasil dibuang")
+    elif job.get("callback_url"):
+        jobs.send_callback(render_queue.get_job(job["id"]))
+
+
+def run_worker(worker_id, stop, once=False):
+    while not stop.is_set():
+        job = render_queue.claim(worker_id)
+        if job is None:
+            if once:
+                return
+            stop.wait(POLL_INTERVAL)
+            continue
+        process_job(job, worker_id)
+        if once:
+            return
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render worker for the durable render queue")
+    parser.add_argument("--threads", type=int, default=jobs.RENDER_WORKERS, help="jobs rendered at the same time")
+    parser.add_argument("--once", action="store_true", help="render at most one job per thread, then exit")
+    args = parser.parse_args()
+
+    startup()
+    progress.add_listener(store_progress)
+    stop = threading.Event()
+    prefix = f"{socket.gethostname()}:{os.getpid()}"
+    threads = [
+        threading.Thread(target=run_worker, args=(f"{prefix}:{i}", stop, args.once), name=f"worker-{i}")
+        for i in range(max(1, args.threads))
+    ]
+    for t in threads:
+        t.start()
+    print(f"Worker {prefix} berjalan dengan {len(threads)} thread, queue: {render_queue.RENDER_QUEUE_DB}")
+    try:
+        for t in threads:
+            while t.is_alive():
+                t.join(timeout=1)
+    except KeyboardInterrupt:
+        # let running renders finish, take no new jobs
+        print("Menghentikan worker setelah job yang sedang berjalan selesai...")
+        stop.set()
+        for t in threads:
+            t.join()
+    finally:
+        render_queue.sweep_jobs()
+        shutdown()
+
+
+if __name__ == "__main__":
+    main()